@@ -0,0 +1,83 @@
+# Measures how many messages per second the daemon can take in, for each
+# way of getting messages to it. A separate process sends the messages as
+# fast as it can, and the daemon side queues them like the daemon does
+# (including writing the received-message log lines, to /dev/null here).
+# UDP drops what doesn't fit in the socket buffer, so the number of
+# messages that made it is reported, too.
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import time
+
+import catflap_daemon
+import daemonlog
+import send_msg
+
+MESSAGE = 'motion detected: 4142 changed pixels 76 x 64 at 274 80'
+
+
+def send(proto, port, path, count):
+    client = send_msg.MessageClient('127.0.0.1', port, proto, path=path)
+    for _ in range(count):
+        client.send(MESSAGE)
+    client.close()
+
+
+async def listen(proto, intake, port, path, queue):
+    loop = asyncio.get_running_loop()
+    if proto == 'TCP':
+        return await loop.create_server(lambda: catflap_daemon.TCPServerProtocol(queue),
+                '127.0.0.1', port)
+    if proto == 'UNIX':
+        return await loop.create_unix_server(lambda: catflap_daemon.TCPServerProtocol(queue), path)
+    if intake == 'batched' or proto == 'UNIXDGRAM':
+        reader = catflap_daemon.DatagramReader(
+                catflap_daemon.datagram_socket(proto, '127.0.0.1', port, path), queue, loop)
+        reader.start()
+        return reader
+    transport, _ = await loop.create_datagram_endpoint(
+            lambda: catflap_daemon.UDPServerProtocol(queue), local_addr=('127.0.0.1', port))
+    return transport
+
+
+# Returns (messages received, seconds from the first message to the last).
+async def run(proto, intake, port, path, count):
+    loop = asyncio.get_running_loop()
+    queue = catflap_daemon.MessageQueue(policy='drop-new')
+    server = await listen(proto, intake, port, path, queue)
+    sender = multiprocessing.Process(target=send, args=(proto, port, path, count))
+    start = time.perf_counter()
+    sender.start()
+    last = (0, start)
+    # Done when everything has arrived, or nothing more arrived for a while
+    # after the sender finished.
+    while queue.qsize() < count:
+        await asyncio.sleep(0.001)
+        if queue.qsize() != last[0]:
+            last = (queue.qsize(), time.perf_counter())
+        elif not sender.is_alive() and time.perf_counter() - last[1] > 0.5:
+            break
+    await loop.run_in_executor(None, sender.join)
+    server.close()
+    return queue.qsize(), last[1] - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('benchmark message intake')
+    parser.add_argument('--count', default=50000, type=int, help='Messages to send per run')
+    parser.add_argument('--port', default=3334, type=int, help='Port for UDP and TCP')
+    args = parser.parse_args()
+    setups = [('UDP', 'callback'), ('UDP', 'batched'), ('UNIXDGRAM', 'batched'),
+              ('TCP', 'stream'), ('UNIX', 'stream')]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'catflap.sock')
+        for proto, intake in setups:
+            with open(os.devnull, 'w') as devnull:
+                daemonlog.start(stream=devnull, maxsize=args.count)
+                received, elapsed = asyncio.run(run(proto, intake, args.port, path, args.count))
+                daemonlog.stop()
+            print('{0} {1}: {2:.0f} messages/s, {3} of {4} received'.format(
+                proto, intake, received / elapsed, received, args.count))
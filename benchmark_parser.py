@@ -0,0 +1,68 @@
+# Compares cat_detector.parse() with the regular expressions that
+# CatDetector.parse_message() used before, on the messages recorded in a
+# daemon log.
+
+import argparse
+import re
+import time
+
+import cat_detector
+
+
+# What parse_message() used to do to take a message apart, without doing
+# anything with the result.
+def regex_parse(message):
+    msavefile = re.match(cat_detector.savefilepattern, message)
+    if msavefile is not None:
+        parts = msavefile.groups()[0].split('/')[-1].split('-')
+        if len(parts) < 3:
+            return None
+        if parts[2] == 'snapshot.jpg':
+            return (msavefile.groups()[0],)
+        return (msavefile.groups()[0], int(parts[0]))
+    motion = re.match(cat_detector.motionpattern, message)
+    if motion is None:
+        return None
+    return tuple(int(m) for m in motion.groups())
+
+
+def time_it(label, messages, repeat, fn):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for m in messages:
+            fn(m)
+    elapsed = time.perf_counter() - start
+    per_message = elapsed / (repeat * len(messages))
+    print('{0}: {1:.0f} ns per message'.format(label, per_message * 1e9))
+    return per_message
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('benchmark message parsing')
+    parser.add_argument('--daemonlog', default='./testdata/daemonlog', help='Daemon log to take messages from')
+    parser.add_argument('--repeat', default=200, type=int, help='How often to parse all messages')
+    args = parser.parse_args()
+    marker = ' received message '
+    messages = []
+    with open(args.daemonlog) as daemonlog:
+        for line in daemonlog:
+            pos = line.find(marker)
+            if pos >= 0:
+                messages.append(line[pos + len(marker):].rstrip('\n'))
+    print('{0} messages from {1}'.format(len(messages), args.daemonlog))
+    for m in messages:
+        parsed = cat_detector.parse(m)
+        old = regex_parse(m)
+        if parsed.kind == cat_detector.MessageKinds.motion:
+            same = old == parsed.motion
+        elif parsed.kind == cat_detector.MessageKinds.frame:
+            same = old == (parsed.filename, parsed.event)
+        elif parsed.kind == cat_detector.MessageKinds.snapshot:
+            same = old == (parsed.filename,)
+        else:
+            same = old is None
+        if not same:
+            print('parsers disagree on {0}: {1} vs {2}'.format(m, old, parsed))
+    regex = time_it('regex', messages, args.repeat, regex_parse)
+    single = time_it('single pass', messages, args.repeat, cat_detector.parse)
+    print('speedup: {0:.2f}x'.format(regex / single))
@@ -1,8 +1,16 @@
+from collections import namedtuple
 import cv2
+import daemonlog
+from daemonlog import log
 from datetime import date, datetime
 from enum import Enum
+import hashlib
+import io
 import numpy as np
+import os
 import re
+import knn
+import threading
 from trainer import Trainer
 
 
@@ -22,60 +30,400 @@ class CatStates(Enum):
     cat_with_prey = 5
 
 
+class MessageKinds(Enum):
+    frame = 1
+    snapshot = 2
+    motion = 3
+    bad_save = 4
+    unknown = 5
+
+
+# What parse() makes of a message. Only the fields that make sense for the
+# kind of message are set, the others are None.
+#   text: the message as received
+#   filename: for frames and snapshots
+#   event: event id (int), for frames and snapshots
+#   index: frame number within the event (int), for frames
+#   motion: (pxcount, width, height, x, y), for motion messages
+Message = namedtuple('Message', ['kind', 'text', 'filename', 'event', 'index', 'motion'])
+
+# The messages motion sends (see on_picture_save and on_motion_detected in
+# motion.conf). These are what parse() replaces; benchmark_parser.py still
+# uses them to compare the two.
+savefilepattern = re.compile('saved (.*.jpg)')
+motionpattern = re.compile(
+  r'motion detected: (\d+) changed pixels (\d+) x (\d+) at (\d+) (\d+)')
+
+SAVED_PREFIX = 'saved '
+MOTION_PREFIX = 'motion detected: '
+
+
+# Parses a message in one go, without regular expressions.
+# Saved files are named %v-%Y%m%d%H%M%S-%q.jpg (event, time, frame) or
+# %v-%Y%m%d%H%M%S-snapshot.jpg (see motion.conf).
+def parse(message):
+    message = message.rstrip()
+    if message.startswith(SAVED_PREFIX):
+        filename = message[len(SAVED_PREFIX):]
+        if not filename.endswith('.jpg'):
+            return Message(MessageKinds.unknown, message, None, None, None, None)
+        parts = filename[filename.rfind('/') + 1:-4].split('-')
+        if len(parts) < 3 or not parts[0].isdigit():
+            return Message(MessageKinds.bad_save, message, filename, None, None, None)
+        if parts[2] == 'snapshot':
+            return Message(MessageKinds.snapshot, message, filename, int(parts[0]), None, None)
+        index = int(parts[2]) if parts[2].isdigit() else None
+        return Message(MessageKinds.frame, message, filename, int(parts[0]), index, None)
+    if message.startswith(MOTION_PREFIX):
+        # '4142 changed pixels 76 x 64 at 274 80'
+        words = message[len(MOTION_PREFIX):].split(' ')
+        if (len(words) == 9 and words[1] == 'changed' and words[2] == 'pixels'
+                and words[4] == 'x' and words[6] == 'at'):
+            pxcount, width, height, x, y = words[0], words[3], words[5], words[7], words[8]
+            if (pxcount.isdigit() and width.isdigit() and height.isdigit()
+                    and x.isdigit() and y.isdigit()):
+                return Message(MessageKinds.motion, message, None, None, None,
+                        (int(pxcount), int(width), int(height), int(x), int(y)))
+    return Message(MessageKinds.unknown, message, None, None, None, None)
+
+
+# motion saves 640x480 frames and the model works at half that resolution
+# (see CatDetector.base_resolution), so frames are decoded straight to
+# grayscale at half size. The jpeg decoder can do that without ever
+# producing the full size colour image.
+DECODE_REDUCTION = 2
+_reduced_grayscale = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
+def read_image(filename, reduction=DECODE_REDUCTION):
+    return cv2.imread(filename, _reduced_grayscale[reduction])
+
+
+# Same as read_image() for a jpeg that is already in memory, like a frame
+# from motion's stream.
+def decode_image(data, reduction=DECODE_REDUCTION):
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), _reduced_grayscale[reduction])
+
+
+# A frame from a series, stored in a FrameRing. The file is only decoded
+# when something asks for the image, since most frames of an event end up
+# being ignored.
+class Frame(object):
+
+    def __init__(self, ring, slot):
+        self._ring = ring
+        self._slot = slot
+        self.filename = ring._filenames[slot]
+        self.reduction = ring.reduction
+
+    @property
+    def decoded(self):
+        return bool(self._ring._decoded[self._slot])
+
+    @property
+    def image(self):
+        return self._ring._image(self._slot)
+
+
+# The last capacity frames of an event. Decoded frames are kept as grayscale
+# in one array that is allocated the first time a frame is decoded and then
+# reused, so memory use doesn't grow however long a cat sits in front of the
+# flap. count is the number of frames appended since the last clear().
+class FrameRing(object):
+
+    def __init__(self, capacity, reduction=DECODE_REDUCTION):
+        self.capacity = capacity
+        self.reduction = reduction
+        self.count = 0
+        self._filenames = [None] * capacity
+        self._decoded = np.zeros(capacity, dtype=bool)
+        self._store = None
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def _slot(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('frame index out of range')
+        return (self.count - len(self) + index) % self.capacity
+
+    def __getitem__(self, index):
+        return Frame(self, self._slot(index))
+
+    def clear(self):
+        self.count = 0
+        self._decoded[:] = False
+
+    # image, if given, is the already decoded frame.
+    def append(self, filename, image=None):
+        slot = self.count % self.capacity
+        self.count += 1
+        self._filenames[slot] = filename
+        self._decoded[slot] = False
+        if image is not None:
+            self._put(slot, image)
+
+    def _put(self, slot, image):
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        if self._store is None:
+            self._store = np.zeros((self.capacity,) + image.shape, dtype=np.uint8)
+        if image.shape != self._store.shape[1:]:
+            rows, cols = self._store.shape[1:]
+            image = cv2.resize(image, (cols, rows), interpolation=cv2.INTER_AREA)
+        self._store[slot] = image
+        self._decoded[slot] = True
+
+    def _image(self, slot):
+        if not self._decoded[slot]:
+            image = read_image(self._filenames[slot], self.reduction)
+            if image is None:
+                return None
+            self._put(slot, image)
+        return self._store[slot]
+
+
+# The last capacity rows of width numbers each, e.g. motion events.
+# Rows are returned as tuples.
+class ArrayRing(object):
+
+    def __init__(self, capacity, width, dtype=np.int32):
+        self.capacity = capacity
+        self.count = 0
+        self._data = np.zeros((capacity, width), dtype=dtype)
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('ring index out of range')
+        slot = (self.count - len(self) + index) % self.capacity
+        return tuple(self._data[slot].tolist())
+
+    def clear(self):
+        self.count = 0
+
+    def append(self, row):
+        self._data[self.count % self.capacity] = row
+        self.count += 1
+
+
+# Decoding the jpg is the expensive part of handling a save message, and
+# it does not depend on any detector state. The daemon can run this in an
+# executor ahead of time and hand the result to handle_message().
+# message is what parse() returned. Returns None for messages that are not
+# about a saved image.
+def image_for_message(message):
+    if message.kind not in (MessageKinds.frame, MessageKinds.snapshot):
+        return None
+    return read_image(message.filename)
+
+
+# What get_coords() finds on a decoded frame around a motion box, as a
+# detector with this roi_margin would find it.
+def roi_coords(image, motion, roi_margin, reduction=DECODE_REDUCTION):
+    detector = CatDetector(None, capacity=1)
+    detector.roi_margin = roi_margin
+    return detector.get_coords(image, motion, reduction)
+
+
+# In 'roi' mode, finding the lines on a frame is as expensive as decoding
+# it, so the daemon does both in its executor once it knows which motion
+# box the frame will be evaluated with (see CatDetector.handle_message()).
+# jpeg is the frame from motion's stream, if there is one. Returns the
+# image and, if motion is given and the image could be decoded, the lines
+# as (filename, motion, coords).
+def decode_and_find_lines(message, jpeg=None, motion=None, roi_margin=20):
+    if jpeg is not None:
+        image = decode_image(jpeg)
+    else:
+        image = image_for_message(message)
+    if motion is None or image is None:
+        return image, None
+    return image, (message.filename, motion, roi_coords(image, motion, roi_margin))
+
+
+# How to load a model, by classifier and model file suffix. The loaders
+# take the file name and the index to use (only for numpy models).
+# opencv can't load binary models itself, so it is handed the memory mapped
+# samples instead; that copies them, but opencv is still the quicker one
+# for predicting one frame at a time. The numpy classifier starts up
+# without touching the samples.
+model_loaders = {
+    ('opencv', 'knn'): lambda modelfile, index: cv2.ml.KNearest_load(modelfile),
+    ('numpy', 'knn'): knn.load_opencv_model,
+    ('opencv', 'knnb'): knn.load_binary_as_opencv,
+    ('numpy', 'knnb'): knn.load_binary_model,
+}
+
+
+# Models trained from a label file are kept here, see trained_model().
+DEFAULT_MODEL_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'catflap')
+
+
+# Name of the cached model for this training data, from a hash of the data
+# and everything else that goes into training.
+def model_cache_key(trainingdata):
+    h = hashlib.sha256()
+    h.update('k={0};features={1};format={2}\n'.format(
+        Trainer.default_k, ','.join(knn.FEATURES), knn.BINARY_VERSION).encode('utf8'))
+    h.update(trainingdata)
+    return h.hexdigest()
+
+
+def _cache_file(trainingdata, cachedir):
+    return os.path.join(cachedir, model_cache_key(trainingdata) + '.knnb')
+
+
+def _train(trainingdata):
+    trainer = Trainer()
+    trainer.addTrainingDataFromFile(io.StringIO(trainingdata.decode('utf8')))
+    return trainer.makeTrainingData()
+
+
+def _save_to_cache(cachefile, samples, labels):
+    os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+    # Write to a temporary file first so a half written model never ends
+    # up in the cache.
+    tmpfile = '{0}.{1}.tmp'.format(cachefile, os.getpid())
+    knn.save_binary_model(tmpfile, samples, labels, Trainer.default_k)
+    os.replace(tmpfile, cachefile)
+    log.info('saved model trained from labels as %s', cachefile)
+
+
+# Trains a model from the label file, or, if the same labels have been used
+# before, loads the model trained then from cachedir. Returns the name of
+# the binary model file.
+def trained_model(trainingfile, cachedir):
+    with open(trainingfile, 'rb') as tfile:
+        trainingdata = tfile.read()
+    cachefile = _cache_file(trainingdata, cachedir)
+    if os.path.exists(cachefile):
+        log.info('using cached model %s for %s', cachefile, trainingfile)
+        return cachefile
+    samples, labels = _train(trainingdata)
+    _save_to_cache(cachefile, samples, labels)
+    return cachefile
+
+
+# Same as trained_model(), but returns the model for the classifier (see
+# model_loaders), and a newly trained model is saved to cachedir by a
+# thread of its own so nothing waits for the disk. Returns (model, thread
+# saving it or None).
+def trained_model_in_background(trainingfile, cachedir, classifier='opencv', index='brute'):
+    with open(trainingfile, 'rb') as tfile:
+        trainingdata = tfile.read()
+    cachefile = _cache_file(trainingdata, cachedir)
+    if os.path.exists(cachefile):
+        log.info('using cached model %s for %s', cachefile, trainingfile)
+        return model_loaders[(classifier, 'knnb')](cachefile, index), None
+    samples, labels = _train(trainingdata)
+    if classifier == 'numpy':
+        model = knn.KNearest(samples, labels, k=Trainer.default_k, index=index)
+        model.prepare()
+    else:
+        model = knn.make_opencv_model(samples, labels, Trainer.default_k)
+    saver = threading.Thread(target=_save_to_cache, args=(cachefile, samples, labels),
+                             name='modelcache')
+    saver.start()
+    return model, saver
+
+
 class CatDetector(object):
     statModel = None
+    # The thread saving a model trained by setupCatDetector() to the cache,
+    # if there is one.
+    cache_saver = None
+    # Bump when get_coords() changes, so features saved by an older version
+    # (see featurestore.py) are computed again.
+    feature_version = 1
 
+    # classifier is 'opencv' for cv2.ml.KNearest or 'numpy' for
+    # knn.KNearest, which can also use a tree index (see knn.py).
+    # Models trained from a trainingfile are cached in cachedir; pass None
+    # to always train a new one. A new model is used right away and saved
+    # to the cache in the background (see cache_saver).
     @classmethod
-    def setupCatDetector(cls, modelfile, trainingfile):
+    def setupCatDetector(cls, modelfile, trainingfile, classifier='opencv', index='brute',
+            cachedir=DEFAULT_MODEL_CACHE):
+        cls.cache_saver = None
         if trainingfile is not None:
-          # Cannot load a model? Train our own!
-          trainer = Trainer()
-          with open(trainingfile, 'r') as tfile:
-            trainer.addTrainingDataFromFile(tfile)
-          trainer.trainClassifier()
-          cls.statModel = trainer.knn_model
-        else: 
-          # What kind of model are we loading? Could have a factory
-          # here but for now, just basics.
-          suffix = modelfile.split('.')[-1]
-          if suffix == 'knn':
-            cls.statModel = cv2.ml.KNearest_load(modelfile)
+          if cachedir is not None:
+            cls.statModel, cls.cache_saver = trained_model_in_background(
+                trainingfile, cachedir, classifier, index)
+            return
           else:
-            raise NotImplementedError('Only supporting knn models right now')
+            # Cannot load a model? Train our own!
+            trainer = Trainer()
+            with open(trainingfile, 'r') as tfile:
+              trainer.addTrainingDataFromFile(tfile)
+            trainer.trainClassifier()
+            cls.statModel = trainer.knn_model
+            if classifier == 'numpy':
+              samples, labels = trainer.makeTrainingData()
+              cls.statModel = knn.KNearest(samples, labels,
+                  k=trainer.knn_model.getDefaultK(), index=index)
+            return
+        suffix = modelfile.split('.')[-1]
+        loader = model_loaders.get((classifier, suffix))
+        if loader is None:
+          raise NotImplementedError('Cannot load {0} models from {1}'.format(
+              classifier, modelfile))
+        cls.statModel = loader(modelfile, index)
 
+    # capacity is how many frames, motions and trajectory points of the
+    # current event are kept.
     @classmethod
-    def makeCatDetector(cls):
+    def makeCatDetector(cls, capacity=32):
         if cls.statModel:
-            return cls(cls.statModel)
+            return cls(cls.statModel, capacity)
         return None
 
-    def __init__(self, statModel):
+    def __init__(self, statModel, capacity=32):
         self._message_state = MessageStates.waiting
         self._cat_state = CatStates.waiting
         self._snapshot = None
-        self._motions = []
-        self._images = []
-        self._trajectory = []
+        self._motions = ArrayRing(capacity, 5)
+        self._images = FrameRing(capacity)
+        self._trajectory = ArrayRing(capacity, 2)
         self._current_event = -1
-        self.savefilepattern = re.compile('saved (.*.jpg)')
-        self.motionpattern = re.compile(
-          'motion detected: (\d+) changed pixels (\d+) x (\d+) at (\d+) (\d+)')
         self._statModel = statModel
         self.base_resolution = (240.0, 320.0)
+        # Where the features for a frame with a motion event come from:
+        # 'motion' uses the motion box as is, 'roi' looks for lines in the
+        # image, but only inside the motion box plus roi_margin pixels
+        # (in the coordinates of the frames saved by motion).
+        self.feature_mode = 'motion'
+        self.roi_margin = 20
+        # What the last call to process_image_and_motion() looked at, as
+        # (filename, motion, features), for the daemon's journal. features
+        # is None if the image wasn't evaluated.
+        self.last_evaluation = None
+        self._features = None
+        # The lines found on a frame outside of the detector, see
+        # handle_message().
+        self._lines = None
 
 
-    # TODO: all the file reading operations should probably be done
-    # asynchronously and in their own thread pool (so as not to block
-    # the main event loop). However, since the images are pretty small
-    # (about 16K) and we get at most two per second, it's not a huge
-    # concern.
-    # There is also literally nothing else I want the system to do while
-    # it's loading and processing an image, so maybe threads are not the
-    # way to go here anyway :-).
-    def load_snapshot(self, filename):
-        img = cv2.imread(filename)
+    # The file reading operations can be done in an executor by the
+    # daemon (see image_for_message()) so they don't block the main event
+    # loop while motion sends a burst of messages. If img is passed in, it
+    # is used as is, otherwise the file is read here.
+    def load_snapshot(self, filename, img=None):
+        if img is None:
+            img = read_image(filename)
         if img is not None:
-            self._snapshot = cv2.imread(filename)
+            self._snapshot = img
             return 'snapshot'
         else:
             return 'Failed to load snapshot from {0}'.format(filename)
@@ -93,18 +441,28 @@ class CatDetector(object):
                   1 : { 0: 'e', -1: 'ne', 1: 'se' } }[xdiff][ydiff]
             
 
-    def decide_if_cat_has_prey(self, image, trajectory):
+    # frame.image decodes the frame if it hasn't been decoded yet.
+    def decide_if_cat_has_prey(self, frame, trajectory):
         return False
 
     def reset(self):
         self._current_event = -1
-        self._motions = []
-        self._images = []
-        self._trajectory = []
+        self._motions.clear()
+        self._images.clear()
+        self._trajectory.clear()
+        self._lines = None
         self._message_state = MessageStates.waiting
         self._cat_state = CatStates.waiting
 
     def process_image_and_motion(self):
+        self._features = None
+        value = self._process_image_and_motion()
+        if len(self._images):
+            motion = self._motions[-1] if len(self._motions) else None
+            self.last_evaluation = (self._images[-1].filename, motion, self._features)
+        return value
+
+    def _process_image_and_motion(self):
         self._message_state = MessageStates.waiting
         if self._cat_state == CatStates.no_cat_arriving:
             # TODO: might want to wait a bit longer before deciding
@@ -114,10 +472,19 @@ class CatDetector(object):
             return 'ignoring image as cat flap already locked'
         if not len(self._images):
             return 'cannot process image as there are none in the list'
-        img = self._images[-1]
+        frame = self._images[-1]
         motion = self._motions[-1]
         if self._cat_state != CatStates.cat_arriving:
-            detected = self.evaluate_motion_and_image(motion=motion, image=img)
+            img = frame.image
+            if img is None:
+                return 'Failed to load image from {0}'.format(frame.filename)
+            lines = self._lines
+            if (self.feature_mode == 'roi' and lines is not None
+                    and lines[0] == frame.filename and np.array_equal(lines[1], motion)):
+                detected = self.evaluate_coords(lines[2])
+            else:
+                detected = self.evaluate_motion_and_image(motion=motion, image=img,
+                        reduction=frame.reduction)
             if detected == 0:
                 self._cat_state = CatStates.no_cat_arriving
             elif detected == 1:
@@ -127,105 +494,149 @@ class CatDetector(object):
             elif detected == 3:
                 self._cat_state = CatStates.cat_arriving
         if self._cat_state == CatStates.cat_arriving:
-            has_prey = self.decide_if_cat_has_prey(image=img, trajectory=self._trajectory)
+            has_prey = self.decide_if_cat_has_prey(frame=frame, trajectory=self._trajectory)
             if has_prey:
                 # TODO: lock cat flap and set a timer to unlock it
                 return 'event {0} image {1}: should lock cat flap '.format(
-                        self._current_event, len(self._images))
+                        self._current_event, self._images.count)
         return 'event {0} image {1} evaluated as {2}'.format(
-                self._current_event, len(self._images), self._cat_state)
+                self._current_event, self._images.count, self._cat_state)
 
 
-    def load_image(self, filename):
-        # TODO: maybe don't do this until we know we need it.
-        img = cv2.imread(filename)
-        if img is None:
+    # The image is not decoded here, only once process_image_and_motion()
+    # decides to look at it (unless the daemon already decoded it, then img
+    # is passed in).
+    # event is the event id if the caller already knows it, otherwise it is
+    # taken from the filename.
+    def load_image(self, filename, img=None, event=None):
+        if img is None and not os.path.exists(filename):
             return 'Failed to load image from {0}'.format(filename)
-        basename = filename.split('/')
-        parts = basename[-1].split('-')
+        if event is None:
+            event = int(filename.split('/')[-1].split('-')[0])
         if self._message_state == MessageStates.waiting:
             self._message_state = MessageStates.got_image
         elif self._message_state == MessageStates.got_motion:
             self._message_state = MessageStates.got_image_and_motion
-        if int(parts[0]) != self._current_event:
+        if event != self._current_event:
             # reset() will be called by the daemon if too much time
             # has passed since the last event.
             # If reset() hasn't been called, it's possible this is a new
             # event following quickly after another event. Sometimes the
             # cats sit about in front of the cat flap for a while.
-            self._current_event = int(parts[0])
+            self._current_event = event
             self._cat_state = CatStates.waiting
-        self._images.append(img)
+        self._images.append(filename, img)
         if self._message_state == MessageStates.got_image_and_motion:
             return self.process_image_and_motion()
         else:
             return 'got image but no motion event'
 
-    def evaluate_motion_and_image(self, motion, image):
+    # Frames are only worth decoding for events that haven't been decided
+    # yet. The daemon uses this to avoid decoding frames ahead of time that
+    # would be ignored anyway.
+    def wants_frame(self, event_id):
+        if event_id != self._current_event:
+            return True
+        return self._cat_state not in (CatStates.no_cat_arriving, CatStates.cat_with_prey)
+
+    # The image can be colour or grayscale. Motion coordinates are relative to
+    # the frames as motion saved them, so if the image was decoded at a reduced
+    # size, reduction says by how much.
+    def evaluate_motion_and_image(self, motion, image, reduction=1):
         if motion is None:
             return self.evaluate_image(image)
+        if self.feature_mode == 'roi' and image is not None:
+            return self.evaluate_image(image, motion, reduction)
         (pxcount, width, height, x, y) = motion
         left = round(x - width/2)
         right = round(x + width/2)
         top = round(height - y)
         bottom = round(height + y)
-        print('motion translated to raw coordinates: %s %s %s %s' % (left, right, top, bottom))
+        log.debug('motion translated to raw coordinates: %s %s %s %s', left, right, top, bottom)
         if image is not None:
-            imgwidth, imgheight, _ = image.shape
-            print('image has width %d and height %d' % (imgwidth, imgheight))
+            imgwidth, imgheight = image.shape[:2]
+            imgwidth *= reduction
+            imgheight *= reduction
             width_factor = self.base_resolution[0] / imgwidth
             height_factor = self.base_resolution[1] / imgheight
-            print('width factor %f height %f' % (width_factor, height_factor))
+            log.debug('image has width %d and height %d, width factor %f height %f',
+                      imgwidth, imgheight, width_factor, height_factor)
             left = left * width_factor
             right = right * width_factor
             top = height * height_factor
             bottom = bottom * height_factor
-        print('motion coordinates normalised: %s %s %s %s' % (left, right, top, bottom))
+        log.debug('motion coordinates normalised: %s %s %s %s', left, right, top, bottom)
+        self._features = (left, right, top, bottom)
         features = np.ndarray((1, 4), dtype=np.float32,
                 buffer=np.array((left, right, top, bottom), dtype=np.float32))
         retval, _ = self._statModel.predict(features)
         return int(retval)
 
-    def get_coords(self, image):
-        cur = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    # Returns the bounding box of the lines found on the image, scaled to
+    # base_resolution. If motion is given, only the part of the image around
+    # the motion box is searched (see roi_margin); reduction is as for
+    # evaluate_motion_and_image().
+    def get_coords(self, image, motion=None, reduction=1):
+        cur = image
+        if image.ndim == 3:
+            cur = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        imgwidth, imgheight = image.shape[:2]
+        x0 = y0 = 0
+        if motion is not None:
+            (x0, x1, y0, y1) = self.motion_roi(motion, cur.shape, reduction)
+            if x0 >= x1 or y0 >= y1:
+                log.debug('motion box is outside the image')
+                return None
+            cur = cur[y0:y1, x0:x1]
         ret, cur = cv2.threshold(cur, 127, 255, cv2.THRESH_BINARY)
         cur = cv2.Canny(cur, 100, 200, 3)
         lines = cv2.HoughLinesP(cur, 1, np.pi/180, 40, 25, 35)
         if lines is None or not len(lines):
-            print('no lines found on image')
+            log.debug('no lines found on image')
             return None
-        imgwidth, imgheight, _ = image.shape
         width_factor = self.base_resolution[0] / imgwidth
         height_factor = self.base_resolution[1] / imgheight
-        left = np.float64(imgwidth)
-        right = np.float64(0.0)
-        top = np.float64(imgheight)
-        bottom = np.float64(0.0)
-        for points in lines:
-            p = points[0]
-            left = min(left, p[0], p[2])
-            right = max(right, p[0], p[2])
-            top = min(top, p[1], p[3])
-            bottom = max(bottom, p[1], p[3])
+        # lines is n x 1 x 4 (x1, y1, x2, y2), relative to the roi.
+        points = lines.reshape(-1, 4)
+        xs = points[:, 0::2] + x0
+        ys = points[:, 1::2] + y0
+        left = min(np.float64(imgwidth), xs.min())
+        right = max(np.float64(0.0), xs.max())
+        top = min(np.float64(imgheight), ys.min())
+        bottom = max(np.float64(0.0), ys.max())
         left = left * width_factor
         right = right * width_factor
         top = top * height_factor
         bottom = bottom * height_factor
-        print('returning %f %f %f %f' % (left, right, top, bottom))
-        for x in (left, right, top, bottom):
-            print(type(x))
+        log.debug('lines found at %f %f %f %f', left, right, top, bottom)
         return (left, right, top, bottom)
 
-    def evaluate_image(self, image):
-        coords = self.get_coords(image)
+    # The motion box plus roi_margin as (x0, x1, y0, y1) pixel ranges of an
+    # image with the given shape, clipped to the image.
+    def motion_roi(self, motion, shape, reduction=1):
+        (pxcount, width, height, x, y) = motion
+        rows, cols = shape[:2]
+        x0 = int((x - width/2 - self.roi_margin) / reduction)
+        x1 = int(np.ceil((x + width/2 + self.roi_margin) / reduction))
+        y0 = int((y - height/2 - self.roi_margin) / reduction)
+        y1 = int(np.ceil((y + height/2 + self.roi_margin) / reduction))
+        return (max(x0, 0), min(x1, cols), max(y0, 0), min(y1, rows))
+
+    def evaluate_image(self, image, motion=None, reduction=1):
+        return self.evaluate_coords(self.get_coords(image, motion, reduction))
+
+    # coords is what get_coords() returned.
+    def evaluate_coords(self, coords):
         if coords is None:
             return 0  # no cat?
         (left, right, top, bottom) = coords
         features = np.ndarray((1, 4), dtype=np.float32,
                 buffer=np.array((left, right, top, bottom), dtype=np.float32))
-        print('image coordinates normalised: %s %s %s %s' % (left, right, top, bottom))
+        log.debug('image coordinates normalised: %s %s %s %s', left, right, top, bottom)
+        self._features = (left, right, top, bottom)
         retval, _ = self._statModel.predict(features)
-        print('i think this is %s' % Trainer.string_for_label(retval))
+        if log.isEnabledFor(daemonlog.DEBUG):
+            log.debug('i think this is %s', Trainer.string_for_label(retval))
         return int(retval)
 
     def motion_detected(self, params):
@@ -243,25 +654,30 @@ class CatDetector(object):
             self._message_state = MessageStates.got_motion
             return 'motion: {0}'.format(params)
 
-    def parse_message(self, message):
-        msavefile = re.match(self.savefilepattern, message)
-        if msavefile is not None:
-            basefilename = msavefile.groups()[0].split('/')
-            parts = basefilename[-1].split('-')
-            if len(parts) < 3:
-                return 'Failed to parse save file message {0}'.format(message)
-            elif parts[2] == 'snapshot.jpg':
-                # This is a message telling us a new snapshot has been taken
-                return self.load_snapshot(msavefile.groups()[0])
-            else:
-                # This is an image from a series
-                return self.load_image(msavefile.groups()[0])
-        else:
-            motion = re.match(self.motionpattern, message)
-            if motion is None:
-                return 'Failed to recognize message {0}'.format(message)
-            else:
-                return self.motion_detected(tuple(int(m) for m in motion.groups()))
+    # image: optionally, the already decoded image for a save message
+    # (see image_for_message()).
+    def parse_message(self, message, image=None):
+        return self.handle_message(parse(message), image)
+
+    # message is what parse() returned.
+    # lines: optionally, what get_coords() found on a frame in 'roi' mode,
+    # as (filename, motion, coords) (see decode_and_find_lines()). They are
+    # used if the detector evaluates that frame with that motion box,
+    # otherwise it looks for the lines itself.
+    def handle_message(self, message, image=None, lines=None):
+        if lines is not None:
+            self._lines = lines
+        if message.kind == MessageKinds.frame:
+            # This is an image from a series
+            return self.load_image(message.filename, image, message.event)
+        elif message.kind == MessageKinds.motion:
+            return self.motion_detected(message.motion)
+        elif message.kind == MessageKinds.snapshot:
+            # This is a message telling us a new snapshot has been taken
+            return self.load_snapshot(message.filename, image)
+        elif message.kind == MessageKinds.bad_save:
+            return 'Failed to parse save file message {0}'.format(message.text)
+        return 'Failed to recognize message {0}'.format(message.text)
 
 
 
@@ -0,0 +1,286 @@
+# A catalog of everything the other tools otherwise find out by listing the
+# image directory, scanning daemon logs and reading label files, kept in a
+# sqlite database so that questions like "all cat arriving frames in March"
+# are indexed lookups.
+#
+# Tables:
+#   frames: every frame motion saved, by file name (without the directory),
+#     with its day, event id and index.
+#   snapshots: the hourly snapshots.
+#   motions: what the daemon log says about each frame: when the save and
+#     motion messages came in, and the motion box.
+#   labels: the labels from label files (like catlabels.csv).
+#   sources: what has been read from each directory, log and label file,
+#     so the catalog can be brought up to date by reading only what's new.
+#
+# Days are 'YYYY-MM-DD' strings.
+
+from datetime import datetime
+import os
+import sqlite3
+
+import events_from_log
+
+DEFAULT_CATALOG = './catflap.sqlite'
+
+SCHEMA = '''
+create table if not exists frames (
+    filename text primary key,
+    dir text not null,
+    day text not null,
+    event integer not null,
+    idx integer not null,
+    taken text not null);
+create index if not exists frames_by_day on frames (day, event, idx);
+create table if not exists snapshots (
+    filename text primary key,
+    dir text not null,
+    day text not null,
+    hour text not null,
+    event integer not null,
+    taken text not null);
+create index if not exists snapshots_by_hour on snapshots (hour);
+create table if not exists motions (
+    day text not null,
+    event integer not null,
+    idx integer,
+    filename text,
+    received text,
+    motiontime text,
+    changedpixels integer,
+    width integer,
+    height integer,
+    x integer,
+    y integer,
+    source text not null);
+create index if not exists motions_by_day on motions (day, event, idx);
+create index if not exists motions_by_filename on motions (filename);
+create table if not exists labels (
+    filename text primary key,
+    day text,
+    label text not null,
+    left integer,
+    right integer,
+    top integer,
+    bottom integer);
+create index if not exists labels_by_label on labels (label, day);
+create table if not exists sources (
+    path text primary key,
+    size integer,
+    mtime real,
+    offset integer,
+    identity text);
+'''
+
+
+# Splits a frame or snapshot file name (with or without a directory) into
+# (event id, time taken, index), with index 'snapshot' for snapshots.
+# Returns None for other files.
+def split_filename(filename):
+    name = os.path.basename(filename)
+    if not name.endswith('.jpg'):
+        return None
+    parts = name[:-len('.jpg')].split('-')
+    if len(parts) != 3 or not parts[0].isdigit() or len(parts[1]) != 14 or not parts[1].isdigit():
+        return None
+    if parts[2] != 'snapshot' and not parts[2].isdigit():
+        return None
+    return int(parts[0]), parts[1], parts[2]
+
+
+def day_of(taken):
+    return '{0}-{1}-{2}'.format(taken[0:4], taken[4:6], taken[6:8])
+
+
+class Catalog(object):
+
+    def __init__(self, filename=DEFAULT_CATALOG):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def _source(self, path):
+        row = self.db.execute('select size, mtime, offset from sources where path = ?',
+                              (path,)).fetchone()
+        return row if row is not None else (None, None, 0)
+
+    def _set_source(self, path, size, mtime, offset, identity=None):
+        self.db.execute('insert or replace into sources values (?, ?, ?, ?, ?)',
+                        (path, size, mtime, offset, identity))
+
+    # Adds the frames and snapshots in imagedir that aren't in the catalog
+    # yet. Skipped if the directory hasn't changed since the last time.
+    # Returns the number of files added.
+    def add_image_dir(self, imagedir):
+        path = os.path.abspath(imagedir)
+        mtime = os.stat(path).st_mtime
+        if self._source(path)[1] == mtime:
+            return 0
+        frames = []
+        snapshots = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                parts = split_filename(entry.name)
+                if parts is None:
+                    continue
+                event, taken, idx = parts
+                if idx == 'snapshot':
+                    snapshots.append((entry.name, path, day_of(taken), taken[:10], event, taken))
+                else:
+                    frames.append((entry.name, path, day_of(taken), event, int(idx), taken))
+        with self.db:
+            before = self.db.total_changes
+            self.db.executemany('insert or ignore into frames values (?, ?, ?, ?, ?, ?)', frames)
+            self.db.executemany('insert or ignore into snapshots values (?, ?, ?, ?, ?, ?)',
+                                snapshots)
+            added = self.db.total_changes - before
+            self._set_source(path, None, mtime, 0)
+        return added
+
+    # Adds what a daemon log says about frames and motions. Uses the log's
+    # index (see events_from_log.DaemonLogIndex) to only read the days that
+    # were added to the log since the last time.
+    def add_daemonlog(self, logfilename):
+        path = os.path.abspath(logfilename)
+        index = events_from_log.DaemonLogIndex(logfilename).update()
+        size = os.path.getsize(logfilename)
+        oldsize, _, _ = self._source(path)
+        if oldsize is not None:
+            identity, = self.db.execute('select identity from sources where path = ?',
+                                        (path,)).fetchone()
+            if oldsize > size or events_from_log.log_identity(logfilename, oldsize) != identity:
+                # Rotated, start over.
+                oldsize = None
+        days = [day for day, (start, end) in index.date_ranges().items()
+                if oldsize is None or end > oldsize]
+        with self.db:
+            if oldsize is None:
+                self.db.execute('delete from motions where source = ?', (path,))
+            for day in days:
+                self.db.execute('delete from motions where source = ? and day = ?', (path, day))
+                events, _ = events_from_log.daemonlog_events_for_date(
+                        index.lines_for_date(day), datetime.strptime(day, '%Y-%m-%d').date())
+                rows = []
+                for event_id, entries in events.items():
+                    for entry in entries:
+                        idx = entry.get('idx')
+                        rows.append((day, int(event_id), None if idx is None else int(idx),
+                                     entry.get('filename'), entry.get('timeofday'),
+                                     entry.get('motiontime'), entry.get('changedpixels'),
+                                     entry.get('width'), entry.get('height'),
+                                     entry.get('x'), entry.get('y'), path))
+                self.db.executemany('insert into motions values '
+                                    '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self._set_source(path, size, None, 0, events_from_log.log_identity(logfilename, size))
+        return len(days)
+
+    # Adds the labels from a label file. Label files are only ever appended
+    # to, so only lines after the ones read last time are read. Later labels
+    # for a file replace earlier ones.
+    def add_labels(self, labelfilename):
+        path = os.path.abspath(labelfilename)
+        size = os.path.getsize(labelfilename)
+        oldsize, _, offset = self._source(path)
+        if oldsize is None or size < oldsize:
+            offset = 0
+        rows = []
+        with open(labelfilename, 'rb') as labelfile:
+            labelfile.seek(offset)
+            for line in labelfile:
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                parts = line.decode('utf8').rstrip('\n').split(',')
+                if parts[0] == 'filename' or len(parts) < 2:
+                    continue
+                name = os.path.basename(parts[0])
+                split = split_filename(name)
+                day = None if split is None else day_of(split[1])
+                coords = [int(c) if c.lstrip('-').isdigit() else None for c in parts[2:6]]
+                coords += [None] * (4 - len(coords))
+                rows.append((name, day, parts[1]) + tuple(coords))
+        with self.db:
+            self.db.executemany('insert or replace into labels values (?, ?, ?, ?, ?, ?, ?)', rows)
+            self._set_source(path, size, None, offset)
+        return len(rows)
+
+    def days(self):
+        return [row[0] for row in self.db.execute(
+            'select distinct day from frames order by day')]
+
+    # The first day after day (a date) that has frames, or None.
+    def next_day(self, day):
+        row = self.db.execute('select min(day) from frames where day > ?',
+                              (day.isoformat(),)).fetchone()
+        return None if row[0] is None else datetime.strptime(row[0], '%Y-%m-%d').date()
+
+    # (events, snapshots) for a day (a date) in the form
+    # listImages.list_events_for_date() returns them.
+    def frames_for_date(self, day):
+        events = {}
+        for filename, event, idx, taken in self.db.execute(
+                'select filename, event, idx, taken from frames where day = ? '
+                'order by event, taken, idx', (day.isoformat(),)):
+            event_id = str(event)
+            events.setdefault(event_id, []).append({
+                'timeofday': taken[8:],
+                'id': event_id,
+                'datetime': taken,
+                'idx': filename[:-len('.jpg')].split('-')[2],
+                'filename': filename})
+        snapshots = {}
+        for filename, event, taken in self.db.execute(
+                'select filename, event, taken from snapshots where day = ? order by taken',
+                (day.isoformat(),)):
+            snapshots[taken[8:10]] = {'id': str(event), 'timeofday': taken[8:],
+                                      'filename': filename}
+        return events, snapshots
+
+    # (events, snapshots) for a day (a date) in the form
+    # events_from_log.daemonlog_events_for_date() returns them.
+    def events_for_date(self, day):
+        events = {}
+        for row in self.db.execute(
+                'select event, idx, filename, received, motiontime, changedpixels, '
+                'width, height, x, y from motions where day = ? order by event',
+                (day.isoformat(),)):
+            (event, idx, filename, received, motiontime, pixels, width, height, x, y) = row
+            event_id = str(event)
+            entry = {}
+            if filename is not None:
+                entry.update({'id': event_id, 'datetime': filename.split('-')[1],
+                              'timeofday': received, 'idx': filename[:-len('.jpg')].split('-')[2],
+                              'filename': filename})
+            if motiontime is not None:
+                entry.update({'motiontime': motiontime, 'changedpixels': pixels,
+                              'width': width, 'height': height, 'x': x, 'y': y})
+            events.setdefault(event_id, []).append(entry)
+        for v in events.values():
+            v.sort(key=lambda e: e.get('timeofday', e.get('motiontime')) + e.get('idx', ''))
+        snapshots = {}
+        for filename, event, taken in self.db.execute(
+                'select filename, event, taken from snapshots where day = ?',
+                (day.isoformat(),)):
+            snapshot = events_from_log.make_snapshot_entry(filename[:-len('-snapshot.jpg')])
+            snapshots[snapshot['basetime']] = snapshot
+        return events, snapshots
+
+    # Labelled frames as (filename, label, left, right, top, bottom), for
+    # one label or all of them, optionally only for days from first to last
+    # (dates, inclusive).
+    def labelled(self, label=None, first=None, last=None):
+        query = 'select filename, label, left, right, top, bottom from labels where 1'
+        params = []
+        if label is not None:
+            query += ' and label = ?'
+            params.append(label)
+        if first is not None:
+            query += ' and day >= ?'
+            params.append(first.isoformat())
+        if last is not None:
+            query += ' and day <= ?'
+            params.append(last.isoformat())
+        return self.db.execute(query + ' order by filename', params).fetchall()
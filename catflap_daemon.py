@@ -1,87 +1,657 @@
 import argparse
 import asyncio
-from datetime import datetime
+import os
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+import socket
+import time
 import cat_detector 
+import daemonlog
+from daemonlog import log
+import dirwatch
+import journal
+import mjpeg
+import send_msg
 from trainer import Trainer
 
+
+MessageKinds = cat_detector.MessageKinds
+
+# Motion messages and frames decide whether to lock the flap, so they go
+# first. They share a priority so the detector still sees them in the order
+# they arrived. Snapshots only matter for the next event, and anything else
+# is housekeeping.
+PRIORITIES = {
+    MessageKinds.motion: 0,
+    MessageKinds.frame: 0,
+    MessageKinds.snapshot: 1,
+    MessageKinds.bad_save: 2,
+    MessageKinds.unknown: 2,
+}
+PRIORITY_NAMES = ('urgent', 'snapshot', 'housekeeping')
+
+
+# A bounded priority queue for incoming messages. Messages are parsed on
+# the way in (see cat_detector.parse()), and get() returns
+# (parsed message, priority, receive time) for the oldest message of the
+# most urgent priority that has any.
+# The protocols can't wait for space, so when the queue is full the
+# overload policy decides what goes:
+#   drop-new: the incoming message is dropped.
+#   drop-oldest: the oldest queued message is dropped.
+#   latest-wins: a new frame replaces older frames of the same event that
+#     are still waiting, since by the time we get to them the cat is long
+#     gone. When full, the least urgent messages are dropped first, and
+#     motion messages only if there is nothing else.
+# Dropped messages are counted by reason in self.dropped.
+class MessageQueue(asyncio.Queue):
+
+    def __init__(self, maxsize=0, policy='latest-wins'):
+        super().__init__(maxsize)
+        self.policy = policy
+        self.dropped = Counter()
+
+    def _init(self, maxsize):
+        self._queues = [deque() for _ in PRIORITY_NAMES]
+
+    def _put(self, item):
+        self._queues[PRIORITIES[item[0].kind]].append(item)
+
+    def _get(self):
+        for queue in self._queues:
+            if queue:
+                message, received = queue.popleft()
+                return (message, PRIORITIES[message.kind], received)
+
+    def qsize(self):
+        return sum(len(queue) for queue in self._queues)
+
+    def empty(self):
+        return not any(self._queues)
+
+    def full(self):
+        if self.maxsize <= 0:
+            return False
+        return self.qsize() >= self.maxsize
+
+    def _remove(self, queue, index, reason):
+        del queue[index]
+        self.dropped[reason] += 1
+        # The message was counted as unfinished when it was put.
+        self.task_done()
+
+    # Motion messages share the urgent queue with frames, so the oldest
+    # message that isn't a motion message goes first.
+    def _drop_least_urgent(self):
+        for queue in reversed(self._queues):
+            if queue:
+                index = next((index for index, (queued, _) in enumerate(queue)
+                              if queued.kind != MessageKinds.motion), 0)
+                self._remove(queue, index, queue[index][0].kind.name)
+                return
+
+    def _drop_oldest(self):
+        oldest = min((queue for queue in self._queues if queue),
+                     key=lambda queue: queue[0][1])
+        self._remove(oldest, 0, 'oldest')
+
+    def put_nowait(self, text):
+        message = cat_detector.parse(text)
+        if self.policy == 'latest-wins':
+            if message.kind == MessageKinds.frame:
+                queue = self._queues[PRIORITIES[message.kind]]
+                stale = [index for index, (queued, _) in enumerate(queue)
+                         if queued.kind == message.kind and queued.event == message.event]
+                for index in reversed(stale):
+                    self._remove(queue, index, 'stale frame')
+            if self.full():
+                self._drop_least_urgent()
+        elif self.full():
+            if self.policy == 'drop-oldest':
+                self._drop_oldest()
+            else:
+                self.dropped['new'] += 1
+                return
+        super().put_nowait((message, time.monotonic()))
+
+
+# Time from receiving a message to having processed it, per priority.
+class LatencyStats(object):
+
+    def __init__(self):
+        self.count = [0] * len(PRIORITY_NAMES)
+        self.total = [0.0] * len(PRIORITY_NAMES)
+        self.max = [0.0] * len(PRIORITY_NAMES)
+
+    def add(self, priority, latency):
+        self.count[priority] += 1
+        self.total[priority] += latency
+        self.max[priority] = max(self.max[priority], latency)
+
+    def __str__(self):
+        return ', '.join('{0}: {1} msgs avg {2:.3f}s max {3:.3f}s'.format(
+            name, self.count[p], self.total[p] / self.count[p], self.max[p])
+            for p, name in enumerate(PRIORITY_NAMES) if self.count[p])
+
+
+async def stats_worker(queue, latency, interval):
+    while True:
+        await asyncio.sleep(interval)
+        log.info('%s: queue length %d, dropped messages: %s, dropped log records: %d '
+                 '(messages and decisions: %d), latency: %s',
+                 datetime.now().strftime("%Y-%m-%d-%H:%M:%S"), queue.qsize(),
+                 dict(queue.dropped), daemonlog.dropped(), daemonlog.dropped_events(), latency)
+
+
+# Every message that comes in is logged with the time it arrived, then
+# queued.
+def receive(queue, message):
+    daemonlog.received(message)
+    queue.put_nowait(message)
+
+
+# Same as receive() for several messages that arrived together.
+def receive_batch(queue, messages):
+    for message in messages:
+        daemonlog.received(message)
+        queue.put_nowait(message)
+
+
 class UDPServerProtocol(asyncio.DatagramProtocol):
 
     def __init__(self, queue):
         self._queue = queue
 
     def datagram_received(self, data, addr):
-        msgtime = datetime.now()
-        timestr = msgtime.strftime("%Y-%m-%d-%H:%M:%S:%f")
-        message = data.decode('utf8')
-        print('{0}: received message {1}'.format(timestr, message), flush=True)
-        self._queue.put_nowait(message)
+        receive(self._queue, data.decode('utf8', errors='replace'))
+
+
+# Reads datagrams from a socket (UDP or unix datagram), draining everything
+# that is waiting (up to max_batch) each time the event loop finds the
+# socket readable, instead of one callback per datagram.
+class DatagramReader(object):
+
+    def __init__(self, sock, queue, loop=None, max_batch=64):
+        self._sock = sock
+        self._queue = queue
+        self._loop = loop
+        self.max_batch = max_batch
 
+    def start(self):
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        self._sock.setblocking(False)
+        self._loop.add_reader(self._sock.fileno(), self._read)
 
+    def close(self):
+        self._loop.remove_reader(self._sock.fileno())
+        self._sock.close()
+
+    # A datagram that isn't valid utf8 still goes on the queue (and ends up
+    # as an unknown message), and a socket error (like ECONNREFUSED, which
+    # UDP reports on the next recv) ends the batch without losing what was
+    # read before it.
+    def _read(self):
+        messages = []
+        for _ in range(self.max_batch):
+            try:
+                data = self._sock.recv(send_msg.MAX_MESSAGE_SIZE)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as ex:
+                log.warning('Failed to read from socket: %s', ex)
+                break
+            messages.append(data.decode('utf8', errors='replace'))
+        if messages:
+            receive_batch(self._queue, messages)
+
+
+# A bound datagram socket for UDP or UNIXDGRAM. A socket file left behind
+# by an earlier run is removed first.
+def datagram_socket(proto, host, port, path):
+    if proto == 'UNIXDGRAM':
+        remove_socket_file(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((host, int(port)))
+    return sock
+
+
+def remove_socket_file(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+# Called by the directory watcher for files motion saves in its target_dir.
+# Queues the same message on_picture_save would have sent, without starting
+# a process for every picture. Other files (like lastsnap.jpg) are ignored.
+def file_saved(queue, filename):
+    message = 'saved {0}'.format(filename)
+    kind = cat_detector.parse(message).kind
+    if kind not in (MessageKinds.frame, MessageKinds.snapshot):
+        return
+    receive(queue, message)
+
+
+# Clients keep their connection open and send as many messages as they
+# like. Messages are framed (see send_msg.frame()) either by ending them with
+# a newline, or by a 4 byte big endian length in front. A client that sends
+# a single message without a newline and closes the connection (like
+# nc does) works with newline framing, too.
 class TCPServerProtocol(asyncio.Protocol):
 
-    def __init__(self, queue):
+    def __init__(self, queue, framing='newline'):
         self._queue = queue
+        self._framing = framing
+        self._buffer = bytearray()
 
     def connection_made(self, transport):
         self.transport = transport
 
     def data_received(self, data):
-        msgtime = datetime.now()
-        timestr = msgtime.strftime("%Y-%m-%d-%H:%M:%S:%f")
-        msg = data.decode('utf8')
-        print('{0}: received message {1}'.format(timestr, msg), flush=True)
-        self.transport.close()
-        self._queue.put_nowait(message)
+        self._buffer += data
+        try:
+            messages = self._messages()
+        except ValueError as ex:
+            log.warning('%s, closing connection', ex)
+            self._buffer.clear()
+            self.transport.close()
+            return
+        # A line that isn't valid utf8 becomes an unknown message, instead of
+        # taking the connection and the messages after it down with it.
+        for message in messages:
+            receive(self._queue, message.decode('utf8', errors='replace'))
 
+    def eof_received(self):
+        if self._framing == 'newline' and self._buffer.strip():
+            receive(self._queue, self._buffer.decode('utf8', errors='replace').strip())
+        self._buffer.clear()
+        return False
 
-async def motion_worker(queue, detector):
-    lastmsgtime = datetime.now()
+    # The complete messages in the buffer. What's left of the last one stays
+    # in the buffer until the rest of it comes in. Raises ValueError if a
+    # message is longer than send_msg.MAX_MESSAGE_SIZE.
+    def _messages(self):
+        messages = []
+        start = 0
+        if self._framing == 'length':
+            header = send_msg.LENGTH_PREFIX
+            while len(self._buffer) - start >= header.size:
+                length, = header.unpack_from(self._buffer, start)
+                if length > send_msg.MAX_MESSAGE_SIZE:
+                    raise ValueError('Message of {0} bytes is too long'.format(length))
+                end = start + header.size + length
+                if end > len(self._buffer):
+                    break
+                messages.append(bytes(self._buffer[start + header.size:end]))
+                start = end
+        else:
+            while True:
+                end = self._buffer.find(b'\n', start)
+                if end < 0:
+                    break
+                message = bytes(self._buffer[start:end]).strip()
+                if message:
+                    messages.append(message)
+                start = end + 1
+            if len(self._buffer) - start > send_msg.MAX_MESSAGE_SIZE:
+                raise ValueError('Message is too long')
+        del self._buffer[:start]
+        return messages
+
+
+# Finds the stream frame to use for a saved frame, so the frame doesn't have
+# to be read back from disk. Motion sends the motion message at the time
+# it sees the frame, and the save message only once the file is written, so
+# the stream frame closest to the motion message before it is the one. If
+# there was no recent motion message, the save message's own time is used.
+class StreamPairing(object):
+
+    def __init__(self, frames, max_skew=1.0):
+        self.frames = frames
+        self.max_skew = max_skew
+        self._last_motion = None
+
+    # Call this for every message, in order. Returns the jpeg for frames,
+    # None for anything else or if there is no stream frame close enough.
+    def jpeg_for(self, msg, received):
+        if msg.kind == MessageKinds.motion:
+            self._last_motion = received
+            return None
+        if msg.kind != MessageKinds.frame:
+            return None
+        when = received
+        if self._last_motion is not None and received - self._last_motion <= self.max_skew:
+            when = self._last_motion
+        return self.frames.closest(when, self.max_skew)
+
+
+# Wall clock time of a time.monotonic() receive time, going by clock (a
+# function returning the current datetime).
+def wallclock(received, clock=datetime.now):
+    return clock() - timedelta(seconds=time.monotonic() - received)
+
+
+# Writes what the detector did with each message to a journal.Journal.
+# A frame is written when it comes in, and again with its motion once
+# a motion message is paired with it (see CatDetector.last_evaluation).
+# clock is where the times in the journal come from.
+class JournalRecorder(object):
+
+    def __init__(self, journal, clock=datetime.now):
+        self.journal = journal
+        self.clock = clock
+        self._frame = None
+        self._frame_time = None
+        self._motion_time = None
+
+    def record(self, msg, received, detector, value):
+        if msg.kind == MessageKinds.snapshot:
+            self.journal.snapshot(wallclock(received, self.clock), msg.filename)
+            return
+        elif msg.kind == MessageKinds.frame:
+            self._frame = msg
+            self._frame_time = wallclock(received, self.clock)
+        elif msg.kind == MessageKinds.motion:
+            self._motion_time = wallclock(received, self.clock)
+        else:
+            return
+        evaluation = detector.last_evaluation
+        detector.last_evaluation = None
+        if evaluation is not None and self._frame_time is not None:
+            filename, motion, features = evaluation
+            frame = self._frame
+            if frame.filename != filename:
+                # Not the last frame that came in, which is what the detector
+                # looks at unless that one couldn't be loaded.
+                frame = cat_detector.parse(cat_detector.SAVED_PREFIX + filename)
+            motiontime = None if motion is None else self._motion_time
+            self.journal.frame(self._frame_time, frame, motion, motiontime, features, value)
+        elif msg.kind == MessageKinds.frame:
+            self.journal.frame(self._frame_time, msg, None, None, None, value)
+
+
+def make_executor(kind, workers):
+    if kind == 'thread':
+        return ThreadPoolExecutor(max_workers=workers)
+    elif kind == 'process':
+        return ProcessPoolExecutor(max_workers=workers)
+    return None
+
+
+# Works out which frame the detector will evaluate with which motion box,
+# going through the messages in the order it does: a frame goes with the
+# motion message before it, or if there wasn't one, with the next one.
+# decode_worker() uses this to find the lines on frames in the executor in
+# 'roi' mode. If the detector ends up pairing them differently (after a
+# reset(), say), it finds the lines itself.
+class MotionPairing(object):
+
+    def __init__(self):
+        self._motion = None
+        self._frame = None
+
+    # The motion box a frame goes with, if the motion message came first.
+    # Otherwise None, and the frame should be passed to frame_waiting().
+    def motion_for_frame(self):
+        motion = self._motion
+        self._motion = None
+        self._frame = None
+        return motion
+
+    # future is what the frame is being decoded by, if anything.
+    def frame_waiting(self, msg, future):
+        self._frame = (msg, future)
+
+    # The frame (message, future) a motion message goes with, if the frame
+    # came first.
+    def frame_for_motion(self, msg):
+        frame = self._frame
+        self._frame = None
+        if frame is None:
+            self._motion = msg.motion
+        return frame
+
+
+# The lines around a motion box on a frame that came before the motion
+# message, once the frame has been decoded (see decode_and_find_lines()).
+async def find_lines_later(executor, frame, future, motion, roi_margin):
+    image, _ = await future
+    if image is None:
+        return None, None
+    coords = await asyncio.get_running_loop().run_in_executor(
+            executor, cat_detector.roi_coords, image, motion, roi_margin)
+    return None, (frame.filename, motion, coords)
+
+
+# Takes messages off the queue and starts decoding the image for each of
+# them in the executor. The messages and their futures go into pending in
+# the order they came off the queue, so motion_worker sees the results in
+# that order even when several images are decoded at the same time.
+# The futures return (image, lines), see decode_and_find_lines().
+# Frames of events the detector has already decided on are not decoded;
+# if the detector changes its mind by the time it gets to them, it decodes
+# them itself.
+# With a stream, frames are decoded from the stream instead of from disk.
+# In 'roi' mode, the lines on a frame are found in the executor, too: along
+# with decoding it if the motion message came first, otherwise once the
+# motion message comes in.
+async def decode_worker(queue, pending, executor, detector, pairing=None):
+    loop = asyncio.get_running_loop()
+    motions = MotionPairing() if detector.feature_mode == 'roi' else None
     while True:
-        msg = await queue.get()
+        msg, priority, received = await queue.get()
         queue.task_done()
+        future = None
+        jpeg = None if pairing is None else pairing.jpeg_for(msg, received)
+        if msg.kind == MessageKinds.snapshot:
+            future = loop.run_in_executor(executor, cat_detector.decode_and_find_lines, msg)
+        elif msg.kind == MessageKinds.frame:
+            motion = None if motions is None else motions.motion_for_frame()
+            if detector.wants_frame(msg.event):
+                future = loop.run_in_executor(executor, cat_detector.decode_and_find_lines,
+                        msg, jpeg, motion, detector.roi_margin)
+            if motions is not None and motion is None:
+                motions.frame_waiting(msg, future)
+        elif msg.kind == MessageKinds.motion and motions is not None:
+            frame = motions.frame_for_motion(msg)
+            if frame is not None and frame[1] is not None:
+                future = asyncio.ensure_future(find_lines_later(
+                        executor, frame[0], frame[1], msg.motion, detector.roi_margin))
+        await pending.put((msg, priority, received, future))
+
+
+# Without an executor, messages are taken straight off the queue and
+# handle_message() does all the work on the event loop.
+# With an executor, messages come in via decode_worker(). Only the
+# decoding (and in 'roi' mode, finding the lines) happens in the executor,
+# the detector itself is only ever touched from here so its state machine
+# sees messages in order.
+# If latency is given, the time from receiving each message to having
+# processed it is recorded there.
+# If pairing (a StreamPairing) is given, frames come from motion's stream
+# when there is a stream frame to go with them. If recorder (a
+# JournalRecorder) is given, decisions are written to its journal.
+async def motion_worker(queue, detector, executor=None, max_pending=4, latency=None,
+                        pairing=None, recorder=None):
+    lastmsgtime = datetime.now()
+    pending = None
+    if executor is not None:
+        pending = asyncio.Queue(maxsize=max_pending)
+        asyncio.ensure_future(decode_worker(queue, pending, executor, detector, pairing))
+    while True:
+        image = None
+        lines = None
+        if pending is None:
+            msg, priority, received = await queue.get()
+            queue.task_done()
+            jpeg = None if pairing is None else pairing.jpeg_for(msg, received)
+            if jpeg is not None and detector.wants_frame(msg.event):
+                image = cat_detector.decode_image(jpeg)
+        else:
+            msg, priority, received, future = await pending.get()
+            pending.task_done()
+            try:
+                if future is not None:
+                    image, lines = await future
+            except Exception as ex:
+                log.error('Failed to decode image for %s because %s', msg.text, ex)
         msgtime = datetime.now()
-        timestr = msgtime.strftime("%Y-%m-%d-%H:%M:%S")
         if (msgtime - lastmsgtime).seconds > 300:
-            print("{0} time passed since last message, resetting cat detector".format(msgtime - lastmsgtime))
+            log.info('%s time passed since last message, resetting cat detector', msgtime - lastmsgtime)
             detector.reset()
         lastmsgtime = msgtime
         try:
-          value = detector.parse_message(msg)
-          print("{0}: {1}".format(timestr, value), flush=True)
+          value = detector.handle_message(msg, image, lines)
+          daemonlog.decision(value)
+          if recorder is not None:
+              recorder.record(msg, received, detector, value)
         except Exception as ex:
-          print('Failed to parse message {0} because {1}'.format(msg, ex), flush=True)
+          log.error('Failed to parse message %s because %s', msg.text, ex)
+        if latency is not None:
+            latency.add(priority, time.monotonic() - received)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser('start the cat flap daemon')
     parser.add_argument('--host', default='127.0.0.1', help='Where the catflap daemon runs')
     parser.add_argument('--port', default=3333, help='Port of the catflap daemon')
-    parser.add_argument('--proto', default='UDP', help='Protocol (TCP or UDP)')
-    parser.add_argument('--statmodel', default='./catflapmodel.knn', help='Statistical model to load')
+    # The unix socket protocols only work with motion on the same machine,
+    # but they skip the network stack. UNIX is a stream socket like TCP,
+    # UNIXDGRAM a datagram socket like UDP.
+    parser.add_argument('--proto', default='UDP', choices=send_msg.PROTOCOLS,
+            help='Protocol (TCP, UDP, UNIX or UNIXDGRAM)')
+    parser.add_argument('--socket', default=send_msg.DEFAULT_SOCKET,
+            help='Socket file for the UNIX and UNIXDGRAM protocols')
+    parser.add_argument('--intake', default='batched', choices=['batched', 'callback'],
+            help='Read all waiting datagrams at once, or one callback per datagram (UDP only)')
+    parser.add_argument('--framing', default='newline', choices=send_msg.FRAMINGS,
+            help='How messages are separated on TCP connections')
+    parser.add_argument('--statmodel', default='./catflapmodel.knn',
+            help='Statistical model to load (.knn, or .knnb made by convert_model.py)')
     # In opencv 4.0.0 there is no way that I can see to load a trained knn model in python.
     # But since the current model is pretty simple, we can just train it here.
     # Takes a lot less time than recompiling opencv on the pi.
     parser.add_argument('--labelfile', default=None, help='Training data for training model')
+    # With this, there's no need for on_picture_save in motion.conf. Motion
+    # messages still come in over the socket.
+    parser.add_argument('--watchdir', default=None,
+            help='Watch this directory (target_dir in motion.conf) for saved pictures')
+    # Frames are taken from motion's stream (stream_port in motion.conf)
+    # instead of being read back from the files motion saves. Save messages
+    # are still needed to know which event a frame belongs to.
+    parser.add_argument('--stream', default=None,
+            help='host:port of the motion stream to decode frames from')
+    parser.add_argument('--streamauth', default=None,
+            help='user:password for the stream (needs stream_auth_method 1)')
+    parser.add_argument('--streamskew', default=1.0, type=float,
+            help='Maximum seconds between a motion message and its stream frame')
+    parser.add_argument('--modelcache', default=cat_detector.DEFAULT_MODEL_CACHE,
+            help='Where to keep models trained from --labelfile')
+    parser.add_argument('--classifier', default='opencv', choices=['opencv', 'numpy'],
+            help='Which knn implementation to use (opencv predicts single frames faster, '
+                 'numpy loads .knnb models faster)')
+    parser.add_argument('--index', default='brute', choices=['brute', 'kdtree', 'balltree'],
+            help='Nearest neighbour index for the numpy classifier')
+    # Decode images off the event loop so bursts of messages from motion
+    # don't pile up in the socket buffers.
+    parser.add_argument('--executor', default='none', choices=['none', 'thread', 'process'],
+            help='Where to decode images (none means on the event loop)')
+    parser.add_argument('--workers', default=2, type=int, help='Size of the executor pool')
+    parser.add_argument('--features', default='motion', choices=['motion', 'roi'],
+            help='Use the motion box as features, or look for lines inside it (roi)')
+    parser.add_argument('--roimargin', default=20, type=int,
+            help='Pixels around the motion box to include in roi mode')
+    parser.add_argument('--history', default=32, type=int,
+            help='How many frames and motions of an event the detector keeps')
+    parser.add_argument('--queuesize', default=50, type=int,
+            help='Maximum number of waiting messages (0 for no limit)')
+    parser.add_argument('--overload', default='latest-wins',
+            choices=['latest-wins', 'drop-oldest', 'drop-new'],
+            help='What to drop when the message queue is full')
+    parser.add_argument('--journal', default=None,
+            help='Append a JSON line per frame and snapshot to this file (see journal.py)')
+    parser.add_argument('--statsinterval', default=300, type=int,
+            help='Seconds between reports of dropped messages and latency')
+    # Logging happens in a background thread, see daemonlog.py.
+    parser.add_argument('--loglevel', default='INFO', choices=daemonlog.LEVELS,
+            help='DEBUG adds what the detector found on each frame')
+    parser.add_argument('--logformat', default='text', choices=daemonlog.FORMATS,
+            help='text (what events_from_log.py reads) or json lines')
+    parser.add_argument('--logqueue', default=10000, type=int,
+            help='Log records that can wait to be written before new DEBUG and INFO ones are dropped')
+    parser.add_argument('--logeventqueue', default=100000, type=int,
+            help='Log records that can wait to be written before received messages, '
+                 'decisions, warnings and errors are dropped, too')
     args = parser.parse_args()
-    print('Starting cat flap daemon', flush=True)
+    if args.history < 1:
+        parser.error('--history must be at least 1')
+    daemonlog.start(args.loglevel, args.logformat, maxsize=args.logqueue,
+                    event_maxsize=args.logeventqueue)
+    log.info('Starting cat flap daemon')
     loop = asyncio.get_event_loop()
-    motion_queue = asyncio.Queue()
+    motion_queue = MessageQueue(args.queuesize, args.overload)
     if args.proto == 'TCP':
-        connect = loop.create_server(lambda: TCPServerProtocol(motion_queue),
+        connect = loop.create_server(lambda: TCPServerProtocol(motion_queue, args.framing),
                 args.host, args.port)
         server = loop.run_until_complete(connect)
+    elif args.proto == 'UNIX':
+        remove_socket_file(args.socket)
+        connect = loop.create_unix_server(lambda: TCPServerProtocol(motion_queue, args.framing),
+                args.socket)
+        server = loop.run_until_complete(connect)
+        log.info('Listening on %s', args.socket)
+    elif args.intake == 'batched' or args.proto == 'UNIXDGRAM':
+        server = DatagramReader(datagram_socket(args.proto, args.host, args.port, args.socket),
+                motion_queue, loop)
+        server.start()
+        log.info('Listening on %s', args.socket if args.proto == 'UNIXDGRAM' else args.port)
     else:
         connect = loop.create_datagram_endpoint(
                 lambda: UDPServerProtocol(motion_queue),
                 local_addr=(args.host, args.port))
-        print('Bringing up udp server ...', flush=True)
+        log.info('Bringing up udp server ...')
         server, _ = loop.run_until_complete(connect)
-        print('Listening on port %d' % args.port, flush=True)
+        log.info('Listening on port %s', args.port)
+    if args.watchdir is not None:
+        watcher = dirwatch.DirectoryWatcher(args.watchdir,
+                lambda filename: file_saved(motion_queue, filename), loop)
+        watcher.start()
+        log.info('Watching %s for saved pictures', args.watchdir)
+    pairing = None
+    if args.stream is not None:
+        stream_host, _, stream_port = args.stream.rpartition(':')
+        frames = mjpeg.StreamFrames()
+        pairing = StreamPairing(frames, args.streamskew)
+        stream_task = asyncio.ensure_future(mjpeg.stream_worker(stream_host or '127.0.0.1',
+            int(stream_port), frames, auth=args.streamauth))
+        log.info('Reading frames from stream at %s', args.stream)
     cat_detector.CatDetector.setupCatDetector(modelfile=args.statmodel,
-        trainingfile=args.labelfile)
-    detector = cat_detector.CatDetector.makeCatDetector()
-    print('made a cat detector', flush=True)
-    task = asyncio.ensure_future(motion_worker(motion_queue, detector))
+        trainingfile=args.labelfile, classifier=args.classifier, index=args.index,
+        cachedir=args.modelcache)
+    detector = cat_detector.CatDetector.makeCatDetector(args.history)
+    detector.feature_mode = args.features
+    detector.roi_margin = args.roimargin
+    log.info('made a cat detector')
+    executor = make_executor(args.executor, args.workers)
+    latency = LatencyStats()
+    recorder = None
+    if args.journal is not None:
+        recorder = JournalRecorder(journal.Journal(args.journal))
+        log.info('Writing journal to %s', args.journal)
+    task = asyncio.ensure_future(motion_worker(motion_queue, detector, executor,
+        max_pending=2 * args.workers, latency=latency, pairing=pairing, recorder=recorder))
+    stats_task = asyncio.ensure_future(stats_worker(motion_queue, latency, args.statsinterval))
     # Alternative, less low-level.
     # task = loop.create_task(motion_worker(motion_queue, detector))
-    loop.run_forever()
+    try:
+        loop.run_forever()
+    finally:
+        if recorder is not None:
+            recorder.journal.close()
+        daemonlog.stop()
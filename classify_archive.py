@@ -0,0 +1,148 @@
+# Classifies every frame in the image directory (or the days from --first
+# to --last) the way the p key in listImages.py does: find the lines on the
+# image with CatDetector.get_coords() and ask the model what they are. The
+# frames are spread over a pool of processes, one per core, and the results
+# are saved as columns in a numpy .npz file (load it with np.load()):
+#
+#   filename, day, event, idx: which frame.
+#   left, right, top, bottom: the features, nan if no lines were found.
+#   label: what the model says (see Trainer.string_for_label()), 0 if no
+#     lines were found, -1 if the file couldn't be read.
+#   event_day, event_id, event_frames, event_decision: one row per event,
+#     with the label the detector would have settled on going through the
+#     event's frames in order.
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import numpy as np
+import os
+import time
+
+import cat_detector
+import catalog
+import featurestore
+from cat_detector import CatDetector
+from trainer import Trainer
+
+# Frames per task handed to a worker.
+CHUNKSIZE = 64
+
+
+# All the frames in imagedir taken on days first to last (dates, either can
+# be None), as (day, event, idx, filename) in the order they were taken.
+def list_frames(imagedir, first=None, last=None):
+    frames = []
+    with os.scandir(imagedir) as entries:
+        for entry in entries:
+            parts = catalog.split_filename(entry.name)
+            if parts is None or parts[2] == 'snapshot':
+                continue
+            event, taken, idx = parts
+            day = catalog.day_of(taken)
+            if first is not None and day < first.isoformat():
+                continue
+            if last is not None and day > last.isoformat():
+                continue
+            frames.append((day, event, taken, int(idx), entry.name))
+    frames.sort()
+    return [(day, event, idx, name) for day, event, taken, idx, name in frames]
+
+
+def setup_worker(modelfile):
+    featurestore.setup_worker()
+    CatDetector.setupCatDetector(modelfile, None)
+
+
+# Features and labels for a list of files, with all the frames that have
+# features classified in one go.
+def classify_files(filenames):
+    features, readable = featurestore.extract_features(filenames)
+    labels = np.zeros(len(filenames), dtype=np.int8)
+    labels[~readable] = -1
+    found = ~np.isnan(features[:, 0])
+    if found.any():
+        _, results = CatDetector.statModel.predict(features[found])
+        labels[found] = np.asarray(results).reshape(-1)
+    return features, labels
+
+
+# The label the detector ends up with for an event whose frames got these
+# labels: a cat arriving decides it, so do no cat and a cat leaving; if it's
+# not sure, or the frame couldn't be read (-1), it looks at the next frame.
+def event_decision(labels):
+    for label in labels:
+        if label in (0, 2, 3):
+            return label
+    return 1
+
+
+def classify_archive(imagedir, modelfile, first=None, last=None, workers=None,
+        chunksize=CHUNKSIZE):
+    frames = list_frames(imagedir, first, last)
+    filenames = [os.path.join(imagedir, f[3]) for f in frames]
+    chunks = [filenames[i:i + chunksize] for i in range(0, len(filenames), chunksize)]
+    features = np.empty((0, 4), dtype=np.float32)
+    labels = np.empty(0, dtype=np.int8)
+    if chunks:
+        with ProcessPoolExecutor(max_workers=workers, initializer=setup_worker,
+                                 initargs=(modelfile,)) as executor:
+            results = list(executor.map(classify_files, chunks))
+        features = np.concatenate([r[0] for r in results])
+        labels = np.concatenate([r[1] for r in results])
+    columns = {
+        'filename': np.array([f[3] for f in frames], dtype=str),
+        'day': np.array([f[0] for f in frames], dtype=str),
+        'event': np.array([f[1] for f in frames], dtype=np.int32),
+        'idx': np.array([f[2] for f in frames], dtype=np.int32),
+        'left': features[:, 0],
+        'right': features[:, 1],
+        'top': features[:, 2],
+        'bottom': features[:, 3],
+        'label': labels,
+    }
+    events = {}
+    for (day, event, _, _), label in zip(frames, labels):
+        events.setdefault((day, event), []).append(label)
+    columns['event_day'] = np.array([k[0] for k in events], dtype=str)
+    columns['event_id'] = np.array([k[1] for k in events], dtype=np.int32)
+    columns['event_frames'] = np.array([len(v) for v in events.values()], dtype=np.int32)
+    columns['event_decision'] = np.array([event_decision(v) for v in events.values()],
+                                         dtype=np.int8)
+    return columns
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('classify all the frames in the image directory')
+    parser.add_argument('--images', default='./images/', help='Where your image files are')
+    parser.add_argument('--first', default=None, help='First day to classify (YYYY-MM-DD)')
+    parser.add_argument('--last', default=None, help='Last day to classify (YYYY-MM-DD)')
+    parser.add_argument('--modelfile', default=None, help='File to load model from')
+    parser.add_argument('--trainingfile', default=None,
+            help='Label file to train a model from if there is no --modelfile')
+    parser.add_argument('--output', default='./classified.npz', help='Where to save the results')
+    parser.add_argument('--workers', type=int, default=None,
+            help='How many processes to use (default: one per core)')
+    parser.add_argument('--chunksize', type=int, default=CHUNKSIZE,
+            help='How many frames to hand to a process at a time')
+    args = parser.parse_args()
+    modelfile = args.modelfile
+    if modelfile is None:
+        if args.trainingfile is None:
+            parser.error('need a --modelfile or a --trainingfile')
+        # Trained once here, the workers load it from the cache.
+        modelfile = cat_detector.trained_model(args.trainingfile,
+                                               cat_detector.DEFAULT_MODEL_CACHE)
+    first = None if args.first is None else datetime.strptime(args.first, '%Y-%m-%d').date()
+    last = None if args.last is None else datetime.strptime(args.last, '%Y-%m-%d').date()
+    start = time.perf_counter()
+    columns = classify_archive(args.images, modelfile, first, last, args.workers, args.chunksize)
+    elapsed = time.perf_counter() - start
+    np.savez(args.output, **columns)
+    count = len(columns['filename'])
+    print('classified %d frames in %d events in %.1fs (%.1f frames/s)' % (
+        count, len(columns['event_id']), elapsed, count / elapsed if elapsed else 0.0))
+    for label in range(4):
+        print('%s: %d frames, %d events' % (Trainer.string_for_label(label),
+            np.count_nonzero(columns['label'] == label),
+            np.count_nonzero(columns['event_decision'] == label)))
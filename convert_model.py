@@ -0,0 +1,16 @@
+# Convert a knn model saved by opencv (.knn, yaml) to the binary format
+# that the cat flap daemon can memory map (.knnb, see knn.py).
+
+import argparse
+import knn
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('convert knn model to binary format')
+    parser.add_argument('--input', default='./catflapmodel.knn', help='Model saved by opencv')
+    parser.add_argument('--output', default=None, help='Binary model file (default: input with .knnb suffix)')
+    args = parser.parse_args()
+    output = args.output
+    if output is None:
+        output = args.input.rsplit('.', 1)[0] + '.knnb'
+    model = knn.convert_opencv_model(args.input, output)
+    print('wrote {0} samples with k={1} to {2}'.format(len(model.samples), model.k, output))
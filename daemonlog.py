@@ -0,0 +1,200 @@
+# Logging for the daemon and the cat detector. A log call only appends the
+# record to a bounded buffer; a background thread formats whatever has
+# piled up every interval seconds and writes it out in one go, so a slow SD
+# card doesn't hold up the event loop and isn't flushed once per line. If
+# the writer falls behind and the buffer fills up, new DEBUG and INFO
+# records are dropped (and counted) rather than making the caller wait.
+# Received messages and decisions are what events_from_log.py replays
+# events from, so they (and warnings and errors) have a bound of their own,
+# a lot larger than that; they are only dropped (and counted separately)
+# if the writer can't write anything for a long time, like when the SD
+# card stalls.
+#
+# There are two formats:
+#   text: the lines the daemon has always printed, which is what
+#     events_from_log.py reads. Received messages and decisions are
+#     prefixed with the time, everything else is written as it is.
+#   json: one object per line with time, level, kind and message.
+# kind is 'received' for incoming messages, 'decision' for what the
+# detector made of them and 'log' for anything else.
+#
+# Per-frame detail is logged at DEBUG level, which is off unless the daemon
+# runs with --loglevel DEBUG. Arguments are only formatted into the message
+# by the writer, so a call below the log level costs next to nothing.
+# Until start() is called, warnings and errors go straight to stderr and
+# everything else is dropped.
+
+from collections import deque
+from datetime import datetime
+import json
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {'DEBUG': DEBUG, 'INFO': INFO, 'WARNING': WARNING, 'ERROR': ERROR}
+LEVEL_NAMES = {level: name for name, level in LEVELS.items()}
+FORMATS = ('text', 'json')
+
+
+def _message(msg, args):
+    if not args:
+        return msg
+    try:
+        return msg % args
+    except (TypeError, ValueError):
+        return '{0} {1}'.format(msg, args)
+
+
+def format_text(record):
+    created, level, kind, msg, args = record
+    message = _message(msg, args)
+    if kind == 'received':
+        timestr = datetime.fromtimestamp(created).strftime("%Y-%m-%d-%H:%M:%S:%f")
+        return '{0}: received message {1}'.format(timestr, message)
+    elif kind == 'decision':
+        timestr = datetime.fromtimestamp(created).strftime("%Y-%m-%d-%H:%M:%S")
+        return '{0}: {1}'.format(timestr, message)
+    return message
+
+
+def format_json(record):
+    created, level, kind, msg, args = record
+    return json.dumps({
+        'time': datetime.fromtimestamp(created).isoformat(),
+        'level': LEVEL_NAMES.get(level, str(level)),
+        'kind': kind,
+        'message': _message(msg, args),
+    })
+
+
+class Logger(object):
+
+    def __init__(self):
+        self.level = INFO
+        self.maxsize = 0
+        self.event_maxsize = 0
+        self.dropped = 0
+        self.dropped_events = 0
+        self._records = None
+
+    def isEnabledFor(self, level):
+        return level >= self.level
+
+    def log(self, level, kind, msg, args=()):
+        if level < self.level:
+            return
+        records = self._records
+        if records is None:
+            if level >= WARNING:
+                sys.stderr.write(format_text((time.time(), level, kind, msg, args)) + '\n')
+            return
+        if kind == 'log' and level < WARNING:
+            if len(records) >= self.maxsize:
+                self.dropped += 1
+                return
+        elif len(records) >= self.event_maxsize:
+            self.dropped_events += 1
+            return
+        records.append((time.time(), level, kind, msg, args))
+
+    def debug(self, msg, *args):
+        self.log(DEBUG, 'log', msg, args)
+
+    def info(self, msg, *args):
+        self.log(INFO, 'log', msg, args)
+
+    def warning(self, msg, *args):
+        self.log(WARNING, 'log', msg, args)
+
+    def error(self, msg, *args):
+        self.log(ERROR, 'log', msg, args)
+
+
+log = Logger()
+
+
+def received(message):
+    log.log(INFO, 'received', message)
+
+
+def decision(value):
+    log.log(INFO, 'decision', '%s', (value,))
+
+
+# Every interval seconds, formats and writes out the records that have been
+# appended to records (a deque) since. journal.Journal uses it, too.
+class Writer(threading.Thread):
+
+    def __init__(self, records, stream, formatter, interval, name='daemonlog'):
+        super().__init__(name=name, daemon=True)
+        self._records = records
+        self._stream = stream
+        self._formatter = formatter
+        self._interval = interval
+        self._stopping = threading.Event()
+
+    def run(self):
+        while not self._stopping.wait(self._interval):
+            self.write()
+        self.write()
+
+    def stop(self):
+        self._stopping.set()
+        self.join()
+
+    def write(self):
+        lines = []
+        while self._records:
+            lines.append(self._formatter(self._records.popleft()))
+        if lines:
+            lines.append('')
+            self._stream.write('\n'.join(lines))
+            self._stream.flush()
+
+
+_writer = None
+
+
+# Writes everything logged from now on to stream (stdout by default), until
+# stop() is called. At most maxsize records wait to be written, or
+# event_maxsize counting received messages, decisions, warnings and errors.
+def start(level='INFO', format='text', stream=None, maxsize=10000, event_maxsize=100000,
+          interval=0.05):
+    global _writer
+    stop()
+    records = deque()
+    formatter = format_json if format == 'json' else format_text
+    _writer = Writer(records, sys.stdout if stream is None else stream, formatter, interval)
+    log.level = LEVELS[level]
+    log.maxsize = maxsize
+    log.event_maxsize = max(maxsize, event_maxsize)
+    log.dropped = 0
+    log.dropped_events = 0
+    log._records = records
+    _writer.start()
+
+
+# Writes out whatever is still waiting and goes back to not logging.
+def stop():
+    global _writer
+    if _writer is not None:
+        _writer.stop()
+        log._records = None
+        _writer.write()
+        _writer = None
+
+
+# How many DEBUG and INFO records were dropped because too many were
+# waiting.
+def dropped():
+    return log.dropped
+
+
+# How many received messages, decisions, warnings and errors were dropped
+# because event_maxsize records were waiting.
+def dropped_events():
+    return log.dropped_events
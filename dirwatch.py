@@ -0,0 +1,85 @@
+# Watch a directory for new files with inotify, from an asyncio event loop.
+# Linux only, but that's what the Pi runs. Uses ctypes so there is nothing
+# extra to install.
+
+import asyncio
+import ctypes
+import ctypes.util
+from daemonlog import log
+import os
+import struct
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# struct inotify_event: wd, mask, cookie, len, followed by len bytes of
+# zero padded name.
+EVENT_HEADER = struct.Struct('iIII')
+
+_libc = None
+
+
+def _inotify():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not available on this system')
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        _libc = libc
+    return _libc
+
+
+# Calls callback(path) for every file that is finished being written to (or
+# moved into) the directory. Files are reported once they are closed, so
+# they can be read straight away.
+class DirectoryWatcher(object):
+
+    def __init__(self, path, callback, loop=None):
+        self.path = path
+        self._callback = callback
+        self._loop = loop
+        self._fd = None
+
+    def start(self):
+        libc = _inotify()
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        wd = libc.inotify_add_watch(fd, os.fsencode(self.path), IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, os.strerror(errno), self.path)
+        self._fd = fd
+        self._loop.add_reader(fd, self._read)
+
+    def close(self):
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+
+    def _read(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                log.warning('inotify queue overflowed, some files were missed')
+                continue
+            if name:
+                self._callback(os.path.join(self.path, os.fsdecode(name)))
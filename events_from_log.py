@@ -1,5 +1,11 @@
+from concurrent.futures import ProcessPoolExecutor
 import datetime
+import gzip
+import hashlib
+import json
+import os
 import re
+import tempfile
 
 DEFAULT_IMAGE_PATH='/home/pi/pictures'
 
@@ -137,3 +143,232 @@ def daemonlog_events_for_date(daemonlogfile, date_to_show):
     return events, snapshots
 
 
+
+
+# Opens a daemon log for reading, decompressing it if it's a .gz file.
+def open_log(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rt', errors='replace')
+    return open(filename, errors='replace')
+
+
+# Reads a whole log file once and returns {date: (events, snapshots)} for
+# every date it has (or only for the dates in dates, if given). The log is
+# in time order, so only the lines of one day are kept in memory at a time.
+def daemonlog_events_by_date(filename, dates=None):
+    results = {}
+    day = None
+    lines = []
+
+    def finish():
+        if day is not None and (dates is None or day in dates):
+            results[day] = daemonlog_events_for_date(lines, day)
+
+    with open_log(filename) as logfile:
+        for line in logfile:
+            if line[4:5] == '-' and line[7:8] == '-' and line[10:11] == '-':
+                try:
+                    linedate = datetime.date(int(line[:4]), int(line[5:7]), int(line[8:10]))
+                except ValueError:
+                    linedate = day
+                if linedate != day:
+                    finish()
+                    day = linedate
+                    lines = []
+            lines.append(line)
+    finish()
+    return results
+
+
+# Adds the (events, snapshots) of one day from another file to merged.
+def merge_events(merged, events, snapshots):
+    merged_events, merged_snapshots = merged
+    for event_id, frames in events.items():
+        merged_frames = merged_events.setdefault(event_id, [])
+        merged_frames.extend(frames)
+        merged_frames.sort(key=eventkey)
+    merged_snapshots.update(snapshots)
+
+
+# Reads several daemon logs (like daemonlog, daemonlog.1,
+# daemonlog.2.gz ...), one per worker process, and returns
+# {date: (events, snapshots)} with the days that are in more than one file
+# merged. An event that was split by log rotation has its motion messages
+# paired within each file only.
+def daemonlog_events(filenames, dates=None, workers=None):
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for by_date in executor.map(daemonlog_events_by_date, filenames,
+                                    [dates] * len(filenames)):
+            for day, (events, snapshots) in by_date.items():
+                merge_events(results.setdefault(day, ({}, {})), events, snapshots)
+    return results
+
+
+# Identifies the first size bytes of a log file: which file it is (device
+# and inode) and a hash of the bytes just before size. Every daemon log
+# starts with the same lines, so the start of a log doesn't tell a rotated
+# one from the old one, but if the bytes before size are different or it's
+# another file, it has been rotated or rewritten.
+def log_identity(logfilename, size, check_size=256):
+    stat = os.stat(logfilename)
+    with open(logfilename, 'rb') as logfile:
+        start = max(0, size - check_size)
+        logfile.seek(start)
+        digest = hashlib.sha1(logfile.read(size - start)).hexdigest()
+    return '{0}:{1}:{2}'.format(stat.st_dev, stat.st_ino, digest)
+
+
+# A sidecar index for a daemon log (saved next to it as <log>.idx) that
+# maps each date, and each event of a date, to the range of bytes in the log
+# that has its lines, so reading one day doesn't mean reading the whole log.
+# update() only reads what was appended to the log since the index was last
+# saved; if the log was rotated or truncated, the index is rebuilt.
+#
+# An event's range starts after the last save message of the event before
+# it (so it includes the motion message that comes before the first save)
+# and ends where the next event starts.
+class DaemonLogIndex(object):
+    version = 2
+    marker = b' received message '
+
+    def __init__(self, logfilename, indexfilename=None):
+        self.logfilename = logfilename
+        self.indexfilename = indexfilename or logfilename + '.idx'
+        self._reset()
+        try:
+            with open(self.indexfilename) as indexfile:
+                saved = json.load(indexfile)
+            if saved.get('version') == self.version:
+                self._state = saved
+        except (OSError, ValueError):
+            pass
+
+    def _reset(self):
+        self._state = {
+            'version': self.version,
+            # How much of the log is indexed, and its log_identity(), to
+            # tell if it has been replaced since.
+            'size': 0,
+            'identity': None,
+            'dates': {},
+            'events': {},
+            # The event the last save message was for, and where its last
+            # save message ended.
+            'current': None,
+            'boundary': 0,
+        }
+
+    # Brings the index up to date with the log and saves it. Returns self.
+    def update(self):
+        state = self._state
+        size = os.path.getsize(self.logfilename)
+        if size < state['size'] or log_identity(self.logfilename, state['size']) != state['identity']:
+            self._reset()
+            state = self._state
+        if size == state['size']:
+            return self
+        with open(self.logfilename, 'rb') as logfile:
+            logfile.seek(state['size'])
+            offset = state['size']
+            for line in logfile:
+                if not line.endswith(b'\n'):
+                    # Still being written, leave it for next time.
+                    break
+                end = offset + len(line)
+                self._add_line(line, offset, end)
+                offset = end
+            state['size'] = offset
+        state['identity'] = log_identity(self.logfilename, offset)
+        self._save()
+        return self
+
+    def _add_line(self, line, start, end):
+        state = self._state
+        current = state['current']
+        if current is not None:
+            state['events'][current[0]][current[1]][1] = end
+        pos = line.find(self.marker)
+        if pos < 0 or line[4:5] != b'-' or line[7:8] != b'-':
+            return
+        date = line[:10].decode('ascii')
+        if date in state['dates']:
+            state['dates'][date][1] = end
+        else:
+            state['dates'][date] = [start, end]
+        message = line[pos + len(self.marker):].strip()
+        if not message.startswith(b'saved ') or message.endswith(b'-snapshot.jpg'):
+            return
+        event_id = message.split(b'/')[-1].split(b'-')[0].decode('ascii', 'replace')
+        if current is None or current[1] != event_id:
+            state['events'].setdefault(date, {})[event_id] = [state['boundary'], end]
+            state['current'] = [date, event_id]
+        state['boundary'] = end
+
+    def _save(self):
+        directory = os.path.dirname(os.path.abspath(self.indexfilename))
+        try:
+            fd, tmpname = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as tmpfile:
+                json.dump(self._state, tmpfile)
+            os.replace(tmpname, self.indexfilename)
+        except OSError:
+            # The index still works, it just has to be rebuilt next time.
+            pass
+
+    def dates(self):
+        return set(self._state['dates'])
+
+    # {date string: [start, end]} byte ranges.
+    def date_ranges(self):
+        return {day: tuple(byterange) for day, byterange in self._state['dates'].items()}
+
+    def events(self, datestr):
+        return sorted(self._state['events'].get(datestr, {}))
+
+    def _lines(self, byterange):
+        start, end = byterange
+        with open(self.logfilename, 'rb') as logfile:
+            logfile.seek(start)
+            data = logfile.read(end - start)
+        return data.decode('utf8', 'replace').splitlines(True)
+
+    # The lines of the log for a date, or for one event of that date.
+    def lines_for_date(self, datestr):
+        if datestr not in self._state['dates']:
+            return []
+        return self._lines(self._state['dates'][datestr])
+
+    def lines_for_event(self, datestr, event_id):
+        event = self._state['events'].get(datestr, {}).get(str(event_id))
+        if event is None:
+            return []
+        return self._lines(event)
+
+
+# Same as daemonlog_datelist() and daemonlog_events_for_date(), but for a
+# log file name, using (and updating) its index.
+def indexed_datelist(logfilename):
+    return DaemonLogIndex(logfilename).update().dates()
+
+
+def indexed_events_for_date(logfilename, date_to_show):
+    index = DaemonLogIndex(logfilename).update()
+    return daemonlog_events_for_date(index.lines_for_date(date_to_show.strftime('%Y-%m-%d')),
+                                     date_to_show)
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    parser = argparse.ArgumentParser('read daemon logs')
+    parser.add_argument('logs', nargs='+', help='Daemon logs, plain or .gz')
+    parser.add_argument('--workers', default=None, type=int, help='Number of processes')
+    args = parser.parse_args()
+    start = time.perf_counter()
+    results = daemonlog_events(args.logs, workers=args.workers)
+    elapsed = time.perf_counter() - start
+    for day, (events, snapshots) in sorted(results.items()):
+        print('{0}: {1} events, {2} frames, {3} snapshots'.format(day, len(events),
+              sum(len(frames) for frames in events.values()), len(snapshots)))
+    print('read {0} logs in {1:.2f}s'.format(len(args.logs), elapsed))
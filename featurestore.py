@@ -0,0 +1,179 @@
+# Features (what CatDetector.get_coords() finds) for every frame in the
+# image directory, worked out once and kept in a file, so trying out a
+# model on other frames or labels doesn't mean decoding images again.
+#
+# The file is a header followed by one fixed size record per frame, which
+# is used straight from a memory mapped file:
+#   header: magic, format version, CatDetector.feature_version, rows
+#   records: file name (without the directory), mtime of the file in ns,
+#     the features (float32, nan if no lines were found)
+# update() only looks at frames that are new or changed since they were
+# stored, and drops the ones that are gone; if get_coords() has changed
+# (see CatDetector.feature_version), everything is computed again.
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+import os
+import struct
+import time
+
+import cat_detector
+import catalog
+from daemonlog import log
+import knn
+from cat_detector import CatDetector
+
+STORE_MAGIC = b'catfeat\0'
+STORE_VERSION = 1
+STORE_HEADER = struct.Struct('<8sIII')
+RECORD = np.dtype([('filename', 'S32'), ('mtime', '<i8'),
+                   ('features', '<f4', (len(knn.FEATURES),))])
+DEFAULT_STORE = './features.bin'
+
+# Frames per task handed to a worker.
+CHUNKSIZE = 64
+
+
+def setup_worker():
+    # The processes are what runs in parallel, so opencv shouldn't start
+    # threads of its own in each of them.
+    cv2.setNumThreads(1)
+
+
+# Features for a list of files as a rows x 4 array, nan where no lines were
+# found or the file couldn't be read, and which of the files could be read.
+def extract_features(filenames):
+    detector = CatDetector(None)
+    features = np.full((len(filenames), len(knn.FEATURES)), np.nan, dtype=np.float32)
+    readable = np.zeros(len(filenames), dtype=bool)
+    for i, filename in enumerate(filenames):
+        img = cat_detector.read_image(filename, reduction=1)
+        if img is None:
+            continue
+        readable[i] = True
+        coords = detector.get_coords(img)
+        if coords is not None:
+            features[i] = coords
+    return features, readable
+
+
+class FeatureStore(object):
+
+    def __init__(self, filename=DEFAULT_STORE):
+        self.filename = filename
+        self._records = np.zeros(0, dtype=RECORD)
+        try:
+            self._records = self._load()
+        except (OSError, ValueError):
+            pass
+        self._index = {name.decode('ascii'): i
+                       for i, name in enumerate(self._records['filename'])}
+
+    def _load(self):
+        data = np.memmap(self.filename, dtype=np.uint8, mode='r')
+        if len(data) < STORE_HEADER.size:
+            raise ValueError('{0} is not a feature store'.format(self.filename))
+        magic, version, feature_version, rows = STORE_HEADER.unpack_from(data)
+        if magic != STORE_MAGIC or version != STORE_VERSION:
+            raise ValueError('{0} is not a feature store'.format(self.filename))
+        if feature_version != CatDetector.feature_version:
+            # Made by another get_coords(), start over.
+            return np.zeros(0, dtype=RECORD)
+        records = data[STORE_HEADER.size:].view(RECORD)
+        if len(records) != rows:
+            raise ValueError('{0} is truncated'.format(self.filename))
+        return records
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, filename):
+        return os.path.basename(filename) in self._index
+
+    # The features for a frame (with or without the directory), or None if
+    # the store doesn't have it or no lines were found on it.
+    def features_for(self, filename):
+        i = self._index.get(os.path.basename(filename))
+        if i is None:
+            return None
+        features = self._records['features'][i]
+        if np.isnan(features[0]):
+            return None
+        return features
+
+    # Works out the features for the frames in imagedir that are new or have
+    # changed, using a pool of processes, drops the frames that are gone
+    # and saves the store. Frames that can't be read are left out, so they
+    # are tried again next time. Returns the number of frames that were
+    # looked at.
+    def update(self, imagedir, workers=None, chunksize=CHUNKSIZE):
+        names = []
+        mtimes = []
+        present = set()
+        with os.scandir(imagedir) as entries:
+            for entry in entries:
+                parts = catalog.split_filename(entry.name)
+                if parts is None or parts[2] == 'snapshot':
+                    continue
+                if len(entry.name) > RECORD['filename'].itemsize:
+                    log.warning('file name %s is too long for the feature store, skipping it',
+                                entry.name)
+                    continue
+                present.add(entry.name)
+                mtime = entry.stat().st_mtime_ns
+                i = self._index.get(entry.name)
+                if i is not None and self._records['mtime'][i] == mtime:
+                    continue
+                names.append(entry.name)
+                mtimes.append(mtime)
+        gone = [i for name, i in self._index.items() if name not in present]
+        if not names and not gone:
+            return 0
+        features = np.empty((0, len(knn.FEATURES)), dtype=np.float32)
+        readable = np.empty(0, dtype=bool)
+        if names:
+            filenames = [os.path.join(imagedir, name) for name in names]
+            chunks = [filenames[i:i + chunksize] for i in range(0, len(filenames), chunksize)]
+            with ProcessPoolExecutor(max_workers=workers, initializer=setup_worker) as executor:
+                results = list(executor.map(extract_features, chunks))
+            features = np.concatenate([r[0] for r in results])
+            readable = np.concatenate([r[1] for r in results])
+        added = np.zeros(len(names), dtype=RECORD)
+        added['filename'] = [name.encode('ascii') for name in names]
+        added['mtime'] = mtimes
+        added['features'] = features
+        replaced = [self._index[name] for name in names if name in self._index]
+        kept = np.delete(np.asarray(self._records), replaced + gone)
+        records = np.concatenate([kept, added[readable]])
+        records.sort(order='filename')
+        self._save(records)
+        self._records = records
+        self._index = {name.decode('ascii'): i
+                       for i, name in enumerate(records['filename'])}
+        return len(names)
+
+    def _save(self, records):
+        # Write to a temporary file first so readers never see half a store.
+        tmpfile = '{0}.{1}.tmp'.format(self.filename, os.getpid())
+        with open(tmpfile, 'wb') as f:
+            f.write(STORE_HEADER.pack(STORE_MAGIC, STORE_VERSION,
+                CatDetector.feature_version, len(records)))
+            f.write(records.tobytes())
+        os.replace(tmpfile, self.filename)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('work out the features of all the frames in the image directory')
+    parser.add_argument('--images', default='./images/', help='Where your image files are')
+    parser.add_argument('--store', default=DEFAULT_STORE, help='The feature store to update')
+    parser.add_argument('--workers', type=int, default=None,
+            help='How many processes to use (default: one per core)')
+    args = parser.parse_args()
+    store = FeatureStore(args.store)
+    start = time.perf_counter()
+    count = store.update(args.images, args.workers)
+    elapsed = time.perf_counter() - start
+    print('computed features for %d frames in %.1fs, %d frames in %s' % (
+        count, elapsed, len(store), args.store))
@@ -0,0 +1,118 @@
+# The daemon's event journal: one JSON object per line, appended as the
+# daemon goes. Unlike the daemon log, which only has the messages as they
+# came in, every frame record says which motion the detector paired it with,
+# what features it worked out and what it decided, so nothing has to be
+# guessed when reading it back.
+#
+# Frame records:
+#   {"kind": "frame", "time": receive time of the save message,
+#    "event": event id, "index": frame index (null if it isn't a number),
+#    "filename": ...,
+#    "motion": [pxcount, width, height, x, y] or null,
+#    "motiontime": receive time of the motion message or null,
+#    "features": [left, right, top, bottom] or null, "decision": ...}
+# Snapshot records:
+#   {"kind": "snapshot", "time": receive time, "filename": ...}
+# Times are ISO 8601 local time. A frame is written again once a motion
+# message is paired with it; the later record wins.
+
+from collections import deque
+from datetime import datetime
+import json
+
+import daemonlog
+import events_from_log
+
+
+class Journal(object):
+
+    # Records are written by a thread of their own every interval seconds,
+    # so the daemon never waits for the disk. Unlike log records, none are
+    # ever dropped.
+    def __init__(self, filename, interval=0.05):
+        self.filename = filename
+        self._file = open(filename, 'a')
+        self._records = deque()
+        self._writer = daemonlog.Writer(self._records, self._file, json.dumps, interval,
+                                        name='journal')
+        self._writer.start()
+
+    # message is the frame's message as cat_detector.parse() returned it.
+    def frame(self, received, message, motion, motiontime, features, decision):
+        self._write({
+            'kind': 'frame',
+            'time': received.isoformat(),
+            'event': message.event,
+            'index': message.index,
+            'filename': message.filename,
+            'motion': None if motion is None else [int(m) for m in motion],
+            'motiontime': None if motiontime is None else motiontime.isoformat(),
+            'features': None if features is None else [float(f) for f in features],
+            'decision': decision,
+        })
+
+    def snapshot(self, received, filename):
+        self._write({'kind': 'snapshot', 'time': received.isoformat(), 'filename': filename})
+
+    def _write(self, record):
+        self._records.append(record)
+
+    # Writes out whatever is still waiting.
+    def close(self):
+        self._writer.stop()
+        self._file.close()
+
+
+# All the days the journal has records for, as 'YYYY-MM-DD' strings.
+def journal_datelist(journalfile):
+    dates = set()
+    for line in journalfile:
+        if line.startswith('{'):
+            dates.add(json.loads(line)['time'][:10])
+    return dates
+
+
+def _timeofday(isotime):
+    # The way events_from_log writes it, which is what hms_to_seconds()
+    # expects.
+    return datetime.fromisoformat(isotime).strftime('%H:%M:%S:%f:')
+
+
+# Reads a journal (an open file) and returns (events, snapshots) for one
+# day in the same form as events_from_log.daemonlog_events_for_date(), with
+# the features and decision added to each frame.
+def journal_events_for_date(journalfile, date_to_show):
+    datestr = date_to_show.isoformat()
+    frames = {}
+    snapshots = {}
+    for line in journalfile:
+        if not line.startswith('{'):
+            continue
+        record = json.loads(line)
+        if not record['time'].startswith(datestr):
+            continue
+        if record['kind'] == 'snapshot':
+            snapshot = events_from_log.make_snapshot_entry(record['filename'][:-len('-snapshot.jpg')])
+            snapshots[snapshot['basetime']] = snapshot
+            continue
+        basename = record['filename'].split('/')[-1]
+        entry = {
+            'id': str(record['event']),
+            'datetime': basename.split('-')[1],
+            'timeofday': _timeofday(record['time']),
+            'idx': basename[:-len('.jpg')].split('-')[2],
+            'filename': basename,
+            'features': record['features'],
+            'decision': record['decision'],
+        }
+        if record['motion'] is not None:
+            entry['motiontime'] = _timeofday(record['motiontime'])
+            for name, value in zip(('changedpixels', 'width', 'height', 'x', 'y'), record['motion']):
+                entry[name] = value
+        frames[(record['event'], basename)] = entry
+    events = {}
+    for _, entry in sorted(frames.items()):
+        events.setdefault(entry['id'], []).append(entry)
+    for v in events.values():
+        v.sort(key=events_from_log.eventkey)
+    return events, snapshots
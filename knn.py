@@ -0,0 +1,320 @@
+import argparse
+import cv2
+import numpy as np
+import struct
+import time
+
+# The tree indexes are optional, brute force only needs numpy.
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+try:
+    from sklearn.neighbors import BallTree
+except ImportError:
+    BallTree = None
+
+
+# A k nearest neighbour classifier that gives the same answers as
+# cv2.ml.KNearest with the same k, but predicts a whole batch of samples in
+# one go instead of paying for a round trip into opencv per sample.
+# It has the same predict() interface, so CatDetector can use either.
+#
+# Like opencv, distances are squared euclidean distances rounded to float32,
+# ties in distance go to the sample that was added first, and ties in the
+# vote go to the smallest label.
+#
+# index can be 'brute', 'kdtree' (needs scipy) or 'balltree' (needs
+# scikit-learn). The trees only pay off with a lot more training data than
+# we have right now.
+class KNearest(object):
+    # How many samples to compare against the training data at once. Bounds
+    # the size of the distance matrix.
+    batch_size = 1024
+
+    # classes are the distinct labels, sorted. Worked out from responses
+    # if not given.
+    def __init__(self, samples, responses, k=3, index='brute', classes=None):
+        self.samples = np.asarray(samples, dtype=np.float32).reshape(-1, 4)
+        self.responses = np.asarray(responses, dtype=np.float32).reshape(-1)
+        if classes is None:
+            classes = np.unique(self.responses)
+        self.classes = np.asarray(classes, dtype=np.float32)
+        # Everything else that depends on the number of samples is only
+        # worked out when it's first needed, so a memory mapped model (see
+        # load_binary_model()) is ready to use right away.
+        self._onehot_responses = None
+        self.k = k
+        self.index = index
+        self._tree = None
+        if index == 'kdtree':
+            if cKDTree is None:
+                raise ImportError('kdtree index needs scipy')
+            self._tree = cKDTree(self.samples)
+        elif index == 'balltree':
+            if BallTree is None:
+                raise ImportError('balltree index needs scikit-learn')
+            self._tree = BallTree(self.samples)
+        elif index != 'brute':
+            raise NotImplementedError('Unknown index {0}'.format(index))
+
+    def getDefaultK(self):
+        return self.k
+
+    def setDefaultK(self, k):
+        self.k = k
+
+    # Returns (label of the first sample, n x 1 array of labels) like
+    # cv2.ml.KNearest.predict().
+    def predict(self, samples):
+        samples = np.asarray(samples, dtype=np.float32).reshape(-1, 4)
+        results = np.empty((len(samples), 1), dtype=np.float32)
+        for start in range(0, len(samples), self.batch_size):
+            batch = samples[start:start + self.batch_size]
+            if self._tree is None:
+                votes = self._brute_votes(batch)
+            else:
+                votes = self._tree_votes(batch)
+            # argmax picks the first of equal counts, i.e. the smallest label.
+            results[start:start + len(batch), 0] = self.classes[np.argmax(votes, axis=1)]
+        retval = float(results[0, 0]) if len(results) else 0.0
+        return retval, results
+
+    def _distances(self, batch, samples):
+        diff = batch[:, None, :].astype(np.float64) - samples[None, :, :]
+        return (diff * diff).sum(axis=2).astype(np.float32)
+
+    # Same as _distances(batch, self.samples) but as |a|^2 + |b|^2 - 2ab,
+    # which is a matrix product and a lot faster. Products of float32 values
+    # are exact in float64, so for our (integer) coordinates this comes out
+    # exactly the same.
+    def _all_distances(self, batch):
+        if self._onehot_responses is None:
+            self.prepare()
+        batch = batch.astype(np.float64)
+        norms = (batch * batch).sum(axis=1)
+        return (norms[:, None] + self._norms[None, :]
+                - 2.0 * (batch @ self.samples.T.astype(np.float64))).astype(np.float32)
+
+    # Works out what brute force prediction needs from the samples. Binary
+    # models (see save_binary_model()) have it saved already.
+    def prepare(self, norms=None, onehot_responses=None):
+        if norms is None:
+            samples = self.samples.astype(np.float64)
+            norms = (samples * samples).sum(axis=1)
+        if onehot_responses is None:
+            onehot_responses = self._onehot(self.responses)
+        self._norms = norms
+        self._onehot_responses = onehot_responses
+
+    # float32 so the vote counting below can use a fast matrix product.
+    def _onehot(self, responses):
+        return (responses[:, None] == self.classes[None, :]).astype(np.float32)
+
+    # Counts the labels of the k nearest samples without sorting: everything
+    # closer than the k-th distance is in, and of the samples exactly at that
+    # distance, the ones that come first fill up the remaining places.
+    def _brute_votes(self, batch):
+        k = min(self.k, len(self.samples))
+        distances = self._all_distances(batch)
+        kth = np.partition(distances, k - 1, axis=1)[:, k - 1:k]
+        closer = distances < kth
+        at_kth = distances == kth
+        places = k - closer.sum(axis=1, keepdims=True)
+        chosen = closer | (at_kth & (np.cumsum(at_kth, axis=1) <= places))
+        return chosen.astype(np.float32) @ self._onehot_responses
+
+    # The trees don't break ties the way opencv does, so ask them for
+    # everything at most as far away as the k-th neighbour and sort that.
+    def _tree_votes(self, batch):
+        k = min(self.k, len(self.samples))
+        if self.index == 'kdtree':
+            kth, _ = self._tree.query(batch, k=[k])
+            kth = kth[:, 0]
+        else:
+            kth, _ = self._tree.query(batch, k=k)
+            kth = kth[:, -1]
+        radius = np.nextafter(kth * (1 + 1e-6), np.inf)
+        if self.index == 'kdtree':
+            candidates = self._tree.query_ball_point(batch, radius)
+        else:
+            candidates = self._tree.query_radius(batch, radius)
+        neighbours = np.empty((len(batch), k), dtype=np.intp)
+        for row, found in enumerate(candidates):
+            found = np.sort(np.asarray(found, dtype=np.intp))
+            distances = self._distances(batch[row:row + 1], self.samples[found])[0]
+            neighbours[row] = found[np.argsort(distances, kind='stable')[:k]]
+        return self._onehot(self.responses[neighbours].reshape(-1)).reshape(
+                len(batch), k, -1).sum(axis=1)
+
+
+# Reads a model saved by cv2.ml.KNearest.save().
+def load_opencv_model(filename, index='brute'):
+    fs = cv2.FileStorage(filename, cv2.FILE_STORAGE_READ)
+    node = fs.getNode('opencv_ml_knn')
+    if node.empty():
+        raise ValueError('{0} does not contain a knn model'.format(filename))
+    k = int(node.getNode('default_k').real())
+    samples = node.getNode('samples').mat()
+    responses = node.getNode('responses').mat()
+    fs.release()
+    return KNearest(samples, responses, k=k, index=index)
+
+
+# The binary model format: a header, then the samples and their labels as
+# float32 arrays that can be used straight from a memory mapped file, so
+# loading a model takes the same time however many samples it has.
+#   header: magic, format version, k, rows, cols, number of classes
+#   cols feature names, FEATURE_NAME_SIZE bytes each, zero padded
+#   the classes (float32), padded to a multiple of 16 bytes
+#   samples: rows x cols float32
+#   labels: rows float32
+# and since version 2, what KNearest.prepare() works out, so loading doesn't
+# have to look at every sample:
+#   norms: rows float64, squared length of each sample
+#   one hot labels: rows x number of classes float32
+BINARY_MAGIC = b'catknn\0\0'
+BINARY_VERSION = 2
+BINARY_HEADER = struct.Struct('<8sIIIII')
+FEATURE_NAME_SIZE = 16
+FEATURES = ('left', 'right', 'top', 'bottom')
+
+
+def _binary_layout(cols, nclasses):
+    start = BINARY_HEADER.size + cols * FEATURE_NAME_SIZE + nclasses * 4
+    return start + (-start % 16)
+
+
+def save_binary_model(filename, samples, responses, k, features=FEATURES):
+    samples = np.ascontiguousarray(samples, dtype=np.float32).reshape(-1, len(features))
+    responses = np.ascontiguousarray(responses, dtype=np.float32).reshape(-1)
+    classes = np.unique(responses)
+    with open(filename, 'wb') as f:
+        f.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, k,
+            samples.shape[0], samples.shape[1], len(classes)))
+        for name in features:
+            f.write(name.encode('ascii').ljust(FEATURE_NAME_SIZE, b'\0'))
+        f.write(classes.tobytes())
+        f.write(b'\0' * (_binary_layout(len(features), len(classes)) - f.tell()))
+        f.write(samples.tobytes())
+        f.write(responses.tobytes())
+        model = KNearest(samples, responses, k=k, classes=classes)
+        model.prepare()
+        f.write(b'\0' * (-f.tell() % 8))
+        f.write(model._norms.tobytes())
+        f.write(model._onehot_responses.tobytes())
+
+
+# The samples and labels stay in the memory mapped file. Refuses files with
+# other features than the ones CatDetector uses.
+def load_binary_model(filename, index='brute'):
+    data = np.memmap(filename, dtype=np.uint8, mode='r')
+    if len(data) < BINARY_HEADER.size:
+        raise ValueError('{0} is not a binary knn model'.format(filename))
+    magic, version, k, rows, cols, nclasses = BINARY_HEADER.unpack_from(data)
+    if magic != BINARY_MAGIC:
+        raise ValueError('{0} is not a binary knn model'.format(filename))
+    if version not in (1, BINARY_VERSION):
+        raise ValueError('{0} has unsupported version {1}'.format(filename, version))
+    offset = BINARY_HEADER.size
+    features = tuple(bytes(data[offset + i * FEATURE_NAME_SIZE:
+        offset + (i + 1) * FEATURE_NAME_SIZE]).rstrip(b'\0').decode('ascii')
+        for i in range(cols))
+    if features != FEATURES:
+        raise ValueError('{0} has features {1}, expected {2}'.format(
+            filename, features, FEATURES))
+    offset += cols * FEATURE_NAME_SIZE
+    classes = data[offset:offset + nclasses * 4].view(np.float32)
+    offset = _binary_layout(cols, nclasses)
+    samples = data[offset:offset + rows * cols * 4].view(np.float32).reshape(rows, cols)
+    offset += rows * cols * 4
+    responses = data[offset:offset + rows * 4].view(np.float32)
+    if len(responses) != rows:
+        raise ValueError('{0} is truncated'.format(filename))
+    model = KNearest(samples, responses, k=k, index=index, classes=classes)
+    if version == 1:
+        # Nothing saved, work it out now rather than on the first frame.
+        model.prepare()
+        return model
+    offset += rows * 4
+    offset += -offset % 8
+    norms = data[offset:offset + rows * 8].view(np.float64)
+    offset += rows * 8
+    onehot = data[offset:offset + rows * nclasses * 4].view(np.float32)
+    if len(norms) != rows or len(onehot) != rows * nclasses:
+        raise ValueError('{0} is truncated'.format(filename))
+    model.prepare(norms, onehot.reshape(rows, nclasses))
+    return model
+
+
+# A cv2.ml.KNearest with these samples and responses.
+def make_opencv_model(samples, responses, k):
+    opencv_model = cv2.ml.KNearest_create()
+    opencv_model.setDefaultK(k)
+    opencv_model.train(samples=np.ascontiguousarray(samples, dtype=np.float32),
+            layout=cv2.ml.ROW_SAMPLE,
+            responses=np.ascontiguousarray(responses, dtype=np.float32))
+    return opencv_model
+
+
+# An opencv model with the data from a binary model file.
+def load_binary_as_opencv(filename, index=None):
+    model = load_binary_model(filename)
+    return make_opencv_model(model.samples, model.responses, model.k)
+
+
+# Writes the model in a .knn file saved by opencv in the binary format.
+def convert_opencv_model(knnfile, binaryfile):
+    model = load_opencv_model(knnfile)
+    save_binary_model(binaryfile, model.samples, model.responses, model.k)
+    return model
+
+
+def time_it(label, repeat, fn):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    elapsed = (time.perf_counter() - start) / repeat
+    print('{0}: {1:.6f}s per run'.format(label, elapsed))
+    return elapsed
+
+
+# Compares the opencv model and this one on the training data, one sample
+# at a time (like CatDetector) and as one batch.
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('benchmark knn classifiers')
+    parser.add_argument('--labelfile', default='./catlabels.csv', help='Training data')
+    parser.add_argument('--k', default=3, type=int, help='Number of neighbours')
+    parser.add_argument('--repeat', default=10, type=int, help='Runs per measurement')
+    parser.add_argument('--copies', default=1, type=int,
+            help='Predict the training data this many times per batch')
+    args = parser.parse_args()
+    from trainer import Trainer
+    trainer = Trainer()
+    with open(args.labelfile, 'r') as labelfile:
+        trainer.addTrainingDataFromFile(labelfile)
+    samples, labels = trainer.makeTrainingData()
+    opencv_model = cv2.ml.KNearest_create()
+    opencv_model.setDefaultK(args.k)
+    opencv_model.train(samples=samples, layout=cv2.ml.ROW_SAMPLE, responses=labels)
+    queries = np.tile(samples, (args.copies, 1))
+    print('{0} training samples, {1} queries, k={2}'.format(len(samples), len(queries), args.k))
+
+    def one_at_a_time(model):
+        for sample in queries:
+            model.predict(sample.reshape(1, 4))
+
+    _, expected = opencv_model.predict(queries)
+    time_it('opencv, one at a time', args.repeat, lambda: one_at_a_time(opencv_model))
+    time_it('opencv, batch', args.repeat, lambda: opencv_model.predict(queries))
+    for index in ('brute', 'kdtree', 'balltree'):
+        try:
+            model = KNearest(samples, labels, k=args.k, index=index)
+        except ImportError as ex:
+            print('skipping {0}: {1}'.format(index, ex))
+            continue
+        _, results = model.predict(queries)
+        print('numpy {0} matches opencv: {1}'.format(index, np.array_equal(expected, results)))
+        if index == 'brute':
+            time_it('numpy brute, one at a time', args.repeat, lambda: one_at_a_time(model))
+        time_it('numpy {0}, batch'.format(index), args.repeat, lambda: model.predict(queries))
@@ -1,73 +1,218 @@
 import argparse
+import bisect
+import collections
 import cv2
-from datetime import date, datetime, timedelta
+from datetime import date, datetime
 import os
-import re
+import threading
 
+import catalog
 import events_from_log
+import journal
 from cat_detector import CatDetector
 from explorer import imageExplorer
 
 
+# Set from --catalog (see catalog.py). The functions below look things up
+# there instead of listing imagedir if it's set.
+image_catalog = None
+
+# How much of the decoded frames the viewers keep around, and how many frames
+# ahead of the current one (and into the next event) they read in the
+# background.
+DEFAULT_CACHE_MB = 256
+PREFETCH_AHEAD = 3
+
+
+# Decoded frames for the viewers, so stepping through an event doesn't wait
+# for the disk. Keeps up to maxbytes of images and drops the least recently
+# used ones first. prefetch() hands a list of files to a background thread
+# that reads them in order; a newer list replaces whatever it hasn't got to.
+class FrameCache(object):
+
+    def __init__(self, maxbytes=DEFAULT_CACHE_MB * 1024 * 1024, read=cv2.imread):
+        self.maxbytes = maxbytes
+        self._read = read
+        self._frames = collections.OrderedDict()
+        self._size = 0
+        self._wanted = []
+        self._loading = None
+        self._cond = threading.Condition()
+        self._thread = None
+
+    # The decoded image in filename, or None if it can't be read. Waits for
+    # the background thread if it is reading the file right now.
+    def get(self, filename):
+        with self._cond:
+            while self._loading == filename:
+                self._cond.wait()
+            img = self._frames.get(filename)
+            if img is not None:
+                self._frames.move_to_end(filename)
+                return img
+            if filename in self._wanted:
+                self._wanted.remove(filename)
+        img = self._read(filename)
+        if img is not None:
+            with self._cond:
+                self._add(filename, img)
+        return img
+
+    def prefetch(self, filenames):
+        with self._cond:
+            self._wanted = [f for f in filenames if f not in self._frames]
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def __contains__(self, filename):
+        with self._cond:
+            return filename in self._frames
+
+    def _add(self, filename, img):
+        if filename in self._frames:
+            return
+        self._frames[filename] = img
+        self._size += img.nbytes
+        while self._size > self.maxbytes and len(self._frames) > 1:
+            _, old = self._frames.popitem(last=False)
+            self._size -= old.nbytes
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._wanted:
+                    self._cond.wait()
+                filename = self._wanted.pop(0)
+                if filename in self._frames:
+                    continue
+                self._loading = filename
+            img = None
+            try:
+                img = self._read(filename)
+            finally:
+                with self._cond:
+                    self._loading = None
+                    if img is not None:
+                        self._add(filename, img)
+                    self._cond.notify_all()
+
+
+frame_cache = FrameCache()
+
+
+# The frames of the event after idx in events, or an empty list.
+def next_event(events, idx):
+    keys = sorted(events.keys(), key=int)
+    pos = keys.index(idx) + 1 if idx in keys else len(keys)
+    return events[keys[pos]] if pos < len(keys) else []
+
+
+# The files the cursor keys can go to from frame i of frames, nearest
+# first, then the first few of next_frames.
+def frames_to_prefetch(imagedir, frames, i, next_frames=()):
+    wanted = []
+    for j in [i + 1, i - 1] + list(range(i + 2, i + 1 + PREFETCH_AHEAD)):
+        if 0 <= j < len(frames):
+            wanted.append(frames[j])
+    wanted.extend(next_frames[:PREFETCH_AHEAD])
+    return [imagedir + f['filename'] for f in wanted if 'filename' in f]
+
+
+def prefetch_around(imagedir, frames, i, next_frames=()):
+    frame_cache.prefetch(frames_to_prefetch(imagedir, frames, i, next_frames))
+
+
+# The frames and snapshots of an image directory by day and event id, from
+# a single os.scandir(). refresh() only scans again if the directory has
+# changed (files were added or removed) since the last scan.
+class ImageDirIndex(object):
+
+    def __init__(self, imagedir):
+        self.imagedir = imagedir
+        self._mtime = None
+        self._days = {}
+        self._dates = []
+
+    def refresh(self):
+        mtime = os.stat(self.imagedir).st_mtime_ns
+        if mtime == self._mtime:
+            return self
+        days = {}
+        with os.scandir(self.imagedir) as entries:
+            for entry in entries:
+                parts = catalog.split_filename(entry.name)
+                if parts is None:
+                    continue
+                event, taken, idx = parts
+                day = date(int(taken[0:4]), int(taken[4:6]), int(taken[6:8]))
+                events, snapshots = days.setdefault(day, ({}, {}))
+                event_id = entry.name.split('-')[0]
+                if idx == 'snapshot':
+                    snapshots[taken[8:10]] = {
+                            'id': event_id,
+                            'timeofday': taken[8:],
+                            'filename': entry.name}
+                else:
+                    events.setdefault(event_id, []).append({'timeofday': taken[8:],
+                        'id': event_id,
+                        'datetime': taken,
+                        'idx': idx,
+                        'filename': entry.name})
+        for events, _ in days.values():
+            for v in events.values():
+                v.sort(key=events_from_log.eventkey)
+        self._days = days
+        self._dates = sorted(day for day, (events, _) in days.items() if events)
+        self._mtime = mtime
+        return self
+
+    # The days that have frames, in order.
+    def dates(self):
+        return self._dates
+
+    def events_for_date(self, day):
+        events, snapshots = self._days.get(day, ({}, {}))
+        return ({k: list(v) for k, v in events.items()}, dict(snapshots))
+
+    # The first day after day that has frames, or None.
+    def next_date_after(self, day):
+        pos = bisect.bisect_right(self._dates, day)
+        return self._dates[pos] if pos < len(self._dates) else None
+
+
+_dir_indexes = {}
+
+
+def dir_index(imagedir):
+    if imagedir not in _dir_indexes:
+        _dir_indexes[imagedir] = ImageDirIndex(imagedir)
+    return _dir_indexes[imagedir].refresh()
+
+
 def list_dates(imagedir):
-    p = re.compile('(\d+)-(\d+)-(\d+).jpg')
-    dates = []
-    for file in os.listdir(imagedir):
-        m = re.match(p, file)
-        if m:
-            date_and_time = m.group(2)
-            dt = datetime.strptime(date_and_time, '%Y%m%d%H%M%S')
-            dates.append(date(dt.year, dt.month, dt.day))
-    return dates
+    if image_catalog is not None:
+        return [datetime.strptime(day, '%Y-%m-%d').date() for day in image_catalog.days()]
+    return dir_index(imagedir).dates()
 
 
 def list_events_for_date(imagedir, date_to_show):
-    datestr = date_to_show.strftime('%Y%m%d')
-    p = re.compile('(\d+)-' + datestr + '(\d+)-(\d+).jpg')
-    s = re.compile('(\d+)-' + datestr + '(\d+)-snapshot.jpg')
-    events = {}
-    snapshots = {}
-    for fname in os.listdir(imagedir):
-        m = re.match(p, fname)
-        if m:
-            event_id = m.group(1)
-            timeofday = m.group(2)
-            idx = m.group(3)
-            if event_id not in events:
-                events[event_id] = []
-            events[event_id].append({'timeofday': timeofday,
-                'id': event_id,
-                'datetime': datestr + timeofday,
-                'idx': idx,
-                'filename': fname})
-        else:
-            m2 = re.match(s, fname)
-            if m2:
-                event_id = m2.group(1)
-                timeofday = m2.group(2)
-                houroftheday = timeofday[0:2]
-                snapshots[houroftheday] = {
-                        'id': event_id,
-                        'timeofday': timeofday,
-                        'filename': fname}
-    for k, v in events.items():
-        v.sort(key=events_from_log.eventkey)
-    return (events, snapshots)
+    if image_catalog is not None:
+        return image_catalog.frames_for_date(date_to_show)
+    return dir_index(imagedir).events_for_date(date_to_show)
 
 
 def get_next_date_after(imagedir, curdate):
-    try_this = curdate + timedelta(days=1)
-    print('trying date %s' % try_this.strftime('%Y-%m-%d'))
-    for i in range(30):
-        (ev, snapshots) = list_events_for_date(imagedir, try_this)
-        if ev:
-            return (try_this, ev, snapshots)
-        else:
-            try_this = try_this + timedelta(days=1)
-            print('no events for date %s' % try_this.strftime('%Y-%m-%d'))
-    print('no events found for 30 days starting from %s' % curdate.strftime('%Y-%m-%d'))
-    return (None, None, None)
-            
+    if image_catalog is not None:
+        next_day = image_catalog.next_day(curdate)
+    else:
+        next_day = dir_index(imagedir).next_date_after(curdate)
+    if next_day is None:
+        print('no events found after %s' % curdate.strftime('%Y-%m-%d'))
+        return (None, None, None)
+    (ev, snapshots) = list_events_for_date(imagedir, next_day)
+    return (next_day, ev, snapshots)
 
 
 def list_images(imagedir, date_to_show):
@@ -113,7 +258,7 @@ def loop_images_no_log(imagedir, date_to_start, labelfile, detector):
         curdate = date_to_start
     (ev, snapshots) = list_events_for_date(imagedir, curdate)
     while(True):
-        for idx in ev.keys():
+        for idx in sorted(ev.keys(), key=int):
             cont = show_images_no_log(imagedir, curdate, idx, labelfile, detector)
             if not cont:
                 break
@@ -135,12 +280,14 @@ def show_images_no_log(imagedir, date_to_show, idx, labelfile, detector):
         return True
     windowname = '%s' % date_to_show
     i = 0
+    following = next_event(ev, idx)
     filename = imagedir + ev[idx][i]['filename']
-    img = cv2.imread(filename)
+    img = frame_cache.get(filename)
     if img is None:
         print('failed to read image at %s' % filename)
         return True
     cv2.imshow(windowname, img)
+    prefetch_around(imagedir, ev[idx], i, following)
     print('showing image %d of %d' % (i, len(ev[idx])))
     while(1):
         pressed = cv2.waitKey(0)
@@ -189,7 +336,7 @@ def show_images_no_log(imagedir, date_to_show, idx, labelfile, detector):
             xp = imageExplorer(ev[idx][i]['filename'], detector, labelfile)
             snapkey = ev[idx][i]['timeofday'][0:2]
             if snapkey in snapshots:
-                snap = cv2.imread(imagedir + snapshots[snapkey]['filename'])
+                snap = frame_cache.get(imagedir + snapshots[snapkey]['filename'])
                 xp.exploreImage(img, snap, None, None)
             else:
                 xp.exploreImage(img, None, None, None)
@@ -199,8 +346,9 @@ def show_images_no_log(imagedir, date_to_show, idx, labelfile, detector):
             break
         print('showing image %d of %d' % (i, len(ev[idx])))
         filename = imagedir + ev[idx][i]['filename']
-        img = cv2.imread(filename)
+        img = frame_cache.get(filename)
         cv2.imshow(windowname, img)
+        prefetch_around(imagedir, ev[idx], i, following)
     cv2.destroyAllWindows()
     return True
         
@@ -210,7 +358,8 @@ def show_image(imagedir, events, snapshots, idx, detector, labelfile):
     print('no event %s in list' % idx)
     return
   i = 0
-  img = cv2.imread(imagedir + events[idx][i]['filename'])
+  following = next_event(events, idx)
+  img = frame_cache.get(imagedir + events[idx][i]['filename'])
   if img is None:
     print('failed to find image at %s' % imagedir + events[idx][i]['filename'], flush=True)
   ev = events[idx][i]
@@ -219,12 +368,13 @@ def show_image(imagedir, events, snapshots, idx, detector, labelfile):
   print('motion for this image: %s' % (motion,))
   windowname = idx
   cv2.imshow(windowname, img)
+  prefetch_around(imagedir, events[idx], i, following)
   snapkey = ev['datetime'][0:10]
   snap = None
   if snapkey in snapshots: 
-      snap = cv2.imread(imagedir + snapshots[snapkey]['filename']+'-snapshot.jpg')
+      snap = frame_cache.get(imagedir + snapshots[snapkey]['filename']+'-snapshot.jpg')
   elif os.path.exists(imagedir + 'lastsnap.jpg'):
-      snap = cv2.imread(imagedir + 'lastsnap.jpg')
+      snap = frame_cache.get(imagedir + 'lastsnap.jpg')
   if snap is not None:
       cv2.imshow('snapshot', snap)
   while(1):
@@ -269,8 +419,9 @@ def show_image(imagedir, events, snapshots, idx, detector, labelfile):
     else:
       break
     print('showing image %d of %d' % (i, len(events[idx])))
-    img = cv2.imread(imagedir + ev['filename'])
+    img = frame_cache.get(imagedir + ev['filename'])
     cv2.imshow(windowname, img)
+    prefetch_around(imagedir, events[idx], i, following)
   cv2.destroyAllWindows()
 
 
@@ -282,23 +433,41 @@ if __name__ == "__main__":
   parser.add_argument('--picture', default=None, help='Single picture filename')
   parser.add_argument('--labelfile', default='/tmp/catlabels.csv', help='Where to write labels')
   parser.add_argument('--daemonlog', default=None, help='File with cat flap daemon log messages')
+  parser.add_argument('--journal', default=None, help='Daemon journal to use instead of the daemon log')
+  parser.add_argument('--catalog', default=None,
+          help='Catalog (see catalog.py) to update from --images and --daemonlog and use')
   parser.add_argument('--modelfile', default=None, help='File to load model from')
   parser.add_argument('--loop', default=None, help='loop over all images in dir')
+  parser.add_argument('--cachesize', type=int, default=DEFAULT_CACHE_MB,
+          help='Megabytes of decoded images to keep in memory')
   args = parser.parse_args()
+  frame_cache = FrameCache(args.cachesize * 1024 * 1024)
   date_to_show = None
-  if not args.date and args.daemonlog is not None:
-      with open(args.daemonlog) as daemonfile:
-          daemon_events = events_from_log.daemonlog_datelist(daemonfile)
-          print(daemon_events)
+  if args.catalog is not None:
+      image_catalog = catalog.Catalog(args.catalog)
+      image_catalog.add_image_dir(args.images)
+      if args.daemonlog is not None:
+          image_catalog.add_daemonlog(args.daemonlog)
+  if not args.date and args.journal is not None:
+      with open(args.journal) as journalfile:
+          print(journal.journal_datelist(journalfile))
           exit()
+  elif not args.date and args.daemonlog is not None:
+      daemon_events = events_from_log.indexed_datelist(args.daemonlog)
+      print(daemon_events)
+      exit()
   elif args.date == 'today':
     date_to_show = date.today()
   elif args.date is not None:
     date_to_show = datetime.strptime(args.date, "%Y-%m-%d").date()
   daemon_events = None
-  if args.daemonlog is not None and date_to_show is not None:
-      with open(args.daemonlog) as daemonfile:
-          daemon_events, snapshots = events_from_log.daemonlog_events_for_date(daemonfile, date_to_show)
+  if args.journal is not None and date_to_show is not None:
+      with open(args.journal) as journalfile:
+          daemon_events, snapshots = journal.journal_events_for_date(journalfile, date_to_show)
+  elif image_catalog is not None and args.daemonlog is not None and date_to_show is not None:
+      daemon_events, snapshots = image_catalog.events_for_date(date_to_show)
+  elif args.daemonlog is not None and date_to_show is not None:
+      daemon_events, snapshots = events_from_log.indexed_events_for_date(args.daemonlog, date_to_show)
   if args.idx is None and args.picture is None and args.loop is None:
       if daemon_events is not None:
           for event_id, events in sorted(daemon_events.items()):
@@ -321,5 +490,5 @@ if __name__ == "__main__":
       elif args.loop is not None:
           loop_images_no_log(args.images, date_to_show, labelfile, cat_detector)
       else:
-          show_images_no_log(args.images, date_to_show, args.idx, None, labelfile, cat_detector)
+          show_images_no_log(args.images, date_to_show, args.idx, labelfile, cat_detector)
     
@@ -0,0 +1,129 @@
+# Read motion's live stream (stream_port in motion.conf) so frames can be
+# decoded from memory instead of waiting for motion to write them to the SD
+# card and reading them back.
+# The stream is multipart/x-mixed-replace: one http response that never
+# ends, with a jpeg in each part.
+
+import asyncio
+import base64
+from collections import deque
+from daemonlog import log
+import time
+
+# Largest frame we can read without a Content-Length header.
+STREAM_LIMIT = 1024 * 1024
+
+
+# The most recent frames from the stream, with the (time.monotonic()) time
+# they arrived. Frames are kept as jpeg bytes, they are only decoded if the
+# detector wants them.
+class StreamFrames(object):
+
+    def __init__(self, capacity=16):
+        self._frames = deque(maxlen=capacity)
+        self.count = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+    def add(self, jpeg, received=None):
+        if received is None:
+            received = time.monotonic()
+        self._frames.append((received, jpeg))
+        self.count += 1
+
+    # The frame that arrived closest to when, or None if there isn't one
+    # within max_skew seconds.
+    def closest(self, when, max_skew=1.0):
+        best = None
+        for received, jpeg in self._frames:
+            skew = abs(received - when)
+            if skew <= max_skew and (best is None or skew < best[0]):
+                best = (skew, jpeg)
+        return None if best is None else best[1]
+
+
+def _headers(lines):
+    headers = {}
+    for line in lines:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return headers
+
+
+async def _read_headers(reader):
+    lines = []
+    while True:
+        line = (await reader.readline()).decode('latin-1')
+        if not line:
+            raise ConnectionError('stream closed')
+        line = line.rstrip('\r\n')
+        if not line:
+            return lines
+        lines.append(line)
+
+
+# Reads the http response from reader and calls callback(jpeg) for every
+# frame until the stream ends.
+async def read_stream(reader, callback):
+    lines = await _read_headers(reader)
+    if not lines or lines[0].split()[1:2] != ['200']:
+        raise ConnectionError('stream request failed: {0}'.format(lines[0] if lines else ''))
+    content_type = _headers(lines[1:]).get('content-type', '')
+    boundary = None
+    for param in content_type.split(';')[1:]:
+        name, _, value = param.partition('=')
+        if name.strip().lower() == 'boundary':
+            boundary = value.strip().strip('"')
+    if boundary is None:
+        raise ConnectionError('not a multipart stream: {0}'.format(content_type))
+    delimiter = b'--' + boundary.encode('latin-1')
+    # Without a Content-Length, a part ends where the next one starts.
+    at_part = False
+    while True:
+        if not at_part:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                if line.rstrip(b'\r\n') == delimiter:
+                    break
+        headers = _headers(await _read_headers(reader))
+        if 'content-length' in headers:
+            jpeg = await reader.readexactly(int(headers['content-length']))
+            at_part = False
+        else:
+            jpeg = await reader.readuntil(b'\r\n' + delimiter)
+            jpeg = jpeg[:-len(delimiter) - 2]
+            at_part = True
+            # The last part is followed by --boundary--
+            if (await reader.readline()).startswith(b'--'):
+                callback(jpeg)
+                return
+        callback(jpeg)
+
+
+# Keeps a connection to the stream open and puts the frames into frames,
+# reconnecting after retry seconds if the connection fails. auth is
+# 'user:password' for basic authentication (stream_auth_method 1).
+async def stream_worker(host, port, frames, path='/', auth=None, retry=5.0):
+    request = 'GET {0} HTTP/1.1\r\nHost: {1}:{2}\r\n'.format(path, host, port)
+    if auth:
+        request += 'Authorization: Basic {0}\r\n'.format(
+            base64.b64encode(auth.encode('utf8')).decode('ascii'))
+    request = (request + '\r\n').encode('latin-1')
+    while True:
+        writer = None
+        try:
+            reader, writer = await asyncio.open_connection(host, port, limit=STREAM_LIMIT)
+            writer.write(request)
+            await writer.drain()
+            await read_stream(reader, frames.add)
+            log.warning('Stream from %s:%s ended', host, port)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError) as ex:
+            log.warning('Stream from %s:%s failed: %s', host, port, ex)
+        finally:
+            if writer is not None:
+                writer.close()
+        await asyncio.sleep(retry)
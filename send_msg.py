@@ -2,29 +2,94 @@
 # As it is now, it would be simpler to use netcat:
 # echo $msg | nc localhost 3333
 # use nc -u for udp
+# With --stdin, every line read from stdin is sent as a message over the
+# same connection, so a producer sending a lot of messages doesn't pay for
+# a new connection every time.
 
 import argparse
-from socket import AF_INET, socket, SOCK_DGRAM, SOCK_STREAM
+import struct
+import sys
+from socket import AF_INET, AF_UNIX, socket, SOCK_DGRAM, SOCK_STREAM
+
+PROTOCOLS = ('UDP', 'TCP', 'UNIX', 'UNIXDGRAM')
+DEFAULT_SOCKET = '/tmp/catflap.sock'
+
+# How messages are separated on a TCP connection: a newline after each
+# message, or the length of the message (4 bytes, big endian) before it.
+FRAMINGS = ('newline', 'length')
+LENGTH_PREFIX = struct.Struct('!I')
+MAX_MESSAGE_SIZE = 64 * 1024
+
+
+def frame(message, framing='newline'):
+    data = bytes(message, 'utf8')
+    if framing == 'length':
+        return LENGTH_PREFIX.pack(len(data)) + data
+    return data + b'\n'
+
+
+# Sends messages to the daemon. For TCP and UNIX the connection is made
+# when the first message is sent and then kept open; if the daemon went
+# away in between, it is made again once. path is the socket file for UNIX
+# and UNIXDGRAM.
+class MessageClient(object):
+
+    def __init__(self, host='127.0.0.1', port=3333, proto='UDP', framing='newline',
+                 path=DEFAULT_SOCKET):
+        self.proto = proto
+        self.framing = framing
+        if proto in ('UNIX', 'UNIXDGRAM'):
+            self.addr = path
+            self._family = AF_UNIX
+        else:
+            self.addr = (host, int(port))
+            self._family = AF_INET
+        self._socket = None
+
+    def send(self, message):
+        if self.proto in ('UDP', 'UNIXDGRAM'):
+            if self._socket is None:
+                self._socket = socket(self._family, SOCK_DGRAM)
+            self._socket.sendto(bytes(message, 'utf8'), self.addr)
+            return
+        data = frame(message, self.framing)
+        if self._socket is not None:
+            try:
+                self._socket.sendall(data)
+                return
+            except OSError:
+                self.close()
+        self._socket = socket(self._family, SOCK_STREAM)
+        self._socket.connect(self.addr)
+        self._socket.sendall(data)
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser('send motion event')
     parser.add_argument('--host', default='127.0.0.1', help='Where the catflap daemon runs')
     parser.add_argument('--port', default=3333, help='Port of the catflap daemon')
     parser.add_argument('--msg', default=None, help='Message to send to the catflap daemon')
-    parser.add_argument('--proto', default='UDP', help='Protocol (TCP or UDP)')
+    parser.add_argument('--stdin', action='store_true',
+            help='Send every line from stdin as a message, over one connection')
+    parser.add_argument('--proto', default='UDP', choices=PROTOCOLS,
+            help='Protocol (TCP, UDP, UNIX or UNIXDGRAM)')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET,
+            help='Socket file for the UNIX and UNIXDGRAM protocols')
+    parser.add_argument('--framing', default='newline', choices=FRAMINGS,
+            help='How messages are separated on TCP connections')
     args = parser.parse_args()
-    if not args.msg:
+    client = MessageClient(args.host, args.port, args.proto, args.framing, args.socket)
+    if args.stdin:
+        for line in sys.stdin:
+            if line.strip():
+                client.send(line.strip())
+    elif not args.msg:
         print('Skipping event with empty message')
-        exit
-    addr = (args.host, int(args.port))
-    if args.proto == 'TCP':
-        client_socket = socket(AF_INET, SOCK_STREAM)
-        client_socket.connect(addr)
-        client_socket.send(bytes(args.msg, "utf8"))
-        client_socket.close()
     else:
-        # udp socket
-        client_socket = socket(AF_INET, SOCK_DGRAM)
-        client_socket.sendto(bytes(args.msg, 'utf8'), addr)
-
-
+        client.send(args.msg)
+    client.close()
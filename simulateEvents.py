@@ -7,15 +7,18 @@ import re
 from socket import AF_INET, socket, SOCK_DGRAM
 import sys
 
+import catalog
 import events_from_log
+import journal
 
 async def send_msg(msg, addr):
     client_socket = socket(AF_INET, SOCK_DGRAM)
     client_socket.sendto(bytes(msg, 'utf8'), addr)
 
 
-async def simulate_event(imagedir, logfile, date_to_show, idx, addr):
-  ev, _ = events_from_log.daemonlog_events_for_date(logfile, date_to_show)
+# ev is the events of one day, as events_from_log.daemonlog_events_for_date()
+# returns them.
+async def simulate_event(imagedir, ev, date_to_show, idx, addr):
   if idx not in ev:
     print('no event %s for date %s' % (idx, date_to_show))
     return
@@ -23,6 +26,10 @@ async def simulate_event(imagedir, logfile, date_to_show, idx, addr):
   for i in range(0, len(ev[idx])):
       imagefile = imagedir + ev[idx][i]['filename']
       imagetime = events_from_log.hms_to_seconds(ev[idx][i]['timeofday'])
+      if 'motiontime' not in ev[idx][i]:
+        # The journal has frames that never got a motion message.
+        await send_msg('saved {0}'.format(imagefile), addr)
+        continue
       motiontime = events_from_log.hms_to_seconds(ev[idx][i]['motiontime'])
       motionmsg = 'motion detected: {0} changed pixels {1} x {2} at {3} {4}'.format(
           ev[idx][i]['changedpixels'],
@@ -48,6 +55,9 @@ if __name__ == "__main__":
   parser.add_argument('--idx', default=None, help='The event to replay')
   parser.add_argument('--images', default='./images/', help='Where your image files are')
   parser.add_argument('--daemonlog', default='./daemonlog', help='Where your log messages are')
+  parser.add_argument('--journal', default=None, help='Replay from the daemon journal instead of the log')
+  parser.add_argument('--catalog', default=None,
+          help='Catalog (see catalog.py) to update from the log and replay from')
   parser.add_argument('--host', default='127.0.0.1', help='Where the catflap daemon runs')
   parser.add_argument('--port', default=3333, help='Port of the catflap daemon')
 
@@ -61,6 +71,18 @@ if __name__ == "__main__":
   else:
     date_to_show = datetime.strptime(args.date, "%Y-%m-%d").date()
   addr = (args.host, args.port)
-  with open(args.daemonlog) as daemonfile:
-      asyncio.run(simulate_event(args.images, daemonfile, date_to_show, args.idx, addr))
+  if args.journal is not None:
+    with open(args.journal) as journalfile:
+      ev, _ = journal.journal_events_for_date(journalfile, date_to_show)
+  elif args.catalog is not None:
+    cat = catalog.Catalog(args.catalog)
+    cat.add_daemonlog(args.daemonlog)
+    ev, _ = cat.events_for_date(date_to_show)
+  else:
+    # Only the lines for this event are read from the log (see
+    # events_from_log.DaemonLogIndex).
+    index = events_from_log.DaemonLogIndex(args.daemonlog).update()
+    lines = index.lines_for_event(date_to_show.strftime('%Y-%m-%d'), args.idx)
+    ev, _ = events_from_log.daemonlog_events_for_date(lines, date_to_show)
+  asyncio.run(simulate_event(args.images, ev, date_to_show, args.idx, addr))
     
@@ -1,11 +1,17 @@
 import cat_detector
+import cv2
+import knn
+import numpy as np
+import os
+import shutil
+import tempfile
 import unittest
 
 class TestCatDetector(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
         cat_detector.CatDetector.setupCatDetector(modelfile=None,
-                trainingfile='./catlabels.csv')
+                trainingfile='./catlabels.csv', cachedir=None)
 
     def setUp(self):
         self.cat_detector = cat_detector.CatDetector.makeCatDetector()
@@ -24,6 +30,24 @@ class TestCatDetector(unittest.TestCase):
         ret = self.cat_detector.parse_message('saved images/20-20200414194357-00.jpg')
         self.assertEqual('got image but no motion event', ret)
 
+    def test_parse(self):
+        Kinds = cat_detector.MessageKinds
+        m = cat_detector.parse('saved /home/pi/pictures/20-20200414194357-03.jpg')
+        self.assertEqual((Kinds.frame, '/home/pi/pictures/20-20200414194357-03.jpg', 20, 3, None),
+                (m.kind, m.filename, m.event, m.index, m.motion))
+        m = cat_detector.parse('saved images/11-20200414190000-snapshot.jpg\n')
+        self.assertEqual((Kinds.snapshot, 'images/11-20200414190000-snapshot.jpg', 11),
+                (m.kind, m.filename, m.event))
+        m = cat_detector.parse('motion detected: 4142 changed pixels 76 x 64 at 274 80')
+        self.assertEqual((Kinds.motion, (4142, 76, 64, 274, 80)), (m.kind, m.motion))
+        self.assertEqual(Kinds.bad_save, cat_detector.parse('saved images/11-2020.jpg').kind)
+        self.assertEqual(Kinds.unknown, cat_detector.parse('saved images/11-2020-00.png').kind)
+        self.assertEqual(Kinds.unknown, cat_detector.parse('motion detected: 1 changed pixels 2 x 3 at 4').kind)
+        self.assertEqual(Kinds.unknown, cat_detector.parse('motion detected: a changed pixels 2 x 3 at 4 5').kind)
+        self.assertEqual(Kinds.unknown, cat_detector.parse('hello').kind)
+        ret = self.cat_detector.parse_message('saved images/11-2020.jpg')
+        self.assertEqual('Failed to parse save file message saved images/11-2020.jpg', ret)
+
     def test_motion_detected(self):
         ret = self.cat_detector.parse_message('motion detected: bad message')
         self.assertEqual('Failed to recognize message motion detected: bad message', ret)
@@ -44,6 +68,103 @@ class TestCatDetector(unittest.TestCase):
         self.assertEqual('event 20 image 1 evaluated as CatStates.no_cat_arriving', ret)
         self.assertEqual(cat_detector.MessageStates.waiting, self.cat_detector._message_state)
 
+    def test_preloaded_image(self):
+        self.assertTrue(cat_detector.image_for_message(cat_detector.parse(
+            'motion detected: 4142 changed pixels 76 x 64 at 274 80')) is None)
+        img = cat_detector.image_for_message(cat_detector.parse(
+            'saved images/20-20200414194357-00.jpg'))
+        self.assertFalse(img is None)
+        ret = self.cat_detector.parse_message('motion detected: 4142 changed pixels 76 x 64 at 274 80')
+        ret = self.cat_detector.parse_message('saved images/20-20200414194357-00.jpg', img)
+        self.assertEqual('event 20 image 1 evaluated as CatStates.no_cat_arriving', ret)
+
+    def test_lazy_decoding(self):
+        self.cat_detector.parse_message('motion detected: 4142 changed pixels 76 x 64 at 274 80')
+        self.cat_detector.parse_message('saved images/20-20200414194357-00.jpg')
+        self.assertEqual((240, 320), self.cat_detector._images[-1].image.shape)
+        self.assertFalse(self.cat_detector.wants_frame(20))
+        self.assertTrue(self.cat_detector.wants_frame(21))
+        self.cat_detector.parse_message('motion detected: 4142 changed pixels 76 x 64 at 274 80')
+        ret = self.cat_detector.parse_message('saved images/20-20200414194357-01.jpg')
+        self.assertEqual('ignoring image as no cat arriving', ret)
+        self.assertFalse(self.cat_detector._images[-1].decoded)
+
+    def test_motion_roi(self):
+        motion = (4142, 200, 200, 300, 250)
+        self.cat_detector.roi_margin = 20
+        self.assertEqual((90, 210, 65, 185), self.cat_detector.motion_roi(motion, (240, 320), 2))
+        self.assertEqual((180, 420, 130, 370), self.cat_detector.motion_roi(motion, (480, 640)))
+        self.assertEqual((290, 320, 215, 240), self.cat_detector.motion_roi((1, 40, 40, 620, 470), (240, 320), 2))
+        img = cat_detector.read_image('images/20-20200414194357-00.jpg')
+        full = self.cat_detector.get_coords(img)
+        roi = self.cat_detector.get_coords(img, motion, 2)
+        # Same scale as the full frame, but only the lines inside the box.
+        self.assertEqual(full[0], roi[0])
+        self.assertTrue(roi[3] <= 185)
+
+    def test_ring_buffers(self):
+        detector = cat_detector.CatDetector.makeCatDetector(capacity=2)
+        for i in range(5):
+            detector.parse_message('motion detected: 4142 changed pixels 76 x 64 at 274 %d' % (80 + i))
+            ret = detector.parse_message('saved images/20-20200414194357-0%d.jpg' % (i % 2))
+        self.assertEqual('ignoring image as no cat arriving', ret)
+        self.assertEqual(2, len(detector._images))
+        self.assertEqual(5, detector._images.count)
+        self.assertEqual((4142, 76, 64, 274, 84), detector._motions[-1])
+        self.assertEqual((274, 83), detector._trajectory[0])
+        self.assertRaises(IndexError, lambda: detector._trajectory[2])
+        self.assertEqual((240, 320), detector._images[0].image.shape)
+        self.assertEqual((2, 240, 320), detector._images._store.shape)
+        detector.reset()
+        self.assertEqual(0, len(detector._images))
+        self.assertTrue(detector.determine_trajectory() is None)
+
+    def test_model_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cachedir = os.path.join(tmpdir, 'cache')
+            labelfile = os.path.join(tmpdir, 'labels.csv')
+            shutil.copy('./catlabels.csv', labelfile)
+            first = cat_detector.trained_model(labelfile, cachedir)
+            self.assertEqual([os.path.basename(first)], os.listdir(cachedir))
+            mtime = os.path.getmtime(first)
+            self.assertEqual(first, cat_detector.trained_model(labelfile, cachedir))
+            self.assertEqual(mtime, os.path.getmtime(first))
+            with open(labelfile, 'a') as f:
+                f.write('99-20200414194357-00.jpg,no cat,1,2,3,4\n')
+            second = cat_detector.trained_model(labelfile, cachedir)
+            self.assertNotEqual(first, second)
+            self.assertEqual(2, len(os.listdir(cachedir)))
+            model = cat_detector.CatDetector.statModel
+            cat_detector.CatDetector.setupCatDetector(None, labelfile, cachedir=cachedir)
+            self.assertFalse(cat_detector.CatDetector.statModel is model)
+            self.assertIsNone(cat_detector.CatDetector.cache_saver)
+            # Not cached yet: trained here and saved in the background.
+            with open(labelfile, 'a') as f:
+                f.write('98-20200414194357-00.jpg,no cat,1,2,3,4\n')
+            cat_detector.CatDetector.setupCatDetector(None, labelfile, classifier='numpy',
+                                                      cachedir=cachedir)
+            cat_detector.CatDetector.cache_saver.join()
+            self.assertEqual(3, len(os.listdir(cachedir)))
+            samples = cat_detector.CatDetector.statModel.samples
+            _, expected = knn.load_binary_model(cat_detector.trained_model(labelfile, cachedir)).predict(
+                    samples)
+            _, results = cat_detector.CatDetector.statModel.predict(samples)
+            self.assertTrue(np.array_equal(expected, results))
+            # The classifier is the one asked for, whether the model is from
+            # the cache or new.
+            cat_detector.CatDetector.setupCatDetector(None, labelfile, cachedir=cachedir)
+            self.assertIsNone(cat_detector.CatDetector.cache_saver)
+            self.assertIsInstance(cat_detector.CatDetector.statModel, cv2.ml.KNearest)
+            _, results = cat_detector.CatDetector.statModel.predict(samples)
+            self.assertTrue(np.array_equal(expected, results))
+            os.remove(cat_detector.trained_model(labelfile, cachedir))
+            cat_detector.CatDetector.setupCatDetector(None, labelfile, cachedir=cachedir)
+            cat_detector.CatDetector.cache_saver.join()
+            self.assertIsInstance(cat_detector.CatDetector.statModel, cv2.ml.KNearest)
+            _, results = cat_detector.CatDetector.statModel.predict(samples)
+            self.assertTrue(np.array_equal(expected, results))
+            cat_detector.CatDetector.statModel = model
+
     def test_image_then_image(self):
         ret = self.cat_detector.parse_message('saved images/20-20200414194357-00.jpg')
         self.assertEqual('got image but no motion event', ret)
@@ -0,0 +1,87 @@
+import catalog
+from datetime import date
+import events_from_log
+import listImages
+import os
+import shutil
+import tempfile
+import unittest
+
+NAMES = ('20-20200414194357-00.jpg', '20-20200414194357-01.jpg', '21-20200414200101-00.jpg',
+         '20-20200414190000-snapshot.jpg', '22-20200415080000-00.jpg', 'lastsnap.jpg')
+
+
+class TestCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.imagedir = os.path.join(self.tmpdir, 'images') + '/'
+        os.mkdir(self.imagedir)
+        for name in NAMES:
+            open(os.path.join(self.imagedir, name), 'w').close()
+        self.catalog = catalog.Catalog(os.path.join(self.tmpdir, 'catalog.sqlite'))
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_image_dir(self):
+        self.assertEqual(5, self.catalog.add_image_dir(self.imagedir))
+        # Nothing changed, so nothing to do.
+        self.assertEqual(0, self.catalog.add_image_dir(self.imagedir))
+        day = date(2020, 4, 14)
+        self.assertEqual(listImages.list_events_for_date(self.imagedir, day),
+                         self.catalog.frames_for_date(day))
+        self.assertEqual(['2020-04-14', '2020-04-15'], self.catalog.days())
+        self.assertEqual(date(2020, 4, 15), self.catalog.next_day(day))
+        self.assertIsNone(self.catalog.next_day(date(2020, 4, 15)))
+
+    def test_daemonlog(self):
+        logfilename = os.path.join(self.tmpdir, 'daemonlog')
+        shutil.copy('./testdata/daemonlog', logfilename)
+        self.assertEqual(3, self.catalog.add_daemonlog(logfilename))
+        self.assertEqual(0, self.catalog.add_daemonlog(logfilename))
+        for day in (date(2020, 4, 14), date(2020, 4, 15), date(2020, 4, 16)):
+            with open(logfilename) as daemonlog:
+                expected, _ = events_from_log.daemonlog_events_for_date(daemonlog, day)
+            events, _ = self.catalog.events_for_date(day)
+            self.assertEqual(expected, events)
+
+    def test_daemonlog_rotated(self):
+        logfilename = os.path.join(self.tmpdir, 'daemonlog')
+        with open('./testdata/daemonlog') as daemonlog:
+            lines = daemonlog.readlines()
+        with open(logfilename, 'w') as logfile:
+            logfile.writelines(lines[:len(lines) // 2])
+        self.catalog.add_daemonlog(logfilename)
+        # Starts like the old log and is already longer.
+        with open(logfilename, 'w') as logfile:
+            logfile.writelines(lines[:3] + lines[len(lines) // 3:])
+        self.catalog.add_daemonlog(logfilename)
+        for day in (date(2020, 4, 14), date(2020, 4, 15), date(2020, 4, 16)):
+            with open(logfilename) as daemonlog:
+                expected, _ = events_from_log.daemonlog_events_for_date(daemonlog, day)
+            events, _ = self.catalog.events_for_date(day)
+            self.assertEqual(expected, events)
+
+    def test_labels(self):
+        labelfilename = os.path.join(self.tmpdir, 'catlabels.csv')
+        with open('./catlabels.csv') as labels:
+            lines = labels.readlines()
+        with open(labelfilename, 'w') as labelfile:
+            labelfile.writelines(lines[:100])
+        self.catalog.add_labels(labelfilename)
+        with open(labelfilename, 'a') as labelfile:
+            labelfile.writelines(lines[100:])
+        # Only the new lines are read.
+        self.assertEqual(len(lines) - 100, self.catalog.add_labels(labelfilename))
+        # A file that was labelled twice has the later label.
+        latest = dict(line.split(',')[:2] for line in lines)
+        expected = sorted(name for name, label in latest.items()
+                          if label == 'cat arriving' and '-202003' in name)
+        arriving = self.catalog.labelled('cat arriving', date(2020, 3, 1), date(2020, 3, 31))
+        self.assertEqual(expected, [row[0] for row in arriving])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,438 @@
+import asyncio
+import cat_detector
+import catflap_daemon
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import dirwatch
+import mjpeg
+import os
+import send_msg
+import shutil
+import socket
+import tempfile
+import unittest
+
+MOTION = 'motion detected: 4142 changed pixels 76 x 64 at 274 80'
+SNAPSHOT = 'saved images/20-20200414190000-snapshot.jpg'
+
+
+def frame(event, idx):
+    return 'saved images/{0}-20200414194357-{1:02d}.jpg'.format(event, idx)
+
+
+class TestMessageQueue(unittest.TestCase):
+
+    def drain(self, queue):
+        messages = []
+        while not queue.empty():
+            messages.append(queue.get_nowait()[0].text)
+            queue.task_done()
+        return messages
+
+    def test_drop_new(self):
+        queue = catflap_daemon.MessageQueue(2, 'drop-new')
+        for m in (frame(20, 0), frame(20, 1), frame(20, 2)):
+            queue.put_nowait(m)
+        self.assertEqual([frame(20, 0), frame(20, 1)], self.drain(queue))
+        self.assertEqual(1, queue.dropped['new'])
+
+    def test_drop_oldest(self):
+        queue = catflap_daemon.MessageQueue(2, 'drop-oldest')
+        for m in (frame(20, 0), frame(20, 1), frame(20, 2)):
+            queue.put_nowait(m)
+        self.assertEqual([frame(20, 1), frame(20, 2)], self.drain(queue))
+        self.assertEqual(1, queue.dropped['oldest'])
+
+    def test_latest_wins(self):
+        queue = catflap_daemon.MessageQueue(10, 'latest-wins')
+        for m in (MOTION, frame(20, 0), MOTION, frame(21, 0), frame(20, 1)):
+            queue.put_nowait(m)
+        self.assertEqual([MOTION, MOTION, frame(21, 0), frame(20, 1)], self.drain(queue))
+        self.assertEqual(1, queue.dropped['stale frame'])
+
+    def test_latest_wins_keeps_motion(self):
+        queue = catflap_daemon.MessageQueue(3, 'latest-wins')
+        for m in (SNAPSHOT, MOTION, MOTION, frame(20, 0)):
+            queue.put_nowait(m)
+        self.assertEqual([MOTION, MOTION, frame(20, 0)], self.drain(queue))
+        self.assertEqual(1, queue.dropped['snapshot'])
+        self.assertEqual(0, queue.dropped['motion'])
+
+    def test_latest_wins_motion_first(self):
+        queue = catflap_daemon.MessageQueue(4, 'latest-wins')
+        for m in (MOTION, frame(20, 0), MOTION, frame(21, 0), MOTION):
+            queue.put_nowait(m)
+        self.assertEqual([MOTION, MOTION, frame(21, 0), MOTION], self.drain(queue))
+        self.assertEqual(1, queue.dropped['frame'])
+        self.assertEqual(0, queue.dropped['motion'])
+        # Nothing but motion messages left to drop.
+        queue = catflap_daemon.MessageQueue(2, 'latest-wins')
+        for m in (MOTION, MOTION, MOTION):
+            queue.put_nowait(m)
+        self.assertEqual(1, queue.dropped['motion'])
+
+    def test_priorities(self):
+        queue = catflap_daemon.MessageQueue()
+        for m in ('hello', SNAPSHOT, MOTION, frame(20, 0), MOTION):
+            queue.put_nowait(m)
+        self.assertEqual([MOTION, frame(20, 0), MOTION, SNAPSHOT, 'hello'], self.drain(queue))
+
+    def test_latency_stats(self):
+        latency = catflap_daemon.LatencyStats()
+        latency.add(0, 0.5)
+        latency.add(0, 1.5)
+        latency.add(1, 2.0)
+        self.assertEqual('urgent: 2 msgs avg 1.000s max 1.500s, '
+                         'snapshot: 1 msgs avg 2.000s max 2.000s', str(latency))
+
+
+class TestDirectoryWatcher(unittest.TestCase):
+
+    def test_saved_files(self):
+        async def watch(tmpdir, queue):
+            loop = asyncio.get_running_loop()
+            watcher = dirwatch.DirectoryWatcher(tmpdir,
+                    lambda filename: catflap_daemon.file_saved(queue, filename), loop)
+            watcher.start()
+            for name in ('20-20200414194357-00.jpg', 'lastsnap.jpg', '20-20200414190000-snapshot.jpg'):
+                with open(os.path.join(tmpdir, name), 'wb') as f:
+                    f.write(b'not really a jpg')
+            # A file moved in counts as saved, too.
+            with open(os.path.join(tmpdir, 'tmpfile'), 'wb') as f:
+                f.write(b'not really a jpg')
+            os.rename(os.path.join(tmpdir, 'tmpfile'), os.path.join(tmpdir, '20-20200414194357-01.jpg'))
+            for _ in range(100):
+                if queue.qsize() == 3:
+                    break
+                await asyncio.sleep(0.01)
+            watcher.close()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            queue = catflap_daemon.MessageQueue(policy='drop-new')
+            asyncio.run(watch(tmpdir, queue))
+            messages = []
+            while not queue.empty():
+                messages.append(queue.get_nowait()[0].text)
+            self.assertEqual(['saved {0}/20-20200414194357-00.jpg'.format(tmpdir),
+                'saved {0}/20-20200414194357-01.jpg'.format(tmpdir),
+                'saved {0}/20-20200414190000-snapshot.jpg'.format(tmpdir)], messages)
+
+
+class TestTCPServer(unittest.TestCase):
+
+    # Sends each list of chunks over its own connection and returns what was
+    # queued once there are count messages.
+    def receive(self, framing, connections, count):
+        async def serve():
+            loop = asyncio.get_running_loop()
+            queue = catflap_daemon.MessageQueue(policy='drop-new')
+            server = await loop.create_server(
+                    lambda: catflap_daemon.TCPServerProtocol(queue, framing), '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+
+            def send():
+                for chunks in connections:
+                    with socket.create_connection(('127.0.0.1', port)) as client:
+                        for chunk in chunks:
+                            client.sendall(chunk)
+            await loop.run_in_executor(None, send)
+            for _ in range(100):
+                if queue.qsize() >= count:
+                    break
+                await asyncio.sleep(0.01)
+            server.close()
+            messages = []
+            while not queue.empty():
+                messages.append(queue.get_nowait()[0].text)
+            return messages
+        return asyncio.run(serve())
+
+    def test_newline_framing(self):
+        data = b''.join(send_msg.frame(m) for m in (MOTION, frame(20, 0), MOTION))
+        # All in one read, and split in the middle of a message.
+        for connections in ([[data]], [[data[:10], data[10:70], data[70:]]]):
+            self.assertEqual([MOTION, frame(20, 0), MOTION], self.receive('newline', connections, 3))
+
+    def test_unframed_message(self):
+        # What nc or the old send_msg.py send.
+        self.assertEqual([MOTION], self.receive('newline', [[MOTION.encode('utf8')]], 1))
+
+    def test_length_framing(self):
+        data = b''.join(send_msg.frame(m, 'length') for m in (MOTION, frame(20, 0), MOTION))
+        self.assertEqual([MOTION, frame(20, 0), MOTION],
+                         self.receive('length', [[data[:2], data[2:70], data[70:]]], 3))
+
+    def test_message_too_long(self):
+        data = send_msg.LENGTH_PREFIX.pack(send_msg.MAX_MESSAGE_SIZE + 1)
+        self.assertEqual([MOTION], self.receive('length',
+            [[data + b'x' * 100], [send_msg.frame(MOTION, 'length')]], 1))
+
+    def test_bad_message(self):
+        data = send_msg.frame(MOTION) + b'\xff\xfe\n' + send_msg.frame(frame(20, 0))
+        # Bad lines are queued as unknown messages, and the connection stays
+        # open for what comes after them.
+        self.assertCountEqual([MOTION, '\ufffd\ufffd', frame(20, 0), MOTION, '\ufffd'],
+                              self.receive('newline', [[data, send_msg.frame(MOTION), b'\xff']], 5))
+
+    def test_persistent_client(self):
+        async def serve():
+            loop = asyncio.get_running_loop()
+            queue = catflap_daemon.MessageQueue(policy='drop-new')
+            connections = []
+
+            def protocol():
+                connections.append(1)
+                return catflap_daemon.TCPServerProtocol(queue)
+            server = await loop.create_server(protocol, '127.0.0.1', 0)
+            client = send_msg.MessageClient('127.0.0.1', server.sockets[0].getsockname()[1], 'TCP')
+            for _ in range(20):
+                await loop.run_in_executor(None, client.send, MOTION)
+            client.close()
+            for _ in range(100):
+                if queue.qsize() >= 20:
+                    break
+                await asyncio.sleep(0.01)
+            server.close()
+            return queue.qsize(), len(connections)
+        self.assertEqual((20, 1), asyncio.run(serve()))
+
+
+class TestUnixSockets(unittest.TestCase):
+
+    def receive(self, proto, messages):
+        async def serve(path):
+            loop = asyncio.get_running_loop()
+            queue = catflap_daemon.MessageQueue(policy='drop-new')
+            if proto == 'UNIX':
+                server = await loop.create_unix_server(
+                        lambda: catflap_daemon.TCPServerProtocol(queue), path)
+            else:
+                server = catflap_daemon.DatagramReader(
+                        catflap_daemon.datagram_socket(proto, '127.0.0.1', 0, path), queue, loop)
+                server.start()
+
+            def send():
+                client = send_msg.MessageClient(proto=proto, path=path)
+                for message in messages:
+                    client.send(message)
+                client.close()
+            await loop.run_in_executor(None, send)
+            for _ in range(100):
+                if queue.qsize() >= len(messages):
+                    break
+                await asyncio.sleep(0.01)
+            server.close()
+            received = []
+            while not queue.empty():
+                received.append(queue.get_nowait()[0].text)
+            return received
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            return asyncio.run(serve(os.path.join(tmpdir, 'catflap.sock')))
+
+    def test_unix_stream(self):
+        self.assertEqual([MOTION, frame(20, 0), MOTION], self.receive('UNIX', [MOTION, frame(20, 0), MOTION]))
+
+    def test_unix_datagrams(self):
+        messages = [MOTION, frame(20, 0)] * 50
+        self.assertEqual(messages, self.receive('UNIXDGRAM', messages))
+
+
+# Hands out datagrams, then fails like a UDP socket whose last send got
+# ECONNREFUSED.
+class FailingSocket(object):
+
+    def __init__(self, datagrams):
+        self._datagrams = list(datagrams)
+
+    def recv(self, size):
+        if self._datagrams:
+            return self._datagrams.pop(0)
+        raise ConnectionRefusedError('connection refused')
+
+
+class TestDatagramReader(unittest.TestCase):
+
+    def test_bad_datagrams(self):
+        queue = catflap_daemon.MessageQueue()
+        reader = catflap_daemon.DatagramReader(
+                FailingSocket([MOTION.encode('utf8'), b'\xff\xfe', frame(20, 0).encode('utf8')]),
+                queue)
+        reader._read()
+        received = []
+        while not queue.empty():
+            received.append(queue.get_nowait()[0])
+        self.assertEqual([MOTION, frame(20, 0)], [m.text for m in received if m.kind !=
+                                                  cat_detector.MessageKinds.unknown])
+        self.assertEqual(3, len(received))
+
+
+# A detector that remembers what it decided, and how often it looked for
+# lines itself.
+class RecordingDetector(cat_detector.CatDetector):
+
+    def __init__(self, statModel):
+        super().__init__(statModel)
+        self.decisions = []
+        self.get_coords_calls = 0
+
+    def handle_message(self, message, image=None, lines=None):
+        value = super().handle_message(message, image, lines)
+        self.decisions.append(value)
+        return value
+
+    def get_coords(self, image, motion=None, reduction=1):
+        self.get_coords_calls += 1
+        return super().get_coords(image, motion, reduction)
+
+
+class TestMotionWorker(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cat_detector.CatDetector.setupCatDetector(modelfile=None,
+                trainingfile='./catlabels.csv', cachedir=None)
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        # Frames of three events, and a box around all of the image.
+        for event in (20, 21, 22):
+            for idx in (0, 1):
+                shutil.copy('images/20-20200414194357-0{0}.jpg'.format(idx),
+                            cls.frame(event, idx))
+        box = 'motion detected: 4142 changed pixels 600 x 400 at 320 240'
+        cls.messages = [MOTION, 'saved ' + cls.frame(20, 0), SNAPSHOT, MOTION,
+                        'saved ' + cls.frame(20, 1),
+                        'saved ' + cls.frame(21, 0), box, box, 'saved ' + cls.frame(21, 1),
+                        'saved ' + cls.frame(22, 0), 'saved ' + cls.frame(22, 1), MOTION]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    @classmethod
+    def frame(cls, event, idx):
+        return os.path.join(cls.tmpdir.name, '{0}-20200414194357-{1:02d}.jpg'.format(event, idx))
+
+    # Runs the messages through motion_worker() and returns the detector.
+    def run_worker(self, executor=None, feature_mode='motion'):
+        detector = RecordingDetector(cat_detector.CatDetector.statModel)
+        detector.feature_mode = feature_mode
+
+        async def run():
+            queue = catflap_daemon.MessageQueue(policy='drop-new')
+            for message in self.messages:
+                queue.put_nowait(message)
+            task = asyncio.ensure_future(catflap_daemon.motion_worker(queue, detector, executor))
+            for _ in range(500):
+                if len(detector.decisions) >= len(self.messages):
+                    break
+                await asyncio.sleep(0.01)
+            task.cancel()
+        asyncio.run(run())
+        return detector
+
+    # Decoding in a pool gives the same decisions, in the same order, as
+    # doing everything on the event loop.
+    def test_executors(self):
+        for feature_mode in ('motion', 'roi'):
+            expected = self.run_worker(feature_mode=feature_mode).decisions
+            self.assertEqual(len(self.messages), len(expected))
+            for executor in (ThreadPoolExecutor(2), ProcessPoolExecutor(2)):
+                with executor:
+                    detector = self.run_worker(executor, feature_mode)
+                self.assertEqual(expected, detector.decisions)
+                # Lines are only looked for in the executor.
+                self.assertEqual(0, detector.get_coords_calls)
+
+    def test_decode_worker(self):
+        detector = RecordingDetector(cat_detector.CatDetector.statModel)
+        detector.parse_message(MOTION)
+        detector.parse_message('saved ' + self.frame(20, 0))
+
+        async def run(executor):
+            queue = catflap_daemon.MessageQueue(policy='drop-new')
+            pending = asyncio.Queue()
+            # Event 20 is decided, so its frames aren't decoded.
+            for message in ('saved ' + self.frame(20, 1), SNAPSHOT, 'saved ' + self.frame(21, 0)):
+                queue.put_nowait(message)
+            task = asyncio.ensure_future(
+                catflap_daemon.decode_worker(queue, pending, executor, detector))
+            results = []
+            for _ in range(3):
+                msg, _, _, future = await pending.get()
+                results.append((msg.kind, None if future is None else (await future)[0].shape))
+            task.cancel()
+            return results
+        with ThreadPoolExecutor(2) as executor:
+            self.assertEqual([(cat_detector.MessageKinds.frame, None),
+                              (cat_detector.MessageKinds.frame, (240, 320)),
+                              (cat_detector.MessageKinds.snapshot, (240, 320))],
+                             asyncio.run(run(executor)))
+
+
+# Serves jpegs the way motion's stream does, with or without Content-Length.
+async def serve_stream(jpegs, content_length=True):
+    async def handle(reader, writer):
+        await reader.readuntil(b'\r\n\r\n')
+        writer.write(b'HTTP/1.0 200 OK\r\nServer: Motion\r\n'
+                     b'Content-Type: multipart/x-mixed-replace; boundary=BoundaryString\r\n\r\n')
+        for jpeg in jpegs:
+            writer.write(b'--BoundaryString\r\nContent-type: image/jpeg\r\n')
+            if content_length:
+                writer.write('Content-Length: {0}\r\n'.format(len(jpeg)).encode('ascii'))
+            writer.write(b'\r\n' + jpeg + b'\r\n')
+        writer.write(b'--BoundaryString--\r\n')
+        await writer.drain()
+        writer.close()
+    return await asyncio.start_server(handle, '127.0.0.1', 0)
+
+
+class TestStream(unittest.TestCase):
+
+    def setUp(self):
+        with open('images/20-20200414194357-00.jpg', 'rb') as f:
+            self.first = f.read()
+        with open('images/20-20200414194357-01.jpg', 'rb') as f:
+            self.second = f.read()
+
+    def read_frames(self, content_length):
+        async def read():
+            server = await serve_stream([self.first, self.second], content_length)
+            port = server.sockets[0].getsockname()[1]
+            frames = mjpeg.StreamFrames()
+            task = asyncio.ensure_future(mjpeg.stream_worker('127.0.0.1', port, frames))
+            for _ in range(100):
+                if frames.count >= 2:
+                    break
+                await asyncio.sleep(0.01)
+            task.cancel()
+            server.close()
+            return frames
+        return asyncio.run(read())
+
+    def test_read_stream(self):
+        for content_length in (True, False):
+            frames = self.read_frames(content_length)
+            self.assertEqual([self.first, self.second], [jpeg for _, jpeg in frames._frames])
+
+    def test_decode_from_memory(self):
+        image = cat_detector.decode_image(self.first)
+        expected = cat_detector.read_image('images/20-20200414194357-00.jpg')
+        self.assertEqual(expected.shape, image.shape)
+        self.assertTrue((expected == image).all())
+
+    def test_pairing(self):
+        frames = mjpeg.StreamFrames()
+        frames.add(self.first, received=10.0)
+        frames.add(self.second, received=10.5)
+        pairing = catflap_daemon.StreamPairing(frames, max_skew=1.0)
+        motion = cat_detector.parse(MOTION)
+        saved = cat_detector.parse(frame(20, 0))
+        # Without a motion message, the save message's own time counts.
+        self.assertIs(self.second, pairing.jpeg_for(saved, 10.6))
+        self.assertIsNone(pairing.jpeg_for(motion, 10.1))
+        self.assertIs(self.first, pairing.jpeg_for(saved, 10.9))
+        # Too long after anything in the stream.
+        self.assertIsNone(pairing.jpeg_for(saved, 20.0))
+
+
+if __name__ == "__main__":
+    unittest.main()
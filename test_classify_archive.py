@@ -0,0 +1,60 @@
+import cat_detector
+import classify_archive
+import cv2
+from datetime import date
+import numpy as np
+import os
+import tempfile
+import unittest
+
+NAMES = ('20-20200414194357-00.jpg', '20-20200414194357-01.jpg', '21-20200414200101-00.jpg',
+         '20-20200414190000-snapshot.jpg', '22-20200415080000-00.jpg')
+
+
+class TestClassifyArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.imagedir = self.tmpdir.name
+        img = np.zeros((480, 640, 3), np.uint8)
+        cv2.rectangle(img, (200, 100), (400, 300), (255, 255, 255), 3)
+        for name in NAMES:
+            cv2.imwrite(os.path.join(self.imagedir, name), img)
+        # Nothing to find on this one.
+        cv2.imwrite(os.path.join(self.imagedir, '21-20200414200101-01.jpg'),
+                    np.zeros((480, 640, 3), np.uint8))
+        self.modelfile = cat_detector.trained_model('./catlabels.csv',
+                                                    os.path.join(self.imagedir, 'cache'))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_list_frames(self):
+        frames = classify_archive.list_frames(self.imagedir, last=date(2020, 4, 14))
+        self.assertEqual([('2020-04-14', 20, 0, NAMES[0]), ('2020-04-14', 20, 1, NAMES[1]),
+                          ('2020-04-14', 21, 0, NAMES[2]),
+                          ('2020-04-14', 21, 1, '21-20200414200101-01.jpg')], frames)
+
+    def test_same_as_detector(self):
+        columns = classify_archive.classify_archive(self.imagedir, self.modelfile,
+                                                    workers=2, chunksize=2)
+        self.assertEqual(5, len(columns['filename']))
+        self.assertEqual([20, 21, 22], list(columns['event_id']))
+        self.assertEqual([2, 2, 1], list(columns['event_frames']))
+        cat_detector.CatDetector.setupCatDetector(self.modelfile, None)
+        detector = cat_detector.CatDetector.makeCatDetector()
+        for i, name in enumerate(columns['filename']):
+            img = cv2.imread(os.path.join(self.imagedir, name))
+            self.assertEqual(detector.evaluate_motion_and_image(None, img), columns['label'][i])
+        self.assertTrue(np.isnan(columns['left'][3]))
+        self.assertEqual(0, columns['label'][3])
+
+    def test_event_decision(self):
+        self.assertEqual(3, classify_archive.event_decision([1, 1, 3, 0]))
+        self.assertEqual(0, classify_archive.event_decision([0, 3]))
+        self.assertEqual(1, classify_archive.event_decision([1, -1]))
+        self.assertEqual(3, classify_archive.event_decision([-1, 3]))
+
+
+if __name__ == "__main__":
+    unittest.main()
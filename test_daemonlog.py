@@ -0,0 +1,84 @@
+import daemonlog
+from daemonlog import log
+import events_from_log
+import io
+import json
+import unittest
+
+MOTION = 'motion detected: 4142 changed pixels 76 x 64 at 274 80'
+
+
+class TestDaemonLog(unittest.TestCase):
+
+    def tearDown(self):
+        daemonlog.stop()
+
+    def test_text(self):
+        out = io.StringIO()
+        daemonlog.start(stream=out)
+        daemonlog.received(MOTION)
+        daemonlog.decision('got motion but no image')
+        log.info('queue length %d', 3)
+        log.debug('not written at INFO level')
+        daemonlog.stop()
+        lines = out.getvalue().splitlines()
+        self.assertEqual(3, len(lines))
+        self.assertTrue(lines[0].endswith(': received message ' + MOTION))
+        self.assertTrue(lines[1].endswith(': got motion but no image'))
+        self.assertEqual('queue length 3', lines[2])
+        # events_from_log.py can still read it.
+        self.assertEqual(1, len(events_from_log.daemonlog_datelist(lines)))
+
+    def test_json(self):
+        out = io.StringIO()
+        daemonlog.start(level='DEBUG', format='json', stream=out)
+        daemonlog.received(MOTION)
+        log.debug('found %d lines', 4)
+        daemonlog.stop()
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([('INFO', 'received', MOTION), ('DEBUG', 'log', 'found 4 lines')],
+                         [(r['level'], r['kind'], r['message']) for r in records])
+
+    def test_full_buffer_drops(self):
+        out = io.StringIO()
+        # Long enough that the writer doesn't get to run in between.
+        daemonlog.start(stream=out, maxsize=5, interval=60)
+        for i in range(8):
+            log.info('message %d', i)
+        self.assertEqual(3, daemonlog.dropped())
+        daemonlog.stop()
+        self.assertEqual(['message %d' % i for i in range(5)], out.getvalue().splitlines())
+
+
+    def test_full_buffer_keeps_messages_and_decisions(self):
+        out = io.StringIO()
+        daemonlog.start(stream=out, maxsize=2, interval=60)
+        for i in range(4):
+            log.info('message %d', i)
+            daemonlog.received(MOTION)
+            daemonlog.decision('decision %d' % i)
+        log.error('something broke')
+        # The first message filled the buffer together with the first
+        # received message and decision.
+        self.assertEqual(3, daemonlog.dropped())
+        daemonlog.stop()
+        lines = out.getvalue().splitlines()
+        self.assertEqual(['message 0'], [l for l in lines if l.startswith('message')])
+        self.assertEqual(4, len([l for l in lines if l.endswith(': received message ' + MOTION)]))
+        self.assertEqual(['decision %d' % i for i in range(4)],
+                         [l.split(': ')[-1] for l in lines if ': decision' in l])
+        self.assertEqual('something broke', lines[-1])
+
+    def test_full_buffer_drops_messages_eventually(self):
+        out = io.StringIO()
+        daemonlog.start(stream=out, maxsize=2, event_maxsize=5, interval=60)
+        for i in range(4):
+            daemonlog.received(MOTION)
+            daemonlog.decision('decision %d' % i)
+        self.assertEqual(3, daemonlog.dropped_events())
+        self.assertEqual(0, daemonlog.dropped())
+        daemonlog.stop()
+        self.assertEqual(5, len(out.getvalue().splitlines()))
+
+if __name__ == "__main__":
+    unittest.main()
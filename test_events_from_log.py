@@ -0,0 +1,113 @@
+from datetime import date
+import events_from_log
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+DATES = (date(2020, 4, 14), date(2020, 4, 15), date(2020, 4, 16))
+
+
+class TestDaemonLogIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.logfilename = os.path.join(self.tmpdir, 'daemonlog')
+        with open('./testdata/daemonlog') as daemonlog:
+            self.lines = daemonlog.readlines()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_log(self, lines, mode='w'):
+        with open(self.logfilename, mode) as logfile:
+            logfile.writelines(lines)
+
+    def assertSameAsScan(self):
+        with open(self.logfilename) as daemonlog:
+            self.assertEqual(events_from_log.daemonlog_datelist(daemonlog),
+                             events_from_log.indexed_datelist(self.logfilename))
+        for day in DATES:
+            with open(self.logfilename) as daemonlog:
+                expected = events_from_log.daemonlog_events_for_date(daemonlog, day)
+            self.assertEqual(expected, events_from_log.indexed_events_for_date(self.logfilename, day))
+
+    def test_same_as_scan(self):
+        self.write_log(self.lines)
+        self.assertSameAsScan()
+        self.assertTrue(os.path.exists(self.logfilename + '.idx'))
+
+    def test_incremental(self):
+        half = len(self.lines) // 2
+        self.write_log(self.lines[:half])
+        index = events_from_log.DaemonLogIndex(self.logfilename).update()
+        self.assertEqual(os.path.getsize(self.logfilename), index._state['size'])
+        # A line that is still being written isn't indexed yet.
+        self.write_log(self.lines[half:] + ['2020-04-16-23:59:59:000000: received'], 'a')
+        index = events_from_log.DaemonLogIndex(self.logfilename).update()
+        self.assertEqual(os.path.getsize(self.logfilename) - len('2020-04-16-23:59:59:000000: received'),
+                         index._state['size'])
+        self.write_log(self.lines)
+        self.assertSameAsScan()
+
+    def test_rotated(self):
+        self.write_log(self.lines)
+        events_from_log.DaemonLogIndex(self.logfilename).update()
+        # Replaced by a shorter log.
+        self.write_log(self.lines[100:150])
+        self.assertSameAsScan()
+
+    def test_rotated_and_grown(self):
+        half = len(self.lines) // 2
+        self.write_log(self.lines[:half])
+        events_from_log.DaemonLogIndex(self.logfilename).update()
+        # A new log that starts the same way and is already longer than
+        # the old one.
+        self.write_log(self.lines[:3] + self.lines[len(self.lines) // 3:])
+        self.assertGreater(os.path.getsize(self.logfilename),
+                           events_from_log.DaemonLogIndex(self.logfilename)._state['size'])
+        self.assertSameAsScan()
+
+    def test_event_lines(self):
+        self.write_log(self.lines)
+        index = events_from_log.DaemonLogIndex(self.logfilename).update()
+        for event_id in index.events('2020-04-14'):
+            events, _ = events_from_log.daemonlog_events_for_date(
+                    index.lines_for_event('2020-04-14', event_id), DATES[0])
+            with open(self.logfilename) as daemonlog:
+                expected, _ = events_from_log.daemonlog_events_for_date(daemonlog, DATES[0])
+            self.assertEqual(expected[event_id], events[event_id])
+
+
+class TestDaemonLogs(unittest.TestCase):
+
+    def test_rotated_logs(self):
+        with open('./testdata/daemonlog') as daemonlog:
+            lines = daemonlog.readlines()
+        split = min(i for i, line in enumerate(lines) if line.startswith('2020-04-15'))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            older = os.path.join(tmpdir, 'daemonlog.1.gz')
+            newer = os.path.join(tmpdir, 'daemonlog')
+            with gzip.open(older, 'wt') as logfile:
+                logfile.writelines(lines[:split])
+            with open(newer, 'w') as logfile:
+                logfile.writelines(lines[split:])
+            results = events_from_log.daemonlog_events([newer, older], workers=2)
+        self.assertEqual(set(DATES), set(results))
+        for day in DATES:
+            self.assertEqual(events_from_log.daemonlog_events_for_date(lines, day), results[day])
+
+    def test_merge(self):
+        merged = ({'20': [{'timeofday': '10:00:01:000000:', 'idx': '01'}]}, {})
+        events_from_log.merge_events(merged,
+            {'20': [{'timeofday': '10:00:00:000000:', 'idx': '00'}],
+             '21': [{'timeofday': '11:00:00:000000:', 'idx': '00'}]},
+            {'2020041410': {'id': '19'}})
+        self.assertEqual(['00', '01'], [f['idx'] for f in merged[0]['20']])
+        self.assertEqual(['20', '21'], sorted(merged[0]))
+        self.assertEqual(['2020041410'], list(merged[1]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+import cv2
+import daemonlog
+import featurestore
+import io
+import numpy as np
+import os
+import tempfile
+import time
+import unittest
+from cat_detector import CatDetector
+from trainer import Trainer
+
+
+class TestFeatureStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.imagedir = os.path.join(self.tmpdir.name, 'images')
+        os.mkdir(self.imagedir)
+        self.storefile = os.path.join(self.tmpdir.name, 'features.bin')
+        self.write_image('20-20200414194357-00.jpg', (200, 100), (400, 300))
+        self.write_image('20-20200414194357-01.jpg', (100, 50), (300, 250))
+        cv2.imwrite(os.path.join(self.imagedir, '20-20200414194357-02.jpg'),
+                    np.zeros((480, 640, 3), np.uint8))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_image(self, name, topleft, bottomright):
+        img = np.zeros((480, 640, 3), np.uint8)
+        cv2.rectangle(img, topleft, bottomright, (255, 255, 255), 3)
+        cv2.imwrite(os.path.join(self.imagedir, name), img)
+
+    def expected(self, name):
+        img = cv2.imread(os.path.join(self.imagedir, name), cv2.IMREAD_GRAYSCALE)
+        return np.array(CatDetector(None).get_coords(img), dtype=np.float32)
+
+    def test_update(self):
+        store = featurestore.FeatureStore(self.storefile)
+        self.assertEqual(3, store.update(self.imagedir, workers=2, chunksize=2))
+        # Read back from the file.
+        store = featurestore.FeatureStore(self.storefile)
+        self.assertEqual(3, len(store))
+        for name in ('20-20200414194357-00.jpg', '20-20200414194357-01.jpg'):
+            np.testing.assert_array_equal(self.expected(name), store.features_for(name))
+        self.assertIn('20-20200414194357-02.jpg', store)
+        self.assertIsNone(store.features_for('20-20200414194357-02.jpg'))
+        self.assertIsNone(store.features_for('21-20200414194357-00.jpg'))
+        # Only new and changed frames are looked at again.
+        self.assertEqual(0, store.update(self.imagedir))
+        time.sleep(0.01)
+        self.write_image('20-20200414194357-01.jpg', (250, 150), (350, 250))
+        self.write_image('21-20200414200101-00.jpg', (100, 100), (200, 200))
+        self.assertEqual(2, store.update(self.imagedir, workers=1))
+        store = featurestore.FeatureStore(self.storefile)
+        self.assertEqual(4, len(store))
+        np.testing.assert_array_equal(self.expected('20-20200414194357-01.jpg'),
+                                      store.features_for('20-20200414194357-01.jpg'))
+
+    def test_gone_unreadable_and_long_names(self):
+        store = featurestore.FeatureStore(self.storefile)
+        store.update(self.imagedir, workers=1)
+        os.remove(os.path.join(self.imagedir, '20-20200414194357-00.jpg'))
+        with open(os.path.join(self.imagedir, '21-20200414200101-00.jpg'), 'wb') as f:
+            f.write(b'not a jpeg')
+        self.write_image('12345678901-20200414200101-00.jpg', (100, 100), (200, 200))
+        out = io.StringIO()
+        daemonlog.start(stream=out)
+        try:
+            self.assertEqual(1, store.update(self.imagedir, workers=1))
+        finally:
+            daemonlog.stop()
+        self.assertIn('12345678901-20200414200101-00.jpg is too long', out.getvalue())
+        store = featurestore.FeatureStore(self.storefile)
+        self.assertEqual(['20-20200414194357-01.jpg', '20-20200414194357-02.jpg'],
+                         sorted(store._index))
+        # The unreadable frame is tried again next time.
+        self.assertEqual(1, store.update(self.imagedir, workers=1))
+
+    def test_extractor_version(self):
+        featurestore.FeatureStore(self.storefile).update(self.imagedir, workers=1)
+        version = CatDetector.feature_version
+        try:
+            CatDetector.feature_version = version + 1
+            store = featurestore.FeatureStore(self.storefile)
+            self.assertEqual(0, len(store))
+            self.assertEqual(3, store.update(self.imagedir, workers=1))
+        finally:
+            CatDetector.feature_version = version
+
+    def test_trainer(self):
+        featurestore.FeatureStore(self.storefile).update(self.imagedir, workers=1)
+        store = featurestore.FeatureStore(self.storefile)
+        labels = ['filename,action,left,right,top,bottom\n',
+                  self.imagedir + '/20-20200414194357-00.jpg,cat arriving,unknown\n',
+                  '20-20200414194357-01.jpg,cat leaving,1,2,3,4\n',
+                  '20-20200414194357-02.jpg,no cat,unknown\n']
+        trainer = Trainer()
+        trainer.addTrainingDataFromFile(labels, store)
+        self.assertEqual([3, 2], trainer.labels)
+        self.assertEqual(list(self.expected('20-20200414194357-01.jpg')), trainer.features[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import cat_detector
+import catflap_daemon
+from datetime import date, datetime
+import journal
+import os
+import tempfile
+import time
+import unittest
+
+MOTION = 'motion detected: 4142 changed pixels 76 x 64 at 274 80'
+OTHER_MOTION = 'motion detected: 3000 changed pixels 50 x 60 at 200 90'
+
+
+class TestJournal(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cat_detector.CatDetector.setupCatDetector(modelfile=None,
+                trainingfile='./catlabels.csv', cachedir=None)
+
+    def test_round_trip(self):
+        detector = cat_detector.CatDetector.makeCatDetector()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'journal')
+            # A fixed clock, so the records don't straddle midnight.
+            recorder = catflap_daemon.JournalRecorder(journal.Journal(filename),
+                    clock=lambda: datetime(2020, 4, 14, 19, 43, 57))
+            for text in (MOTION, 'saved images/20-20200414194357-00.jpg',
+                         'saved images/20-20200414194357-01.jpg', OTHER_MOTION,
+                         'saved images/20-20200414190000-snapshot.jpg',
+                         # parse() takes a frame index that isn't a number.
+                         'saved images/21-20200414194357-xx.jpg'):
+                msg = cat_detector.parse(text)
+                value = detector.handle_message(msg)
+                recorder.record(msg, time.monotonic(), detector, value)
+            recorder.journal.close()
+            with open(filename) as journalfile:
+                events, snapshots = journal.journal_events_for_date(journalfile, date(2020, 4, 14))
+        self.assertEqual(['20', '21'], list(events.keys()))
+        self.assertEqual(['xx'], [f['idx'] for f in events['21']])
+        frames = events['20']
+        self.assertEqual(['00', '01'], [f['idx'] for f in frames])
+        self.assertEqual((4142, 76, 64, 274, 80), tuple(frames[0][k] for k in
+            ('changedpixels', 'width', 'height', 'x', 'y')))
+        # The second frame came before its motion message, so it was written
+        # twice and the record with the motion wins.
+        self.assertEqual(3000, frames[1]['changedpixels'])
+        self.assertEqual(4, len(frames[0]['features']))
+        self.assertTrue(frames[0]['decision'].startswith('event 20 image 1'))
+        self.assertEqual(['2020041419'], list(snapshots.keys()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+import cv2
+import knn
+import numpy as np
+import os
+import tempfile
+from trainer import Trainer
+import unittest
+
+
+class TestKNearest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        trainer = Trainer()
+        with open('./catlabels.csv', 'r') as labelfile:
+            trainer.addTrainingDataFromFile(labelfile)
+        cls.samples, cls.labels = trainer.makeTrainingData()
+        rng = np.random.default_rng(7)
+        # Integer coordinates like the real features, so there are plenty of
+        # ties in distance.
+        cls.queries = np.vstack((cls.samples,
+            rng.integers(0, 320, size=(500, 4)).astype(np.float32)))
+
+    def opencv_results(self, k):
+        model = cv2.ml.KNearest_create()
+        model.setDefaultK(k)
+        model.train(samples=self.samples, layout=cv2.ml.ROW_SAMPLE, responses=self.labels)
+        return model.predict(self.queries)
+
+    def test_same_as_opencv(self):
+        for k in (1, 3, 10):
+            expected_retval, expected = self.opencv_results(k)
+            retval, results = knn.KNearest(self.samples, self.labels, k=k).predict(self.queries)
+            self.assertEqual(expected_retval, retval)
+            self.assertTrue(np.array_equal(expected, results), 'k=%d' % k)
+
+    def test_small_batches(self):
+        model = knn.KNearest(self.samples, self.labels, k=3)
+        _, expected = model.predict(self.queries)
+        model.batch_size = 7
+        _, results = model.predict(self.queries)
+        self.assertTrue(np.array_equal(expected, results))
+
+    def test_tree_indexes(self):
+        _, expected = self.opencv_results(5)
+        for index in ('kdtree', 'balltree'):
+            try:
+                model = knn.KNearest(self.samples, self.labels, k=5, index=index)
+            except ImportError:
+                continue
+            _, results = model.predict(self.queries)
+            self.assertTrue(np.array_equal(expected, results), index)
+
+    def test_load_opencv_model(self):
+        model = knn.load_opencv_model('./catflapmodel.knn')
+        self.assertEqual(3, model.getDefaultK())
+        opencv_model = cv2.ml.KNearest_load('./catflapmodel.knn')
+        _, expected = opencv_model.predict(self.queries)
+        _, results = model.predict(self.queries)
+        self.assertTrue(np.array_equal(expected, results))
+
+    def test_binary_model(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'model.knnb')
+            model = knn.convert_opencv_model('./catflapmodel.knn', filename)
+            loaded = knn.load_binary_model(filename)
+            self.assertEqual(model.k, loaded.k)
+            self.assertTrue(np.array_equal(model.samples, loaded.samples))
+            self.assertTrue(np.array_equal(model.classes, loaded.classes))
+            _, expected = model.predict(self.queries)
+            _, results = loaded.predict(self.queries)
+            self.assertTrue(np.array_equal(expected, results))
+            _, results = knn.load_binary_as_opencv(filename).predict(self.queries)
+            self.assertTrue(np.array_equal(expected, results))
+            del loaded
+
+    def test_binary_model_prepared(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'model.knnb')
+            knn.save_binary_model(filename, self.samples, self.labels, 3)
+            loaded = knn.load_binary_model(filename)
+            # Loaded from the file, not worked out.
+            self.assertIsInstance(loaded._norms.base, np.memmap)
+            model = knn.KNearest(self.samples, self.labels, k=3)
+            model.prepare()
+            self.assertTrue(np.array_equal(model._norms, loaded._norms))
+            self.assertTrue(np.array_equal(model._onehot_responses, loaded._onehot_responses))
+            _, expected = model.predict(self.queries)
+            del loaded
+            # A version 1 file is the same without what prepare() works out.
+            rows = len(self.samples)
+            with open(filename, 'r+b') as f:
+                header = bytearray(f.read(knn.BINARY_HEADER.size))
+                header[8:12] = (1).to_bytes(4, 'little')
+                f.seek(0)
+                f.write(header)
+                f.truncate(knn._binary_layout(4, len(model.classes)) + rows * 5 * 4)
+            _, results = knn.load_binary_model(filename).predict(self.queries)
+            self.assertTrue(np.array_equal(expected, results))
+
+    def test_binary_model_bad_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'model.knnb')
+            with open(filename, 'wb') as f:
+                f.write(b'not a model, just some bytes in a file')
+            self.assertRaises(ValueError, knn.load_binary_model, filename)
+            knn.save_binary_model(filename, self.samples, self.labels, 3,
+                    features=('a', 'b', 'c', 'd'))
+            self.assertRaises(ValueError, knn.load_binary_model, filename)
+
+
+if __name__ == "__main__":
+    unittest.main()
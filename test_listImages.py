@@ -0,0 +1,73 @@
+from datetime import date
+import listImages
+import numpy as np
+import os
+import tempfile
+import time
+import unittest
+
+
+class TestImageDirIndex(unittest.TestCase):
+
+    def test_index(self):
+        with tempfile.TemporaryDirectory() as imagedir:
+            for name in ('20-20200414194357-01.jpg', '20-20200414194357-00.jpg',
+                         '20-20200414190000-snapshot.jpg', '25-20200420080000-00.jpg', 'lastsnap.jpg'):
+                open(os.path.join(imagedir, name), 'w').close()
+            index = listImages.ImageDirIndex(imagedir).refresh()
+            self.assertEqual([date(2020, 4, 14), date(2020, 4, 20)], index.dates())
+            events, snapshots = index.events_for_date(date(2020, 4, 14))
+            self.assertEqual(['00', '01'], [e['idx'] for e in events['20']])
+            self.assertEqual('194357', events['20'][0]['timeofday'])
+            self.assertEqual('20-20200414190000-snapshot.jpg', snapshots['19']['filename'])
+            self.assertEqual(date(2020, 4, 20), index.next_date_after(date(2020, 4, 14)))
+            self.assertIsNone(index.next_date_after(date(2020, 4, 20)))
+            # New files show up once the directory has changed.
+            time.sleep(0.01)
+            open(os.path.join(imagedir, '26-20200422080000-00.jpg'), 'w').close()
+            self.assertEqual(date(2020, 4, 22), index.refresh().next_date_after(date(2020, 4, 20)))
+
+
+class TestFrameCache(unittest.TestCase):
+
+    def setUp(self):
+        self.reads = []
+
+    def read(self, filename):
+        self.reads.append(filename)
+        return np.zeros((10, 10, 3), np.uint8)
+
+    def test_least_recently_used(self):
+        # Room for two frames.
+        cache = listImages.FrameCache(maxbytes=600, read=self.read)
+        cache.get('a')
+        cache.get('b')
+        cache.get('a')
+        cache.get('c')
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        cache.get('a')
+        self.assertEqual(['a', 'b', 'c'], self.reads)
+
+    def test_prefetch(self):
+        cache = listImages.FrameCache(read=self.read)
+        cache.prefetch(['a', 'b', 'c'])
+        for _ in range(100):
+            if 'c' in cache:
+                break
+            time.sleep(0.01)
+        cache.get('b')
+        self.assertEqual(['a', 'b', 'c'], self.reads)
+
+    def test_frames_to_prefetch(self):
+        frames = [{'filename': '%d.jpg' % i} for i in range(6)]
+        following = [{'filename': 'next-%d.jpg' % i} for i in range(6)]
+        self.assertEqual(['/x/3.jpg', '/x/1.jpg', '/x/4.jpg', '/x/5.jpg',
+                          '/x/next-0.jpg', '/x/next-1.jpg', '/x/next-2.jpg'],
+                         listImages.frames_to_prefetch('/x/', frames, 2, following))
+        self.assertEqual(following, listImages.next_event({'20': frames, '3': [], '100': following}, '20'))
+        self.assertEqual([], listImages.next_event({'20': frames}, '20'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import io
+import knn
+import numpy as np
+import trainer
+import unittest
+
+
+class TestCrossValidation(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.trainer = trainer.Trainer()
+        with open('./catlabels.csv', 'r') as labelfile:
+            cls.trainer.addTrainingDataFromFile(labelfile)
+        cls.samples, cls.labels = cls.trainer.makeTrainingData()
+
+    def test_stratified_folds(self):
+        folds = trainer.stratified_folds(self.labels, 5)
+        self.assertEqual(list(range(len(self.labels))), sorted(np.concatenate(folds)))
+        labels = self.labels.reshape(-1)
+        for label in np.unique(labels):
+            counts = [np.count_nonzero(labels[fold] == label) for fold in folds]
+            self.assertLessEqual(max(counts) - min(counts), 1)
+
+    def test_cross_validate(self):
+        folds = trainer.stratified_folds(self.labels, 5)
+        confmatrix = trainer.cross_validate(self.samples, self.labels, 3, 'none', folds)
+        self.assertEqual(len(self.labels), confmatrix.sum())
+        # The first fold, by hand.
+        train = np.setdiff1d(np.arange(len(self.labels)), folds[0])
+        model = knn.KNearest(self.samples[train], self.labels[train], k=3)
+        _, results = model.predict(self.samples[folds[0]])
+        expected = np.zeros((4, 4), dtype=np.int32)
+        np.add.at(expected, (self.labels[folds[0]].reshape(-1).astype(np.int32),
+                             results.reshape(-1).astype(np.int32)), 1)
+        self.assertTrue(np.array_equal(expected, trainer.cross_validate(
+            self.samples, self.labels, 3, 'none', folds[:1])))
+
+    def test_grid(self):
+        results = self.trainer.crossValidate([1, 3], ['none', 'minmax'], folds=3, workers=2)
+        self.assertEqual({(1, 'none'), (1, 'minmax'), (3, 'none'), (3, 'minmax')}, set(results))
+        for confmatrix in results.values():
+            self.assertEqual(len(self.labels), confmatrix.sum())
+
+    def test_bad_settings(self):
+        with self.assertRaises(ValueError):
+            self.trainer.crossValidate([1], ['none'], folds=1)
+        with self.assertRaises(ValueError):
+            self.trainer.crossValidate([1], ['none', 'log'], folds=3)
+
+
+class TestTestFile(unittest.TestCase):
+
+    def test_read_labelled_samples(self):
+        labelfile = io.StringIO('filename,action,left,right,top,bottom\n'
+                                'a.jpg,cat arriving,151,207,0,180\n'
+                                'b.jpg,no cat,unknown\n'
+                                'c.jpg,cat leaving,103,202,124,239\n')
+        filenames, labels, samples = trainer.read_labelled_samples(labelfile)
+        self.assertEqual(['a.jpg', 'c.jpg'], filenames)
+        self.assertEqual(['cat arriving', 'cat leaving'], labels)
+        self.assertTrue(np.array_equal(np.array([[151, 207, 0, 180], [103, 202, 124, 239]],
+                                                dtype=np.float32), samples))
+
+    def test_bad_coordinates(self):
+        labelfile = io.StringIO('filename,action,left,right,top,bottom\n'
+                                'a.jpg,cat arriving,151,x,0,180\n')
+        with self.assertRaises(ValueError):
+            trainer.read_labelled_samples(labelfile)
+
+    def test_no_samples(self):
+        t = trainer.Trainer()
+        with open('./catlabels.csv', 'r') as labelfile:
+            t.addTrainingDataFromFile(labelfile)
+        t.trainClassifier()
+        for text in ('', 'filename,action,left,right,top,bottom\nb.jpg,no cat,unknown\n'):
+            filenames, labels, samples = trainer.read_labelled_samples(io.StringIO(text))
+            self.assertEqual(([], []), (filenames, labels))
+            self.assertEqual((0, 4), samples.shape)
+            self.assertEqual(0, len(t.testSamples(samples)))
+
+    def test_same_as_one_by_one(self):
+        t = trainer.Trainer()
+        with open('./catlabels.csv', 'r') as labelfile:
+            t.addTrainingDataFromFile(labelfile)
+        t.trainClassifier()
+        with open('./catlabels.csv', 'r') as labelfile:
+            _, _, samples = trainer.read_labelled_samples(labelfile)
+        results = t.testSamples(samples)
+        self.assertEqual([int(t.testModel(s)) for s in samples], list(results))
+        self.assertEqual('cat arriving', trainer.Trainer.string_for_label(results[0]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,94 @@
+from concurrent.futures import ProcessPoolExecutor
 import cv2
+import knn
 import numpy as np
 import os
 import re
+import warnings
+
+# Feature scalings to try in cross validation. Each is worked out from the
+# training samples (fit) and then applied to training and test samples.
+# CatDetector uses the features as they are ('none').
+SCALINGS = {
+    'none': lambda samples: (np.zeros(samples.shape[1]), np.ones(samples.shape[1])),
+    'standard': lambda samples: (samples.mean(axis=0), samples.std(axis=0)),
+    'minmax': lambda samples: (samples.min(axis=0), np.ptp(samples, axis=0)),
+}
+
+
+def scale(samples, offset, factor):
+    factor = np.where(factor == 0, 1, factor)
+    return ((samples - offset) / factor).astype(np.float32)
+
+
+# Splits the sample indexes into folds with about the same share of every
+# label in each fold.
+def stratified_folds(labels, folds, seed=0):
+    labels = np.asarray(labels).reshape(-1)
+    rng = np.random.default_rng(seed)
+    assignment = np.empty(len(labels), dtype=np.int32)
+    offset = 0
+    for label in np.unique(labels):
+        indexes = rng.permutation(np.flatnonzero(labels == label))
+        # Carry on where the last label stopped, so small classes don't all
+        # end up in the first folds.
+        assignment[indexes] = (np.arange(len(indexes)) + offset) % folds
+        offset += len(indexes)
+    return [np.flatnonzero(assignment == fold) for fold in range(folds)]
+
+
+# Confusion matrix (expected label x predicted label) of a knn model with
+# k and scaling over all the folds, each fold predicted by a model trained
+# on the others.
+def cross_validate(samples, labels, k, scaling, folds):
+    confmatrix = np.zeros((4, 4), dtype=np.int32)
+    labels = np.asarray(labels).reshape(-1)
+    for test in folds:
+        train = np.ones(len(labels), dtype=bool)
+        train[test] = False
+        offset, factor = SCALINGS[scaling](samples[train])
+        model = knn.KNearest(scale(samples[train], offset, factor), labels[train], k=k)
+        _, results = model.predict(scale(samples[test], offset, factor))
+        np.add.at(confmatrix, (labels[test].astype(np.int32),
+                               results.reshape(-1).astype(np.int32)), 1)
+    return confmatrix
+
+
+def _cross_validate(args):
+    return cross_validate(*args)
+
+
+# Reads a whole label file (like catlabels.csv) at once. Returns the file
+# names, the labels (as strings) and the coordinates as an n x 4 float32
+# array, for the lines that have coordinates.
+def read_labelled_samples(labelfile):
+    rows = [line.split(',') for line in labelfile.read().splitlines()]
+    rows = [r for r in rows if len(r) >= 6 and r[0] != 'filename']
+    filenames = [r[0] for r in rows]
+    labels = [r[1] for r in rows]
+    if not rows:
+        return filenames, labels, np.empty((0, 4), dtype=np.float32)
+    # Parsing one long string is a lot faster than converting the fields
+    # one by one.
+    with warnings.catch_warnings():
+        # Stopping at something that isn't a number is a warning for now,
+        # caught by the length check below.
+        warnings.simplefilter('ignore', DeprecationWarning)
+        try:
+            samples = np.fromstring(' '.join(' '.join(r[2:6]) for r in rows),
+                                    dtype=np.float32, sep=' ')
+        except ValueError:
+            samples = np.empty(0, dtype=np.float32)
+    if len(samples) != 4 * len(rows):
+        raise ValueError('{0} has coordinates that are not numbers'.format(
+            getattr(labelfile, 'name', 'label file')))
+    return filenames, labels, samples.reshape(-1, 4)
+
 
 class Trainer(object):
+    # k for the knn models trained here.
+    default_k = 3
+
     def __init__(self):
         self.features = []
         self.labels = []
@@ -23,6 +108,7 @@ class Trainer(object):
         else:
             return 0
 
+    @staticmethod
     def string_for_label(label):
         if label == 3:
             return 'cat arriving'
@@ -42,19 +128,38 @@ class Trainer(object):
         l = np.asarray(self.labels).reshape((featurecount, 1))
         return (f, l)
 
-    def addTrainingDataFromFile(self, trainfile):
+    # With a feature store (see featurestore.py), the features come from
+    # there instead of the coordinates in the file, and frames the store
+    # has no features for are left out.
+    def addTrainingDataFromFile(self, trainfile, features=None):
         for line in trainfile:
             l = line.rstrip('\n')
             parts = l.split(',')
             if parts[0] == 'filename': # headerline
                 continue
+            if features is not None:
+                coords = features.features_for(parts[0])
+                if coords is not None:
+                    self.addTrainingData(label=parts[1], coords=coords, img=None)
+                continue
             if parts[2] == 'unknown':
                 continue
             self.addTrainingData(label=parts[1], coords=(parts[2], parts[3], parts[4], parts[5]), img=None)
 
+    # Same as addTrainingDataFromFile() for the rows catalog.Catalog.labelled()
+    # returns.
+    def addTrainingDataFromCatalog(self, rows):
+        for filename, label, left, right, top, bottom in rows:
+            if left is None:
+                continue
+            self.addTrainingData(label=label, coords=(left, right, top, bottom), img=None)
+
+    # coords are strings from a label file, or numbers as get_coords()
+    # found them (from a feature store), which are kept as they are.
     def addTrainingData(self, label, coords, img):
         self.labels.append(self.label_for_string(label))
-        self.features.append([np.float32(int(c)) for c in coords])
+        self.features.append([np.float32(int(c)) if isinstance(c, str) else np.float32(c)
+                              for c in coords])
 
 
     def trainClassifier(self):
@@ -67,7 +172,7 @@ class Trainer(object):
         #self.dtree_model.train(samples=samples, layout=cv2.ml.ROW_SAMPLE, responses=labels)
         #print('dtree model trained')
         self.knn_model = cv2.ml.KNearest_create()
-        self.knn_model.setDefaultK(3)
+        self.knn_model.setDefaultK(self.default_k)
         samples, labels = self.makeTrainingData()
         self.knn_model.train(samples=samples, layout=cv2.ml.ROW_SAMPLE, responses=labels)
         print('knn model trained')
@@ -81,13 +186,24 @@ class Trainer(object):
             filename = '{0}.knn'.format(modelfile)
             print('saving knn model to {0}'.format(filename))
             self.knn_model.save('{0}'.format(filename))
+            filename = '{0}.knnb'.format(modelfile)
+            print('saving binary knn model to {0}'.format(filename))
+            samples, labels = self.makeTrainingData()
+            knn.save_binary_model(filename, samples, labels, self.knn_model.getDefaultK())
         else:
             print('No model to save')
 
+    # Prefers the binary knn model (see knn.save_binary_model()), which
+    # loads a lot faster than opencv's yaml files.
     def loadModels(self, modelfile):
         knn_file = '{0}.knn'.format(modelfile)
+        knnb_file = '{0}.knnb'.format(modelfile)
         dtree_file = '{0}.dtree'.format(modelfile)
-        if os.path.exists(knn_file):
+        if os.path.exists(knnb_file):
+            if self.knn_model:
+                print('Loading new knn model from %s, overwriting existing one.' % knnb_file)
+            self.knn_model = knn.load_binary_model(knnb_file)
+        elif os.path.exists(knn_file):
             if self.knn_model:
                 print('Loading new knn model from %s, overwriting existing one.' % knn_file)
             self.knn_model = cv2.ml.KNearest_load(knn_file)
@@ -102,22 +218,43 @@ class Trainer(object):
             return
         featurecount=len(self.features)
         confmatrix_knn = np.zeros((4,4), dtype=np.int32)
-        goodcount_knn = 0
-        for index, sample in enumerate(self.features):
-          f = np.ndarray((1, 4), dtype=np.float32, buffer=np.array(sample, dtype=np.float32))
-          if self.knn_model:
-              retval, _ = self.knn_model.predict(f)
-              expected = self.labels[index]
-              r = int(retval)
-              confmatrix_knn[int(expected)][r] += 1
-              if expected == retval:
-                  goodcount_knn += 1
-              else:
-                  print('index {0} expected {1} got {2}'.format(index, expected, r))
+        samples, labels = self.makeTrainingData()
+        # One predict() call for all samples.
+        _, results = self.knn_model.predict(samples)
+        expected = labels.reshape(-1).astype(np.int32)
+        got = results.reshape(-1).astype(np.int32)
+        np.add.at(confmatrix_knn, (expected, got), 1)
+        goodcount_knn = int(np.count_nonzero(expected == got))
+        for index in np.flatnonzero(expected != got):
+            print('index {0} expected {1} got {2}'.format(index, expected[index], got[index]))
         print('knn performance: {0} out of {1} = {2}'.format(
             goodcount_knn, featurecount, (float)(goodcount_knn)/featurecount))
         print('knn confusion matrix:\n ', confmatrix_knn)
 
+    # Stratified cross validation of knn models for every k in ks and every
+    # scaling (see SCALINGS) in scalings, with the settings spread over a
+    # pool of processes. Returns {(k, scaling): confusion matrix}.
+    def crossValidate(self, ks, scalings, folds=5, workers=None):
+        if folds < 2:
+            raise ValueError('need at least 2 folds, not {0}'.format(folds))
+        unknown = [s for s in scalings if s not in SCALINGS]
+        if unknown:
+            raise ValueError('unknown scalings {0}'.format(', '.join(unknown)))
+        samples, labels = self.makeTrainingData()
+        split = stratified_folds(labels, folds)
+        settings = [(k, scaling) for k in ks for scaling in scalings]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(_cross_validate,
+                [(samples, labels, k, scaling, split) for k, scaling in settings])
+            return dict(zip(settings, results))
+
+    # Labels for an n x 4 array of samples, with one predict() call.
+    def testSamples(self, samples):
+        if len(samples) == 0:
+            return np.empty(0, dtype=np.int32)
+        _, results = self.knn_model.predict(np.ascontiguousarray(samples, dtype=np.float32))
+        return results.reshape(-1).astype(np.int32)
+
     def testModel(self, coords):
           f = np.ndarray((1, 4), dtype=np.float32, buffer=np.array(coords, dtype=np.float32))
           retval, _ = self.knn_model.predict(f)
@@ -1,6 +1,11 @@
 import argparse
+import catalog
+from datetime import datetime
+import featurestore
+import numpy as np
 import os
-from trainer import Trainer
+import time
+from trainer import SCALINGS, Trainer, read_labelled_samples
 
 
 if __name__ == "__main__":
@@ -10,12 +15,37 @@ if __name__ == "__main__":
   # If training, models will be written to this file.
   # For testing, models will be loaded from this file.
   parser.add_argument('--modelfile', default='./catflapmodel', help='File with model')
+  # With a catalog, the label file is added to the catalog and the training
+  # data comes from there, optionally only for some days.
+  parser.add_argument('--catalog', default=None, help='Catalog to train from (see catalog.py)')
+  parser.add_argument('--first', default=None, help='First day (YYYY-MM-DD) of training data')
+  parser.add_argument('--last', default=None, help='Last day (YYYY-MM-DD) of training data')
+  # With a feature store, the features for the labelled frames come from the
+  # store instead of the label file. With --images, the store is brought up
+  # to date first.
+  parser.add_argument('--features', default=None, help='Feature store (see featurestore.py)')
+  parser.add_argument('--images', default=None, help='Image directory to update the feature store from')
+  # Instead of training a model, cross validate knn models for all the
+  # combinations of --ks and --scalings on the training data.
+  parser.add_argument('--crossvalidate', action='store_true', help='Cross validate instead of training')
+  parser.add_argument('--folds', type=int, default=5, help='Folds for cross validation')
+  parser.add_argument('--ks', default='1,3,5,7,10,15', help='Values of k to cross validate')
+  parser.add_argument('--scalings', default=','.join(SCALINGS),
+          help='Feature scalings to cross validate ({0})'.format(', '.join(SCALINGS)))
+  parser.add_argument('--workers', type=int, default=None,
+          help='How many processes to use for cross validation (default: one per core)')
   args = parser.parse_args()
+  if args.folds < 2:
+      parser.error('--folds must be at least 2')
+  unknown = [s for s in args.scalings.split(',') if s not in SCALINGS]
+  if unknown:
+      parser.error('unknown --scalings {0} (choose from {1})'.format(
+          ', '.join(unknown), ', '.join(SCALINGS)))
   training = False
   testing = False
-  if args.labelfile:
+  if args.labelfile or args.catalog:
       training = True
-      if not os.path.exists(args.labelfile):
+      if args.labelfile and not os.path.exists(args.labelfile):
           print('Missing file with training data')
           exit
   if args.testfile:
@@ -25,9 +55,42 @@ if __name__ == "__main__":
           exit
   trainer = Trainer()
   if training:
-      with open(args.labelfile, 'r') as labelfile:
-          trainer.addTrainingDataFromFile(labelfile)
+      if args.catalog:
+          cat = catalog.Catalog(args.catalog)
+          if args.labelfile:
+              cat.add_labels(args.labelfile)
+          first = last = None
+          if args.first:
+              first = datetime.strptime(args.first, '%Y-%m-%d').date()
+          if args.last:
+              last = datetime.strptime(args.last, '%Y-%m-%d').date()
+          trainer.addTrainingDataFromCatalog(cat.labelled(first=first, last=last))
+      else:
+          store = None
+          if args.features:
+              store = featurestore.FeatureStore(args.features)
+              if args.images:
+                  print('computed features for {0} frames'.format(store.update(args.images)))
+          with open(args.labelfile, 'r') as labelfile:
+              trainer.addTrainingDataFromFile(labelfile, store)
       print('collected training data')
+      if args.crossvalidate:
+          ks = [int(k) for k in args.ks.split(',')]
+          scalings = args.scalings.split(',')
+          results = trainer.crossValidate(ks, scalings, args.folds, args.workers)
+          print('confusion matrices: rows are the labels, columns what the model said, '
+                'in the order {0}'.format(
+                    ', '.join(Trainer.string_for_label(label) for label in range(4))))
+          best = None
+          for (k, scaling), confmatrix in results.items():
+              accuracy = float(np.trace(confmatrix)) / confmatrix.sum()
+              print('k={0} scaling={1}: {2:.3f}'.format(k, scaling, accuracy))
+              print(' ', confmatrix)
+              if best is None or accuracy > best[0]:
+                  best = (accuracy, k, scaling)
+          print('best: k={0} scaling={1} with {2:.3f} of {3} samples in {4} folds'.format(
+              best[1], best[2], best[0], len(trainer.labels), args.folds))
+          exit()
       trainer.trainClassifier()
       print('Finished training model')
       # This just tests on the training data
@@ -42,20 +105,24 @@ if __name__ == "__main__":
               print('Need to train a model or load one')
               exit
           trainer.loadModels(args.modelfile)
+      start = time.perf_counter()
       with open(args.testfile, 'r') as testfile:
-          for line in testfile:
-              l = line.rstrip('\n')
-              parts = l.split(',')
-              if parts[0] == 'filename': # header line
-                  continue
-              if len(parts) < 6:
-                  continue
-              coords = (parts[2],parts[3],parts[4],parts[5])
-              result = trainer.testModel(coords=(parts[2],parts[3],parts[4],parts[5]))
-              reslabel = trainer.string_for_label(int(result))
-              if parts[1] == reslabel:
-                  continue
-              print('File {0} coords {1} expecting label {2} and got {3}'.format(
-                  parts[0], coords, parts[1], reslabel))
-
-
+          filenames, labels, samples = read_labelled_samples(testfile)
+      loaded = time.perf_counter()
+      results = trainer.testSamples(samples)
+      predicted = time.perf_counter()
+      names = np.array([Trainer.string_for_label(label) for label in range(4)])
+      reslabels = names[results]
+      expected = np.array([trainer.label_for_string(label) for label in labels], dtype=np.int32)
+      confmatrix = np.zeros((4, 4), dtype=np.int32)
+      np.add.at(confmatrix, (expected, results), 1)
+      mismatches = np.flatnonzero(np.array(labels) != reslabels)
+      for index in mismatches:
+          print('File {0} coords {1} expecting label {2} and got {3}'.format(
+              filenames[index], tuple(int(c) for c in samples[index]), labels[index],
+              reslabels[index]))
+      print('{0} of {1} test samples as expected'.format(len(labels) - len(mismatches), len(labels)))
+      print('knn confusion matrix:\n ', confmatrix)
+      print('read test data in {0:.3f}s, predicted in {1:.3f}s ({2:.0f} samples/s)'.format(
+          loaded - start, predicted - loaded,
+          len(labels) / (predicted - loaded) if predicted > loaded else 0.0))